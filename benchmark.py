@@ -0,0 +1,576 @@
+#!/usr/bin/env python3
+
+import contextlib
+import itertools
+import json
+import os
+import time
+from argparse import ArgumentParser
+from dataclasses import dataclass, field
+
+import numpy as np
+
+from ina226 import INA226
+from ina226_regs import INA226_Regs
+from ina226_i2c import INA226_I2C_If
+from ina226_remote import INA226_Remote
+from ina226_uart import INA226_Uart
+from ina226_ring import ByteRing
+from ina226_sim import INA226_Sim, INA226_SimChip, INA226_SimSerial, INA226_SimI2cPort
+from ina226_trace import tracer
+
+link_presets = {
+    'ideal': dict(latency=0.0, bandwidth=None, jitter=0.0, mtu=None),
+    'uart': dict(latency=0.0005, bandwidth=11520, jitter=0.0002, mtu=None),
+    'ble': dict(latency=0.0075, bandwidth=30000, jitter=0.005, mtu=244),
+}
+
+@dataclass
+class BenchResult:
+    name: str
+    samples: int = 0
+    packets: int = 0
+    wall: float = 0.0
+    cpu: float = 0.0
+    latencies: list = field(default_factory=list, repr=False)
+
+    @property
+    def samples_per_sec(self):
+        return self.samples / self.wall if self.wall else 0.0
+
+    @property
+    def cpu_per_sample(self):
+        return self.cpu / self.samples if self.samples else 0.0
+
+    def latency(self, q):
+        return float(np.percentile(self.latencies, q)) if self.latencies else 0.0
+
+    def summary(self):
+        return {
+            'name': self.name,
+            'samples': self.samples,
+            'packets': self.packets,
+            'samples_per_sec': self.samples_per_sec,
+            'latency_p50_ms': self.latency(50) * 1000,
+            'latency_p99_ms': self.latency(99) * 1000,
+            'cpu_us_per_sample': self.cpu_per_sample * 1e6,
+        }
+
+def run(name, step, duration):
+    result = BenchResult(name)
+
+    start_wall = time.perf_counter()
+    start_cpu = time.process_time()
+    while time.perf_counter() - start_wall < duration:
+        t = time.perf_counter()
+        nr_samples = step()
+        result.latencies.append(time.perf_counter() - t)
+        result.samples += nr_samples
+        result.packets += 1
+    result.wall = time.perf_counter() - start_wall
+    result.cpu = time.process_time() - start_cpu
+
+    return result
+
+def make_sim(args):
+    return INA226_Sim(latency=args.latency, bandwidth=args.bandwidth, jitter=args.jitter,
+                      mtu=args.mtu, loss=args.loss, seed=0)
+
+def make_ina226(ina_if):
+    ina226 = INA226(ina_if)
+    interval = ina226.setup()
+    ina226.calibrate(maxCurrent=0.100, Rshunt=1)
+    return ina226, interval
+
+def bench_remote(args):
+    remote = INA226_Remote(0x40, args.nr_samples, make_sim(args), args.pipeline_depth)
+    make_ina226(remote)
+
+    def step():
+        remote.read_packet()
+        return len(remote.current_buf)
+
+    return run('INA226_Remote', step, args.duration)
+
+def bench_stream(args):
+    remote = INA226_Remote(0x40, args.nr_samples, make_sim(args), args.pipeline_depth)
+    make_ina226(remote)
+    remote.start_stream()
+
+    def step():
+        remote.read_packet()
+        return len(remote.current_buf)
+
+    try:
+        return run('INA226_Remote stream', step, args.duration)
+    finally:
+        remote.stop_stream()
+
+def bench_stream_v2(args):
+    from ina226_proto import SampleFormat
+
+    remote = INA226_Remote(0x40, args.nr_samples, make_sim(args), args.pipeline_depth, protocol=2,
+                           sample_format=SampleFormat[args.encoding])
+    make_ina226(remote)
+    remote.start_stream()
+
+    def step():
+        remote.read_packet()
+        return len(remote.current_buf)
+
+    try:
+        return run(f'INA226_Remote push {args.encoding}', step, args.duration)
+    finally:
+        remote.stop_stream()
+
+def bench_profile(args):
+    from ina226_profile import profiles
+
+    # Profile switches while the bridge keeps pushing, one per step
+    remote = INA226_Remote(0x40, args.nr_samples, make_sim(args), args.pipeline_depth, protocol=2)
+    ina226, _ = make_ina226(remote)
+    remote.start_stream()
+    names = itertools.cycle(['fast-transient', 'balanced'])
+
+    def step():
+        ina226.apply_profile(profiles[next(names)])
+        remote.read_packet()
+        return 1
+
+    try:
+        return run('profile switch', step, args.duration)
+    finally:
+        remote.stop_stream()
+
+def bench_codec(args):
+    from ina226_codec import encode_delta, decode_delta
+
+    chip = INA226_SimChip(seed=0)
+    chip.regs[INA226_Regs.Calibration] = 1677
+    nr_pairs = max(args.nr_samples // 2, 1)
+    current, vbus, _ = chip.samples(np.arange(nr_pairs) * chip.conversionInterval())
+    data = encode_delta(current, vbus)
+
+    def step():
+        decode_delta(data)
+        return nr_pairs
+
+    result = run('delta decode', step, args.duration)
+    result.name = f'delta decode {4 * nr_pairs / len(data):.2f}x'
+    return result
+
+def bench_async(args):
+    import asyncio
+    from ina226_remote import INA226_RemoteAsync
+    from ina226_sim import INA226_SimAsync
+
+    loop = asyncio.new_event_loop()
+    ll = INA226_SimAsync(make_sim(args))
+    remote = loop.run_until_complete(INA226_RemoteAsync.create(0x40, args.nr_samples, ll, args.pipeline_depth))
+
+    def step():
+        current, _ = loop.run_until_complete(remote.readBatch())
+        return len(current)
+
+    try:
+        return run('INA226_RemoteAsync', step, args.duration)
+    finally:
+        loop.close()
+
+def bench_multi(args):
+    from ina226_multi import INA226_Multi
+
+    multi = INA226_Multi(nr_samples=args.nr_samples // 2)
+    for k in range(4):
+        remote = INA226_Remote(0x40, args.nr_samples, make_sim(args), args.pipeline_depth)
+        ina226, _ = make_ina226(remote)
+        multi.add_rail(f'rail{k}', ina226)
+    multi.start()
+    counted = 0
+
+    # Samples actually read from the rails, not the grid points made from them
+    def step():
+        nonlocal counted
+        multi.read()
+        total = sum(rail.nr_samples for rail in multi.rails.values())
+        nr_samples, counted = total - counted, total
+        return nr_samples
+
+    try:
+        return run('INA226_Multi x4', step, args.duration)
+    finally:
+        multi.stop()
+
+def bench_uart(args):
+    uart = INA226_Uart(INA226_SimSerial(make_sim(args)), 115200)
+
+    def step():
+        uart.read_packet()
+        return len(uart.current_buf)
+
+    return run('INA226_Uart', step, args.duration)
+
+def bench_i2c(args):
+    port = INA226_SimI2cPort(INA226_SimChip(seed=0), latency=args.usb_latency)
+    ina226, _ = make_ina226(INA226_I2C_If(port))
+
+    def step():
+        ina226.readCurrent()
+        ina226.readVbus()
+        return 1
+
+    return run('INA226_I2C_If', step, args.duration)
+
+def bench_i2c_poll(args):
+    from ina226_regs import INA226_Regs, MODE_Setting, VSHCT_Setting, VBUSCT_Setting, AVG_Setting
+
+    port = INA226_SimI2cPort(INA226_SimChip(seed=0), latency=args.usb_latency)
+    ina_if = INA226_I2C_If(port)
+    ina226, _ = make_ina226(ina_if)
+    ina226.apply_config(config=MODE_Setting.ShuntAndBusVoltageCont |
+                        (VSHCT_Setting.ConversionTime_140us << 3) | (VBUSCT_Setting.ConversionTime_140us << 6) |
+                        (AVG_Setting.NrAverages_4 << 9))
+
+    def step():
+        current, _, _ = ina226.read_batch()
+        return len(current)
+
+    return run('INA226_I2C_If poll', step, args.duration)
+
+def bench_generator(args):
+    import monitor
+
+    remote = INA226_Remote(0x40, args.nr_samples, make_sim(args), args.pipeline_depth)
+    ina226, interval = make_ina226(remote)
+    gen = monitor.generator(ina226, interval)
+
+    def step():
+        next(gen)
+        return 1
+
+    return run('monitor.generator', step, args.duration)
+
+def bench_batch(args):
+    remote = INA226_Remote(0x40, args.nr_samples, make_sim(args), args.pipeline_depth)
+    ina226, _ = make_ina226(remote)
+
+    def step():
+        current, _, _ = ina226.read_batch()
+        return len(current)
+
+    return run('INA226.read_batch', step, args.duration)
+
+def bench_block_generator(args):
+    import monitor
+
+    remote = INA226_Remote(0x40, args.nr_samples, make_sim(args), args.pipeline_depth)
+    ina226, _ = make_ina226(remote)
+    gen = monitor.block_generator(ina226)
+
+    def step():
+        _, (power, _, _) = next(gen)
+        return len(power)
+
+    return run('monitor.block_generator', step, args.duration)
+
+def make_capture(args, nr_samples=1 << 18):
+    import tempfile
+    from ina226_capture import CaptureWriter
+
+    remote = INA226_Remote(0x40, 2048, INA226_Sim(seed=0), 4)
+    ina226, _ = make_ina226(remote)
+
+    path = os.path.join(tempfile.mkdtemp(), 'bench.cap')
+    with CaptureWriter.for_ina226(path, ina226) as writer:
+        while writer.nr_samples < nr_samples:
+            writer.write(*ina226.read_raw_batch())
+    remote.terminate()
+
+    return path
+
+def bench_replay(args):
+    from ina226_replay import INA226_Replay
+
+    ina226, _ = make_ina226(INA226_Replay(make_capture(args), args.nr_samples, loop=True))
+
+    def step():
+        current, _, _ = ina226.read_batch()
+        return len(current)
+
+    return run('INA226_Replay', step, args.duration)
+
+def bench_stats(args):
+    from ina226_replay import INA226_Replay
+    from ina226_stats import RailStats
+
+    ina226, interval = make_ina226(INA226_Replay(make_capture(args), args.nr_samples, loop=True))
+    stats = RailStats(int(5 / interval))
+    t0 = 0.0
+
+    def step():
+        nonlocal t0
+        current, vbus, power = ina226.read_batch()
+        t = t0 + interval * np.arange(len(current))
+        t0 = t[-1] + interval
+        stats.update(t, current, vbus, power)
+        return len(current)
+
+    return run('RailStats', step, args.duration)
+
+def bench_ring(args):
+    import threading
+
+    ring = ByteRing(1 << 16)
+    notification = bytes(args.mtu or 244)
+    stop = threading.Event()
+
+    def producer():
+        while not stop.is_set():
+            with ring.cond:
+                ring.cond.wait_for(lambda: ring.capacity - ring.size >= len(notification) or ring.closed)
+            ring.write(notification)
+
+    thread = threading.Thread(target=producer, daemon=True)
+    thread.start()
+
+    pkt = np.empty(args.nr_samples, dtype='<u2')
+
+    def step():
+        ring.readinto(pkt)
+        return args.nr_samples // 2
+
+    try:
+        return run('ByteRing', step, args.duration)
+    finally:
+        stop.set()
+        ring.close()
+        thread.join()
+
+def bench_startup(args):
+    import subprocess
+    import sys
+
+    # One short headless capture per launch, the way test jigs drive the tool
+    path = make_capture(args, nr_samples=4096)
+    cmd = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'monitor.py'),
+           '--transport', 'replay', '--replay', path, '--headless', '--output', os.devnull]
+
+    def step():
+        subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        return 1
+
+    return run('monitor.py startup', step, args.duration)
+
+def bench_trigger(args):
+    from ina226_trigger import TriggerEngine, Trigger
+
+    chip = INA226_SimChip(seed=0)
+    chip.regs[INA226_Regs.Calibration] = 1677
+    ina226, _ = make_ina226(INA226_Remote(0x40, args.nr_samples, make_sim(args)))
+    nr_pairs = max(args.nr_samples // 2, 1)
+    t = np.arange(64 * nr_pairs) * chip.conversionInterval()
+    current, vbus, _ = chip.samples(t)
+    engine = TriggerEngine(ina226, Trigger('current', 'edge', 'rising', 0.065, 0.002), max_packet=nr_pairs)
+    pos = 0
+
+    def step():
+        nonlocal pos
+        sl = slice(pos, pos + nr_pairs)
+        engine.feed(t[sl], current[sl], vbus[sl])
+        pos = (pos + nr_pairs) % len(t)
+        return nr_pairs
+
+    return run('trigger edge', step, args.duration)
+
+def bench_rollup(args):
+    import tempfile
+    from ina226_rollup import RollupStore
+
+    chip = INA226_SimChip(seed=0)
+    chip.regs[INA226_Regs.Calibration] = 1677
+    nr_pairs = max(args.nr_samples // 2, 1)
+    interval = chip.conversionInterval()
+    current, vbus, _ = chip.samples(np.arange(64 * nr_pairs) * interval)
+    tmp = tempfile.TemporaryDirectory()
+    store = RollupStore(tmp.name, 0.1 / 32768, raw_samples=1 << 20)
+    start = time.time()
+    pos = 0
+
+    def step():
+        nonlocal pos
+        sl = slice(pos % len(current), pos % len(current) + nr_pairs)
+        store.update(start + (pos + np.arange(nr_pairs)) * interval, current[sl], vbus[sl])
+        pos += nr_pairs
+        return nr_pairs
+
+    try:
+        return run('rollup store', step, args.duration)
+    finally:
+        store.close()
+        tmp.cleanup()
+
+def _shm_producer(name, nr_pairs, stop):
+    from ina226_shm import SampleRingWriter
+
+    writer = SampleRingWriter(name, slots=256, block_samples=nr_pairs)
+    t = np.arange(nr_pairs) * 1e-3
+    current = np.arange(nr_pairs, dtype=np.uint16)
+    vbus = np.full(nr_pairs, 2640, dtype=np.uint16)
+    try:
+        while not stop.is_set():
+            writer.write(t, current, vbus)
+            t += nr_pairs * 1e-3
+            # Pace below the consumer so the benchmark measures reads, not drops
+            time.sleep(nr_pairs * 1e-7)
+    finally:
+        writer.close()
+
+def bench_shm(args):
+    import multiprocessing
+    from ina226_shm import SampleRingReader
+
+    name = f'ina226_bench_{os.getpid()}'
+    nr_pairs = max(args.nr_samples // 2, 1)
+    stop = multiprocessing.Event()
+    producer = multiprocessing.Process(target=_shm_producer, args=(name, nr_pairs, stop), daemon=True)
+    producer.start()
+    while True:
+        try:
+            reader = SampleRingReader(name)
+            break
+        except FileNotFoundError:
+            time.sleep(0.01)
+
+    def step():
+        t, current, vbus = reader.read(1.0)
+        return len(t)
+
+    try:
+        result = run('shm ring reader', step, args.duration)
+        stats = reader.stats()
+        result.name = f'shm ring drop {stats["dropped_blocks"]}'
+        return result
+    finally:
+        reader.close()
+        stop.set()
+        producer.join()
+
+def bench_net(args):
+    import threading
+    from ina226_net import SampleServer, INA226_Net
+
+    nr_pairs = max(args.nr_samples // 2, 1)
+    server = SampleServer(0, meta=dict(currentLSB=0.1 / 32768, interval=1e-3, config=0x4127, calibration=1677))
+    client = INA226_Net('127.0.0.1', server.port)
+    stop = threading.Event()
+
+    def producer():
+        t = np.arange(nr_pairs) * 1e-3
+        current = np.arange(nr_pairs, dtype=np.uint16)
+        vbus = np.full(nr_pairs, 2640, dtype=np.uint16)
+        while not stop.is_set():
+            server.publish(t, current, vbus)
+            t += nr_pairs * 1e-3
+            time.sleep(nr_pairs * 1e-7)
+
+    thread = threading.Thread(target=producer, daemon=True)
+    thread.start()
+
+    def step():
+        current, _, _ = client.readBatchTimed()
+        return len(current)
+
+    try:
+        result = run('net client', step, args.duration)
+        result.name = f'net client drop {client.dropped_samples}'
+        return result
+    finally:
+        stop.set()
+        thread.join()
+        server.close()
+        client.terminate()
+
+benchmarks = {
+    'remote': bench_remote,
+    'stream': bench_stream,
+    'stream_v2': bench_stream_v2,
+    'profile': bench_profile,
+    'codec': bench_codec,
+    'async': bench_async,
+    'multi': bench_multi,
+    'uart': bench_uart,
+    'i2c': bench_i2c,
+    'i2c_poll': bench_i2c_poll,
+    'generator': bench_generator,
+    'batch': bench_batch,
+    'block_generator': bench_block_generator,
+    'ring': bench_ring,
+    'replay': bench_replay,
+    'stats': bench_stats,
+    'startup': bench_startup,
+    'trigger': bench_trigger,
+    'rollup': bench_rollup,
+    'shm': bench_shm,
+    'net': bench_net,
+}
+
+def main():
+    argparser = ArgumentParser()
+    argparser.add_argument('--link', default='ble', choices=link_presets.keys(),
+                            help='simulated link preset')
+    argparser.add_argument('--latency', type=float, default=None,
+                            help='one-way link latency, s')
+    argparser.add_argument('--bandwidth', type=float, default=None,
+                            help='link bandwidth, bytes/s')
+    argparser.add_argument('--jitter', type=float, default=None,
+                            help='max extra latency per chunk, s')
+    argparser.add_argument('--mtu', type=int, default=None,
+                            help='max bytes per link chunk')
+    argparser.add_argument('--encoding', default='Raw16', choices=['Raw16', 'Delta'],
+                            help='sample encoding for the v2 stream benchmark')
+    argparser.add_argument('--loss', type=float, default=0.0,
+                            help='probability of losing a byte per link chunk')
+    argparser.add_argument('--usb_latency', type=float, default=1e-3,
+                            help='simulated FTDI USB transaction time, s')
+    argparser.add_argument('--nr_samples', type=lambda x: int(x,0), default=128,
+                            help='Number of samples to read per batch (remote only)')
+    argparser.add_argument('--pipeline_depth', type=int, default=1,
+                            help='packet requests kept in flight (remote only)')
+    argparser.add_argument('--duration', type=float, default=2.0,
+                            help='seconds per benchmark')
+    argparser.add_argument('--json', default=None,
+                            help='write results to json file')
+    argparser.add_argument('--trace', default=None,
+                            help='record spans and write a Chrome trace to this file')
+    argparser.add_argument('benchmarks', nargs='*', default=list(benchmarks.keys()),
+                            help=f'benchmarks to run: {", ".join(benchmarks.keys())}')
+
+    args = argparser.parse_args()
+
+    for k, v in link_presets[args.link].items():
+        if getattr(args, k) is None:
+            setattr(args, k, v)
+
+    if args.trace:
+        tracer.enable()
+
+    results = []
+    for name in args.benchmarks:
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            result = benchmarks[name](args)
+        results.append(result.summary())
+
+    print(f'{"benchmark":<24} {"samples/s":>12} {"p50 ms":>9} {"p99 ms":>9} {"cpu us/sample":>14}')
+    for r in results:
+        print(f'{r["name"]:<24} {r["samples_per_sec"]:>12.1f} {r["latency_p50_ms"]:>9.2f} '
+              f'{r["latency_p99_ms"]:>9.2f} {r["cpu_us_per_sample"]:>14.2f}')
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'link': {k: getattr(args, k) for k in link_presets['ideal']}, 'results': results}, f, indent=2)
+
+    if args.trace:
+        tracer.dump(args.trace)
+
+if __name__ == '__main__':
+    main()
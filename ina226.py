@@ -1,11 +1,14 @@
 
 
 import time
+import numpy as np
 from ina226_regs import *
 from ina226_if import INA226_If
+from ina226_trace import tracer
 
 class INA226:
     endianess: str = 'big'
+    BusVoltageLSB = 1.25e-3
     ina226_if: INA226_If = None
 
     map_conv_time = {
@@ -33,47 +36,121 @@ class INA226:
     def __init__(self, ina226_if: INA226_If):
         self.ina226_if = ina226_if
 
-        ManId = self.ina226_if.readReg16(INA226_Regs.ManId)
-        DieId = self.ina226_if.readReg16(INA226_Regs.DieId)
+        # Ids and the writable registers in one exchange, the latter seed the shadow
+        regs = [INA226_Regs.ManId, INA226_Regs.DieId, *self.writable]
+        ManId, DieId, *values = self.ina226_if.transact([(addr, None) for addr in regs])
 
         assert ManId == 0x5449, f'ManId doesn\'t match : {hex(ManId)}, expected : {hex(0x5449)}'
         assert DieId == 0x2260, f'DieId doesn\'t match : {hex(DieId)}, expected : {hex(0x2260)}'
 
+        self.config = None
+        self.calibration = None
+        self.currentLSB = None
+        self.interval = None
+        # Last known value of each writable register, lets apply_config skip
+        # whatever the device already holds
+        self.shadow = {addr: val & mask for (addr, mask), val in zip(self.writable.items(), values)}
+
         print('Init OK')
 
 
-    def setup(self):
-        VBUSCT_setting = VBUSCT_Setting.ConversionTime_1100us
-        VSHCT_setting = VSHCT_Setting.ConversionTime_1100us
-        MODE_setting = MODE_Setting.ShuntAndBusTriggered
-        AVG_setting = AVG_Setting.NrAverages_64
+    def setup(self, VSHCT_setting=VSHCT_Setting.ConversionTime_1100us,
+              VBUSCT_setting=VBUSCT_Setting.ConversionTime_1100us,
+              AVG_setting=AVG_Setting.NrAverages_64,
+              MODE_setting=MODE_Setting.ShuntAndBusTriggered):
 
         reg_val = MODE_setting | (VSHCT_setting << 3) | (VBUSCT_setting << 6) | (AVG_setting << 9)
 
-        self.ina226_if.writeReg16(INA226_Regs.Config, reg_val)
-        got = self.ina226_if.readReg16(INA226_Regs.Config)
-
-        assert (got & reg_val) == reg_val, f'Write config failed: got {hex(got & reg_val)} != exp {hex(reg_val)}'
+        # Always written: the write arms triggered mode, and the bridges only
+        # learn the mode from it
+        self.apply_config(config=reg_val, force=True)
 
         print('Setup OK')
 
-        interval = self.map_conv_time[VSHCT_setting] * self.map_avg[AVG_setting] + \
-                    self.map_conv_time[VBUSCT_setting] * self.map_avg[AVG_setting] + 2
-        interval /= 1000
+        interval = self.config_interval(reg_val)
+        self.interval = interval
+        self.ina226_if.setInterval(interval)
 
         return interval
 
+    @classmethod
+    def config_interval(cls, config):
+        vshct = (config >> 3) & 0b111
+        vbusct = (config >> 6) & 0b111
+        avg = (config >> 9) & 0b111
+        interval = (cls.map_conv_time[vshct] + cls.map_conv_time[vbusct]) * cls.map_avg[avg]
+        if not config & 0b100:
+            # Triggered conversions also wait for the retrigger round trip
+            interval += 2
+        return interval / 1000
+
     def calibrate(self, maxCurrent, Rshunt):
         currentLSB = maxCurrent / (2**15)
         cal = 0.00512 / (currentLSB * Rshunt)
         cal = int(cal)
 
         self.currentLSB = currentLSB
+        self.apply_config(calibration=cal)
+
+    # Bits that read back as written, the rest are reserved or status flags
+    writable = {
+        INA226_Regs.Config: 0x0fff,
+        INA226_Regs.Calibration: 0x7fff,
+        INA226_Regs.MaskEnable: 0xfc03,
+        INA226_Regs.AlertLimit: 0xffff,
+    }
 
-        self.ina226_if.writeReg16(INA226_Regs.Calibration, cal)
+    def apply_config(self, config=None, calibration=None, mask_enable=None, alert_limit=None, force=False):
+        requested = {
+            INA226_Regs.Config: config,
+            INA226_Regs.Calibration: calibration,
+            INA226_Regs.MaskEnable: mask_enable,
+            INA226_Regs.AlertLimit: alert_limit,
+        }
+        requested = {addr: val for addr, val in requested.items() if val is not None}
+
+        if config is not None and config & 0x8000:
+            # Reset puts every register back to its default
+            self.invalidate()
+        regs = {addr: val for addr, val in requested.items()
+                if force or self.shadow.get(addr) != val & self.writable[addr]}
+
+        if regs:
+            # All writes then all read-backs, one exchange on batching transports
+            ops = list(regs.items()) + [(addr, None) for addr in regs]
+            got = self.ina226_if.transact(ops)[len(regs):]
+
+            for (addr, val), reg in zip(regs.items(), got):
+                mask = self.writable[addr]
+                reset = addr == INA226_Regs.Config and val & 0x8000
+                assert reset or (reg & mask) == (val & mask), f'Write reg {hex(addr)} failed: got {hex(reg)} != exp {hex(val)}'
+                self.shadow[addr] = reg & mask
+
+        if config is not None:
+            self.config = config
+        if calibration is not None:
+            self.calibration = calibration
+        return {addr: self.shadow[addr] for addr in requested}
+
+    def invalidate(self):
+        # Forget the shadow after the device may have changed behind our back,
+        # e.g. a power cycle, the next apply_config writes everything
+        self.shadow = {}
+
+    def apply_profile(self, profile):
+        # Only the registers that differ from the shadow go out, so switching
+        # between profiles is at most one exchange
+        config, calibration, currentLSB = profile.registers()
+        self.apply_config(config=config, calibration=calibration)
+        self.currentLSB = currentLSB
+        self.interval = self.config_interval(config)
+        self.ina226_if.setInterval(self.interval)
+        return self.interval
 
     def readCurrent(self):
-        raw =  self.ina226_if.readCurrent()
+        raw = int(self.ina226_if.readCurrent())
+        if raw & 0x8000:
+            raw -= 0x10000
         return float(raw) * self.currentLSB
 
     def readVbus(self):
@@ -81,29 +158,28 @@ class INA226:
         vbus = raw * 1.25
         return vbus / 1000
 
-    def calibrateInterval(self):
-        nr_iter = 20
-        start_time = time.time()
-        for _ in range (nr_iter):
-            _ = self.ina226_if.readReg16(INA226_Regs.Current)
-        diff_time = (time.time() - start_time) / nr_iter
-        diff_time *= 1000
-        diff_time += 2
-
-        min_diff = float('inf')
-        best_pair = (None, None)
-
-        for conv_time_setting, conv_time in map_conv_time:
-            for avg_setting, avg in map_avg:
-                product = conv_time * avg
-                diff = abs(diff_time - product)
-
-                if diff < min_diff:
-                    min_diff = diff
-                    best_pair = (conv_time_setting, avg_setting)
-
-        conv_time_setting, avg_setting = best_pair
-        return conv_time_setting, avg_setting, diff_time/1000
+    def read_raw_batch(self, n=None):
+        return self.ina226_if.readBatch(n)
+
+    def read_batch(self, n=None):
+        return self.convert(*self.read_raw_batch(n))
+
+    def read_raw_batch_timed(self, n=None):
+        current_raw, vbus_raw, t = self.ina226_if.readBatchTimed(n)
+        return t, current_raw, vbus_raw
+
+    def read_batch_timed(self, n=None):
+        t, current_raw, vbus_raw = self.read_raw_batch_timed(n)
+        return (t, *self.convert(current_raw, vbus_raw))
+
+    def convert(self, current_raw, vbus_raw):
+        start = tracer.enabled and time.perf_counter_ns()
+        current = current_raw.view(np.int16) * self.currentLSB
+        vbus = vbus_raw * self.BusVoltageLSB
+        power = current * vbus
+
+        if start: tracer.record('ina226.convert', start)
+        return current, vbus, power
 
     def terminate(self):
         self.ina226_if.terminate()
\ No newline at end of file
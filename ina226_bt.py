@@ -1,99 +1,176 @@
 import asyncio
-from collections import deque
 from bleak import BleakClient, BleakScanner
-import numpy as np
-from enum import IntEnum
 import threading
+import time
 
-from ina226_if import INA226_ll
+from ina226_if import INA226_ll, INA226_llAsync
+from ina226_ring import ByteRing
+import ina226_metrics as metrics
+from ina226_trace import tracer
 
 UART_TX_UUID = "6E400002-B5A3-F393-E0A9-E50E24DCCA9E"
 UART_RX_UUID = "6E400003-B5A3-F393-E0A9-E50E24DCCA9E"
 
-class INA226_Bt(INA226_ll):
-    byteorder = 'little'
-    MaxPktLen = 2048
+async def ble_scan(targetDeviceName):
+    print("Scanning for BLE devices...")
+    devices = await BleakScanner.discover()
 
-    def __init__(self, targetDeviceName):
-        self.rxbuf = deque(maxlen=self.MaxPktLen)
-        self.txbuf = deque(maxlen=self.MaxPktLen)
+    # Look for the device with the matching name
+    target_device = None
+    for device in devices:
+        if device.name == targetDeviceName:
+            target_device = device
+            break
 
-        self.async_loop = asyncio.new_event_loop()
-        self.thread = threading.Thread(target=self.start_async_loop, args=(self.async_loop,), daemon=True)
-        self.thread.start()
+    if target_device is None:
+        print(f"Device with name '{targetDeviceName}' not found.")
+        return None
 
-        self.future = asyncio.run_coroutine_threadsafe(self.ble_gatt_loop(targetDeviceName), self.async_loop)
+    print(f"Found device: {target_device.name}, Address: {target_device.address}")
 
-        self._terminate = False
-        self._terminated = False
+    return target_device
 
-    def start_async_loop(self, loop):
-        asyncio.set_event_loop(loop)
-        loop.run_forever()
+class INA226_BtAsync(INA226_llAsync):
+    byteorder = 'little'
+    RxBufLen = 1 << 16
 
-    async def ble_scan(self, targetDeviceName):
-        print("Scanning for BLE devices...")
-        devices = await BleakScanner.discover()
+    def __init__(self, targetDeviceName, on_data=None):
+        self.targetDeviceName = targetDeviceName
+        self.on_data = on_data
+        self.client = None
+        self.tx_lock = asyncio.Lock()
 
-        # Look for the device with the matching name
-        target_device = None
-        for device in devices:
-            if device.name == targetDeviceName:
-                target_device = device
-                break
+        self.rxbuf = bytearray()
+        self.waiter = None
+        self.dropped = 0
 
-        if target_device is None:
-            print(f"Device with name '{targetDeviceName}' not found.")
-            return None
+    async def connect(self):
+        target_device = await ble_scan(self.targetDeviceName)
 
-        print(f"Found device: {target_device.name}, Address: {target_device.address}")
+        if not target_device:
+            return False
 
-        return target_device
+        print("Connecting...")
 
-    async def ble_gatt_loop(self, targetDeviceName):
+        self.client = BleakClient(target_device.address)
+        await self.client.connect()
+        print(f"Connected to {target_device.address}")
 
-        target_device = await self.ble_scan(targetDeviceName)
+        await self.client.start_notify(UART_RX_UUID, self.notification_handler)
+        return True
 
-        if not target_device:
+    def notification_handler(self, sender, data):
+        if self.on_data:
+            self.on_data(data)
             return
 
-        print("Connecting...")
+        free = self.RxBufLen - len(self.rxbuf)
+        if len(data) > free:
+            self.dropped += len(data) - free
+            print(f'rx overflow: dropped {len(data) - free} bytes, {self.dropped} total')
+            data = data[:free]
+        self.rxbuf.extend(data)
 
-        async with BleakClient(target_device.address) as client:
-            print(f"Connected to {target_device.address}")
+        if self.waiter and len(self.rxbuf) >= self.waiter[0] and not self.waiter[1].done():
+            self.waiter[1].set_result(None)
 
-            def notification_handler(sender, data):
-                self.rxbuf.extend(data)
+    async def send(self, data):
+        async with self.tx_lock:
+            await self.client.write_gatt_char(UART_TX_UUID, bytes(data))
 
-            await client.start_notify(UART_RX_UUID, notification_handler)
+    async def recvInto(self, buf):
+        out = memoryview(buf).cast('B')
+        n = len(out)
 
+        while len(self.rxbuf) < n:
+            self.waiter = (n, asyncio.get_running_loop().create_future())
             try:
-                while not self._terminate:
-                    await asyncio.sleep(0.01)
-                    _txbuf = bytes([self.txbuf.popleft() for _ in range(len(self.txbuf))])
-                    if len(_txbuf):
-                        await client.write_gatt_char(UART_TX_UUID, _txbuf)
-            except KeyboardInterrupt:
-                print('*** KeyboardInterrupt ***')
-                pass
+                await self.waiter[1]
+            finally:
+                self.waiter = None
+
+        out[:] = self.rxbuf[:n]
+        del self.rxbuf[:n]
+        return n
+
+    async def terminate(self):
+        if self.client is None:
+            return
+        if self.client.is_connected:
+            await self.client.stop_notify(UART_RX_UUID)
+            await self.client.disconnect()
+        print("Disconnected.")
+        self.client = None
+
+class INA226_Bt(INA226_ll):
+    byteorder = 'little'
+    MaxPktLen = 2048
+    RxBufLen = 1 << 16
+
+    def __init__(self, targetDeviceName):
+        self.rxbuf = ByteRing(self.RxBufLen)
+        self.txq = asyncio.Queue()
 
-            await client.stop_notify(UART_RX_UUID)
-            await client.disconnect()
-            print("Disconnected.")
-            self._terminated = True
+        labels = {'device': targetDeviceName}
+        self.m_rx_bytes = metrics.counter('ina226_rx_bytes_total', 'Bytes received from the link', labels)
+        self.m_rx_dropped = metrics.counter('ina226_rx_dropped_bytes_total', 'Bytes dropped on rx buffer overflow', labels)
+        self.m_rx_fill = metrics.gauge('ina226_rx_buffer_bytes', 'Bytes waiting in the rx buffer', labels)
+        self.bt = INA226_BtAsync(targetDeviceName, on_data=self.notification_handler)
 
+        self.async_loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.start_async_loop, args=(self.async_loop,), daemon=True)
+        self.thread.start()
 
-    def sendBytes(self, bytes):
-        self.txbuf.extend(bytes)
+        self.future = asyncio.run_coroutine_threadsafe(self.ble_gatt_loop(), self.async_loop)
+
+    def start_async_loop(self, loop):
+        asyncio.set_event_loop(loop)
+        loop.run_forever()
+
+    def notification_handler(self, data):
+        n = self.rxbuf.write(data)
+        self.m_rx_bytes.inc(len(data))
+        self.m_rx_fill.set(self.rxbuf.size)
+        if n < len(data):
+            self.m_rx_dropped.inc(len(data) - n)
+            print(f'rx overflow: dropped {len(data) - n} bytes, {self.rxbuf.dropped} total')
+
+    async def ble_gatt_loop(self):
+        if not await self.bt.connect():
+            return
+
+        try:
+            while True:
+                data = [await self.txq.get()]
+                while not self.txq.empty() and data[-1] is not None:
+                    data.append(self.txq.get_nowait())
+
+                terminate = data[-1] is None
+                data = b''.join(d for d in data if d is not None)
+                if data:
+                    await self.bt.send(data)
+                if terminate:
+                    break
+        finally:
+            await self.bt.terminate()
+
+    def sendBytes(self, data):
+        self.async_loop.call_soon_threadsafe(self.txq.put_nowait, bytes(data))
 
     def recvBytes(self, nr_bytes):
-        while len(self.rxbuf) < nr_bytes:
-            pass
-        data = bytes([self.rxbuf.popleft() for _ in range(nr_bytes)])
+        start = tracer.enabled and time.perf_counter_ns()
+        data = self.rxbuf.read(nr_bytes)
+        if start: tracer.record('ll.recvBytes', start)
         return data
 
+    def recvInto(self, buf):
+        start = tracer.enabled and time.perf_counter_ns()
+        n = self.rxbuf.readinto(buf)
+        if start: tracer.record('ll.recvInto', start)
+        return n
+
     def terminate(self):
-        self._terminate = True
-        while self._terminated == False:
-            pass
-        print('Terminated')
\ No newline at end of file
+        self.async_loop.call_soon_threadsafe(self.txq.put_nowait, None)
+        self.future.result()
+        self.rxbuf.close()
+        print('Terminated')
@@ -0,0 +1,191 @@
+import os
+import time
+import numpy as np
+
+from ina226 import INA226
+
+CaptureMagic = b'INA226CP'
+CaptureVersion = 1
+ChunkMagic = b'CHNK'
+
+header_dtype = np.dtype([
+    ('magic', 'S8'),
+    ('version', '<u2'),
+    ('header_size', '<u2'),
+    ('chunk_samples', '<u4'),
+    ('config', '<u2'),
+    ('calibration', '<u2'),
+    ('reserved', '<u4'),
+    ('currentLSB', '<f8'),
+    ('interval', '<f8'),
+    ('start_time', '<f8'),
+    ('padding', 'V16'),
+])
+
+def chunk_dtype(chunk_samples):
+    return np.dtype([
+        ('magic', 'S4'),
+        ('index', '<u4'),
+        ('count', '<u4'),
+        ('reserved', '<u4'),
+        ('time', '<f8'),
+        ('samples', '<u2', (chunk_samples, 2)),
+    ])
+
+class CaptureWriter:
+    def __init__(self, path, config, calibration, currentLSB, interval, start_time=None, chunk_samples=4096):
+        self.path = path
+        self.chunk_samples = chunk_samples
+        self.interval = interval
+        self.start_time = start_time if start_time is not None else time.time()
+
+        header = np.zeros(1, dtype=header_dtype)
+        header['magic'] = CaptureMagic
+        header['version'] = CaptureVersion
+        header['header_size'] = header_dtype.itemsize
+        header['chunk_samples'] = chunk_samples
+        header['config'] = config
+        header['calibration'] = calibration
+        header['currentLSB'] = currentLSB
+        header['interval'] = interval
+        header['start_time'] = self.start_time
+
+        self.file = open(path, 'wb')
+        self.file.write(header.data)
+
+        self.chunk = np.zeros(1, dtype=chunk_dtype(chunk_samples))
+        self.chunk['magic'] = ChunkMagic
+        self.samples = self.chunk['samples'][0]
+        self.fill = 0
+        self.index = 0
+        self.nr_samples = 0
+
+    @classmethod
+    def for_ina226(cls, path, ina226: INA226, **kwargs):
+        return cls(path, ina226.config, ina226.calibration, ina226.currentLSB, ina226.interval, **kwargs)
+
+    def _flush_chunk(self):
+        self.chunk['index'] = self.index
+        self.chunk['count'] = self.fill
+        self.file.write(self.chunk.data)
+        self.index += 1
+        self.fill = 0
+
+    def write(self, current_raw, vbus_raw, t=None):
+        n = len(current_raw)
+        first = t if t is not None else self.start_time + self.nr_samples * self.interval
+        pos = 0
+        while pos < n:
+            if self.fill == 0:
+                self.chunk['time'] = first + pos * self.interval
+            k = min(n - pos, self.chunk_samples - self.fill)
+            self.samples[self.fill:self.fill + k, 0] = current_raw[pos:pos + k]
+            self.samples[self.fill:self.fill + k, 1] = vbus_raw[pos:pos + k]
+            self.fill += k
+            self.nr_samples += k
+            pos += k
+            if self.fill == self.chunk_samples:
+                self._flush_chunk()
+
+    def close(self):
+        if self.file.closed:
+            return
+        if self.fill:
+            self.samples[self.fill:] = 0
+            self._flush_chunk()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class CaptureReader:
+    def __init__(self, path):
+        self.path = path
+
+        header = np.fromfile(path, dtype=header_dtype, count=1)
+        assert len(header) == 1 and header['magic'][0] == CaptureMagic, f'{path} is not an INA226 capture'
+        assert header['version'][0] == CaptureVersion, f'Unsupported capture version {header["version"][0]}'
+        header = header[0]
+
+        self.config = int(header['config'])
+        self.calibration = int(header['calibration'])
+        self.currentLSB = float(header['currentLSB'])
+        self.interval = float(header['interval'])
+        self.start_time = float(header['start_time'])
+        self.chunk_samples = int(header['chunk_samples'])
+
+        dtype = chunk_dtype(self.chunk_samples)
+        offset = int(header['header_size'])
+        nr_chunks = (os.path.getsize(path) - offset) // dtype.itemsize
+
+        if nr_chunks:
+            self.chunks = np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=(nr_chunks,))
+        else:
+            self.chunks = np.zeros(0, dtype=dtype)
+
+        assert np.all(self.chunks['magic'] == ChunkMagic), f'{path}: corrupt chunk header'
+        assert np.all(self.chunks['index'] == np.arange(nr_chunks)), f'{path}: chunk index mismatch'
+
+        self.counts = self.chunks['count'].astype(np.int64)
+        self.offsets = np.concatenate(([0], np.cumsum(self.counts)))
+        self.nr_samples = int(self.offsets[-1])
+
+    def __len__(self):
+        return self.nr_samples
+
+    def _range(self, start, stop):
+        start, stop, _ = slice(start, stop).indices(self.nr_samples)
+        return start, max(start, stop)
+
+    def _locate(self, pos):
+        chunk = int(np.searchsorted(self.offsets, pos, side='right')) - 1
+        return chunk, pos - int(self.offsets[chunk])
+
+    def raw(self, start=0, stop=None):
+        start, stop = self._range(start, stop)
+        n = stop - start
+        if n == 0:
+            return np.empty(0, dtype=np.uint16), np.empty(0, dtype=np.uint16)
+
+        chunk, off = self._locate(start)
+        if off + n <= self.counts[chunk]:
+            samples = self.chunks['samples'][chunk]
+            return samples[off:off + n, 0], samples[off:off + n, 1]
+
+        out = np.empty((n, 2), dtype=np.uint16)
+        pos = 0
+        while pos < n:
+            k = min(n - pos, int(self.counts[chunk]) - off)
+            out[pos:pos + k] = self.chunks['samples'][chunk][off:off + k]
+            pos += k
+            chunk += 1
+            off = 0
+        return out[:, 0], out[:, 1]
+
+    def convert(self, current_raw, vbus_raw):
+        current = current_raw.view(np.int16) * self.currentLSB
+        vbus = vbus_raw * INA226.BusVoltageLSB
+        return current, vbus, current * vbus
+
+    def read(self, start=0, stop=None):
+        return self.convert(*self.raw(start, stop))
+
+    def times(self, start=0, stop=None):
+        start, stop = self._range(start, stop)
+        t = np.empty(stop - start, dtype=np.float64)
+        pos = start
+        while pos < stop:
+            chunk, off = self._locate(pos)
+            k = min(stop - pos, int(self.counts[chunk]) - off)
+            t[pos - start:pos - start + k] = self.chunks['time'][chunk] + (off + np.arange(k)) * self.interval
+            pos += k
+        return t
+
+    def blocks(self):
+        for chunk in range(len(self.chunks)):
+            samples = self.chunks['samples'][chunk][:self.counts[chunk]]
+            yield samples[:, 0], samples[:, 1]
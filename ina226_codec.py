@@ -0,0 +1,91 @@
+import struct
+import numpy as np
+
+# Delta encoding of a sample frame, per channel (current, then vbus):
+#   first value u16 | one width byte per block | bit-packed blocks
+# Each block holds BlockLen zigzagged 16-bit deltas of the same bit width,
+# packed LSB first. BlockLen * width bits is always whole bytes, so block
+# offsets follow from the widths alone and both sides vectorize.
+
+BlockLen = 32
+count = struct.Struct('<H')
+
+def zigzag(x):
+    d = np.diff(x.astype(np.uint16)).view(np.int16).astype(np.int32)
+    return ((d << 1) ^ (d >> 15)).astype(np.uint16)
+
+def unzigzag(zz):
+    zz = zz.astype(np.int32)
+    return ((zz >> 1) ^ -(zz & 1)).astype(np.int16)
+
+def _widths(blocks):
+    top = blocks.max(axis=1).astype(np.float64)
+    return np.where(top > 0, np.floor(np.log2(np.maximum(top, 1))) + 1, 0).astype(np.uint8)
+
+def _encode_channel(x):
+    zz = zigzag(x)
+    nr_blocks = -(-len(zz) // BlockLen)
+    blocks = np.zeros(nr_blocks * BlockLen, dtype=np.uint16)
+    blocks[:len(zz)] = zz
+    blocks = blocks.reshape(nr_blocks, BlockLen)
+
+    widths = _widths(blocks) if nr_blocks else np.empty(0, dtype=np.uint8)
+    sizes = widths.astype(np.int64) * BlockLen // 8
+    offsets = np.concatenate(([0], np.cumsum(sizes)))
+    data = np.empty(offsets[-1], dtype=np.uint8)
+
+    for w in np.unique(widths):
+        if w == 0:
+            continue
+        sel = np.flatnonzero(widths == w)
+        bits = (blocks[sel, :, None] >> np.arange(w, dtype=np.uint16)) & 1
+        packed = np.packbits(bits.astype(np.uint8).reshape(len(sel), -1), axis=1, bitorder='little')
+        data[offsets[sel][:, None] + np.arange(packed.shape[1])] = packed
+
+    first = int(x[0]) if len(x) else 0
+    return b''.join((count.pack(first), widths.tobytes(), data.tobytes()))
+
+def _decode_channel(buf, pos, nr_pairs):
+    first, = count.unpack_from(buf, pos)
+    pos += count.size
+    if nr_pairs == 0:
+        return np.empty(0, dtype=np.uint16), pos
+
+    nr_blocks = -(-(nr_pairs - 1) // BlockLen)
+    widths = np.frombuffer(buf, dtype=np.uint8, count=nr_blocks, offset=pos)
+    pos += nr_blocks
+
+    sizes = widths.astype(np.int64) * BlockLen // 8
+    offsets = np.concatenate(([0], np.cumsum(sizes)))
+    data = np.frombuffer(buf, dtype=np.uint8, count=int(offsets[-1]), offset=pos)
+    pos += int(offsets[-1])
+
+    zz = np.zeros((nr_blocks, BlockLen), dtype=np.uint16)
+    for w in np.unique(widths):
+        if w == 0:
+            continue
+        sel = np.flatnonzero(widths == w)
+        packed = data[offsets[sel][:, None] + np.arange(BlockLen * int(w) // 8)]
+        bits = np.unpackbits(packed, axis=1, bitorder='little').reshape(len(sel), BlockLen, w)
+        zz[sel] = bits.astype(np.uint16) @ (np.uint16(1) << np.arange(w, dtype=np.uint16))
+
+    x = np.empty(nr_pairs, dtype=np.uint16)
+    x[0] = first
+    np.cumsum(unzigzag(zz.reshape(-1)[:nr_pairs - 1]).view(np.uint16), dtype=np.uint16, out=x[1:])
+    x[1:] += np.uint16(first)
+    return x, pos
+
+def encode_delta(current, vbus):
+    return b''.join((count.pack(len(current)), _encode_channel(current), _encode_channel(vbus)))
+
+def decode_delta(buf, offset=0):
+    nr_pairs, = count.unpack_from(buf, offset)
+    current, pos = _decode_channel(buf, offset + count.size, nr_pairs)
+    vbus, _ = _decode_channel(buf, pos, nr_pairs)
+    return current, vbus
+
+def interleave(current, vbus):
+    pkt = np.empty(2 * len(current), dtype='<u2')
+    pkt[0::2] = current
+    pkt[1::2] = vbus
+    return pkt
@@ -1,21 +1,42 @@
+import time
+import numpy as np
 from pyftdi.i2c import I2cPort
 
+from ina226 import INA226
 from ina226_if import INA226_If
 from ina226_regs import *
+from ina226_trace import tracer
+
+CVRF = 1 << 3
 
 class INA226_I2C_If(INA226_If):
+    endianess: str = 'big'
     port: I2cPort = None
+    BatchTime = 0.05
+    PollTimeout = 1.0
+    # Every sample waits for its conversion, reading samples measures the chip, not the link
+    PollsConversions = True
 
     def __init__(self, port: I2cPort):
         self.port = port
+        self.config = None
+        self.conv_interval = None
+        self.next_ready = None
+        self.nr_polls = 0
+        # Flags seen in any MaskEnable read, the read that shows them also clears them
+        self.ready_flag = False
+        self.alert_flag = False
 
     def __readReg(self, addr, nrBytes = 2):
-        self.port.write([addr])
-        bytes = self.port.read(nrBytes)
-        return bytes
+        # Pointer write and read in one transaction with a repeated start
+        return self.port.exchange([addr], nrBytes)
 
     def readReg16(self, addr: int):
-        return int.from_bytes(self.__readReg(addr, nrBytes=2), self.endianess)
+        val = int.from_bytes(self.__readReg(addr, nrBytes=2), self.endianess)
+        if addr == INA226_Regs.MaskEnable:
+            self.ready_flag |= bool(val & CVRF)
+            self.alert_flag |= bool(val & MaskEnable_Bits.AlertFunctionFlag)
+        return val
 
     def __writeReg(self, addr, val):
         buf = [addr]
@@ -32,10 +53,83 @@ class INA226_I2C_If(INA226_If):
 
         self.__writeReg(addr, buf)
 
+        if addr == INA226_Regs.Config:
+            # Writing Config restarts the conversion
+            self.ready_flag = False
+            self.setConfig(val)
+
+    def setConfig(self, config):
+        self.config = config
+        vshct = (config >> 3) & 0b111
+        vbusct = (config >> 6) & 0b111
+        avg = (config >> 9) & 0b111
+        self.conv_interval = (INA226.map_conv_time[vshct] + INA226.map_conv_time[vbusct]) * INA226.map_avg[avg] / 1000
+        self.next_ready = time.perf_counter() + self.conv_interval
+
+    def triggered(self):
+        return self.config is not None and not self.config & 0b100
+
     def readCurrent(self):
         raw = self.readReg16(INA226_Regs.Current)
         return raw
 
     def readVbus(self):
         raw = self.readReg16(INA226_Regs.BusVoltage)
-        return raw
\ No newline at end of file
+        return raw
+
+    def waitReady(self):
+        if self.config is None:
+            self.setConfig(self.readReg16(INA226_Regs.Config))
+
+        # Sleep through the conversion instead of burning USB transactions on it
+        wait = self.next_ready - time.perf_counter()
+        if wait > 0:
+            time.sleep(wait)
+
+        deadline = time.perf_counter() + max(self.PollTimeout, 2 * self.conv_interval)
+        polls = 0
+        while True:
+            polls += 1
+            self.readReg16(INA226_Regs.MaskEnable)
+            if self.ready_flag:
+                self.ready_flag = False
+                break
+            if time.perf_counter() > deadline:
+                raise TimeoutError('Conversion ready flag not set')
+            time.sleep(min(self.conv_interval / 16, 1e-3))
+        self.nr_polls += polls
+
+        now = time.perf_counter()
+        if polls > 1:
+            # Caught the flag rising, lock onto the conversion phase
+            self.next_ready = now + self.conv_interval
+        else:
+            # Keep the cadence so read overhead doesn't pile up into skipped
+            # conversions, aim slightly early to notice the chip running fast
+            self.next_ready = max(self.next_ready + 0.99 * self.conv_interval, now)
+        return now
+
+    def readBatchTimed(self, n=None):
+        if n is None:
+            if self.conv_interval is None:
+                self.setConfig(self.readReg16(INA226_Regs.Config))
+            n = max(int(self.BatchTime / self.conv_interval), 1)
+
+        current = np.empty(n, dtype=np.uint16)
+        vbus = np.empty(n, dtype=np.uint16)
+        t = np.empty(n)
+        offset = time.time() - time.perf_counter()
+        for i in range(n):
+            t[i] = self.waitReady() + offset
+            start = tracer.enabled and time.perf_counter_ns()
+            current[i] = self.readReg16(INA226_Regs.Current)
+            vbus[i] = self.readReg16(INA226_Regs.BusVoltage)
+            if self.triggered():
+                self.writeReg16(INA226_Regs.Config, self.config)
+            if start: tracer.record('i2c.read_sample', start)
+
+        return current, vbus, t
+
+    def readBatch(self, n=None):
+        current, vbus, _ = self.readBatchTimed(n)
+        return current, vbus
@@ -1,3 +1,5 @@
+import time
+import numpy as np
 
 
 class INA226_ll:
@@ -10,9 +12,32 @@ class INA226_ll:
     def recvBytes(self):
         raise NotImplemented()
 
+    def recvInto(self, buf):
+        out = memoryview(buf).cast('B')
+        out[:] = self.recvBytes(len(out))
+        return len(out)
+
     def terminate(self):
         raise NotImplemented()
 
+class INA226_llAsync:
+    def __init__(self):
+        raise NotImplemented()
+
+    async def send(self, data):
+        raise NotImplemented()
+
+    async def recvInto(self, buf):
+        raise NotImplemented()
+
+    async def recv(self, nr_bytes):
+        buf = bytearray(nr_bytes)
+        await self.recvInto(buf)
+        return bytes(buf)
+
+    async def terminate(self):
+        raise NotImplemented()
+
 class INA226_If:
     def __init__(self):
         raise NotImplemented()
@@ -29,6 +54,47 @@ class INA226_If:
     def readVbus(self):
         raise NotImplemented()
 
+    def transact(self, ops):
+        # ops are (addr, None) reads and (addr, value) writes, done in order
+        results = []
+        for addr, val in ops:
+            if val is None:
+                results.append(self.readReg16(addr))
+            else:
+                self.writeReg16(addr, val)
+                results.append(val)
+        return results
+
+    def readBatch(self, n=None):
+        n = n if n else 1
+        current = np.empty(n, dtype=np.uint16)
+        vbus = np.empty(n, dtype=np.uint16)
+        for i in range(n):
+            current[i] = self.readCurrent()
+            vbus[i] = self.readVbus()
+        return current, vbus
+
+    def readBatchTimed(self, n=None):
+        n = n if n else 1
+        current = np.empty(n, dtype=np.uint16)
+        vbus = np.empty(n, dtype=np.uint16)
+        t = np.empty(n)
+        for i in range(n):
+            current[i] = self.readCurrent()
+            vbus[i] = self.readVbus()
+            t[i] = time.time()
+        return current, vbus, t
+
+    def setInterval(self, interval):
+        pass
+
+    def setNrSamples(self, nr_samples):
+        pass
+
+    def flush(self):
+        # Drop samples buffered before a configuration change
+        pass
+
     def terminate(self):
         raise NotImplemented()
 
@@ -0,0 +1,165 @@
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+
+from ina226 import INA226
+
+class RailBuffer:
+    GapFactor = 3
+
+    def __init__(self, name, ina226: INA226):
+        self.name = name
+        self.ina226 = ina226
+        self.blocks = []
+        self.t = np.empty(0)
+        self.values = np.empty((3, 0))
+        self.nr_samples = 0
+
+    def append(self, t, current, vbus, power):
+        self.blocks.append((t, np.vstack((current, vbus, power))))
+        self.nr_samples += len(t)
+
+    def merge(self):
+        if self.blocks:
+            self.t = np.concatenate([self.t] + [b[0] for b in self.blocks])
+            self.values = np.concatenate([self.values] + [b[1] for b in self.blocks], axis=1)
+            self.blocks = []
+
+    def first(self):
+        return self.t[0] if len(self.t) else None
+
+    def last(self):
+        return self.t[-1] if len(self.t) else None
+
+    def max_gap(self):
+        # Neighbouring samples further apart than this have a hole between them
+        spacing = self.ina226.interval or 0.0
+        if len(self.t) > 1:
+            spacing = max(spacing, float(np.median(np.diff(self.t))))
+        return RailBuffer.GapFactor * spacing
+
+    def trim(self, t):
+        # Keep one sample at or before t so the next grid point can still be interpolated
+        keep = max(int(np.searchsorted(self.t, t, side='right')) - 1, 0)
+        self.t = self.t[keep:]
+        self.values = self.values[:, keep:]
+
+class INA226_Multi:
+    # Samples per rail a shared bus group collects before handing them over
+    PassesPerBlock = 64
+
+    def __init__(self, period=None, nr_samples=None):
+        self.period = period
+        self.nr_samples = nr_samples
+        self.rails = OrderedDict()
+        self.groups = OrderedDict()
+
+        self.cond = threading.Condition()
+        self.threads = []
+        self.stop_event = threading.Event()
+        self.errors = {}
+        self.next_t = None
+
+    def add_rail(self, name, ina226: INA226, group=None):
+        assert name not in self.rails, f'Rail {name} already added'
+        self.rails[name] = RailBuffer(name, ina226)
+        self.groups.setdefault(group if group is not None else name, []).append(name)
+
+    def _round_robin(self, rails):
+        # Rails on one bus take turns per conversion, one sample each per pass,
+        # so none of them sits out while the others read a whole batch
+        blocks = [[] for _ in rails]
+        for _ in range(self.nr_samples or self.PassesPerBlock):
+            for rail, block in zip(rails, blocks):
+                block.append(rail.ina226.read_batch_timed(1))
+        return [tuple(np.concatenate(x) for x in zip(*block)) for block in blocks]
+
+    def _acquire(self, group, names):
+        rails = [self.rails[name] for name in names]
+        try:
+            while not self.stop_event.is_set():
+                if len(rails) == 1:
+                    blocks = [rails[0].ina226.read_batch_timed(self.nr_samples)]
+                else:
+                    blocks = self._round_robin(rails)
+                with self.cond:
+                    for rail, block in zip(rails, blocks):
+                        rail.append(*block)
+                    self.cond.notify_all()
+        except Exception as e:
+            self.errors[group] = e
+            with self.cond:
+                self.cond.notify_all()
+
+    def start(self):
+        if self.period is None:
+            self.period = min(r.ina226.interval for r in self.rails.values())
+
+        self.stop_event.clear()
+        for group, names in self.groups.items():
+            thread = threading.Thread(target=self._acquire, args=(group, names), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        self.stop_event.set()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def terminate(self):
+        self.stop_event.set()
+        for rail in self.rails.values():
+            rail.ina226.terminate()
+        for thread in self.threads:
+            thread.join(timeout=1)
+        self.threads = []
+
+    def _aligned(self):
+        for rail in self.rails.values():
+            rail.merge()
+            if rail.last() is None:
+                return None
+
+        if self.next_t is None:
+            self.next_t = max(rail.first() for rail in self.rails.values())
+        horizon = min(rail.last() for rail in self.rails.values())
+        if horizon < self.next_t:
+            return None
+
+        nr_points = int((horizon - self.next_t) / self.period) + 1
+        t = self.next_t + self.period * np.arange(nr_points)
+        self.next_t = t[-1] + self.period
+
+        # Interpolate only between neighbouring samples of a rail, grid points
+        # falling into a hole (link stall, lost packet) come out as NaN
+        rails = OrderedDict()
+        for name, rail in self.rails.items():
+            values = np.array([np.interp(t, rail.t, v) for v in rail.values])
+            if len(rail.t) > 1:
+                idx = np.clip(np.searchsorted(rail.t, t, side='right'), 1, len(rail.t) - 1)
+                hole = (rail.t[idx] - rail.t[idx - 1] > rail.max_gap()) & (t != rail.t[idx - 1])
+                values[:, hole] = np.nan
+            rails[name] = tuple(values)
+            rail.trim(t[-1])
+        return t, rails
+
+    def read(self, timeout=None):
+        deadline = time.time() + timeout if timeout is not None else None
+        with self.cond:
+            while True:
+                if self.errors:
+                    group, e = next(iter(self.errors.items()))
+                    raise RuntimeError(f'Acquisition of {group} failed') from e
+                block = self._aligned()
+                if block:
+                    return block
+                wait = deadline - time.time() if deadline is not None else None
+                if wait is not None and wait <= 0:
+                    return None
+                self.cond.wait(wait)
+
+    def blocks(self):
+        while True:
+            yield self.read()
@@ -0,0 +1,244 @@
+import json
+import socket
+import threading
+from collections import deque
+
+import numpy as np
+
+from ina226_regs import *
+from ina226_if import INA226_If
+import ina226_metrics as metrics
+import ina226_proto as proto
+from ina226_proto import FrameType, FrameReader
+
+# Sample blocks go out as protocol v2 frames over TCP: a Meta frame with JSON
+# metadata on connect, then TimedSamples frames. Every block is encoded once
+# and queued per client; a client that falls behind loses its oldest queued
+# blocks instead of holding up acquisition, and sees the gap in the sample index.
+
+MaxBlock = 4096
+MaxPayload = proto.timed_samples_header.size + 12 * MaxBlock
+
+def encode_block(index, t, current_raw, vbus_raw):
+    return b''.join((proto.timed_samples_header.pack(index, len(t)),
+                     np.asarray(t, dtype='<f8').tobytes(),
+                     np.asarray(current_raw, dtype='<u2').tobytes(),
+                     np.asarray(vbus_raw, dtype='<u2').tobytes()))
+
+def decode_block(payload):
+    index, n = proto.timed_samples_header.unpack_from(payload)
+    pos = proto.timed_samples_header.size
+    t = np.frombuffer(payload, dtype='<f8', count=n, offset=pos)
+    current = np.frombuffer(payload, dtype='<u2', count=n, offset=pos + 8 * n)
+    vbus = np.frombuffer(payload, dtype='<u2', count=n, offset=pos + 10 * n)
+    return index, t, current, vbus
+
+class ClientQueue:
+    def __init__(self, sock, addr, queue_len):
+        self.sock = sock
+        self.addr = f'{addr[0]}:{addr[1]}'
+        self.queue = deque()
+        self.queue_len = queue_len
+        self.cond = threading.Condition()
+        self.closed = False
+
+        labels = {'client': self.addr}
+        self.m_sent = metrics.counter('ina226_net_sent_blocks_total', 'Sample blocks sent to a client', labels)
+        self.m_dropped = metrics.counter('ina226_net_dropped_blocks_total', 'Blocks dropped for a slow client', labels)
+        self.m_queue = metrics.gauge('ina226_net_queue_blocks', 'Blocks queued for a client', labels)
+
+    def offer(self, frame):
+        with self.cond:
+            if len(self.queue) >= self.queue_len:
+                self.queue.popleft()
+                self.m_dropped.inc()
+            self.queue.append(frame)
+            self.m_queue.set(len(self.queue))
+            self.cond.notify()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+
+    def send_loop(self):
+        try:
+            while True:
+                with self.cond:
+                    while not self.queue and not self.closed:
+                        self.cond.wait()
+                    if self.closed:
+                        break
+                    frame = self.queue.popleft()
+                self.sock.sendall(frame)
+                self.m_sent.inc()
+        except OSError:
+            pass
+        finally:
+            self.closed = True
+            self.sock.close()
+
+class SampleServer:
+    def __init__(self, port=0, host='127.0.0.1', meta=None, queue_len=256):
+        self.meta = meta or {}
+        self.queue_len = queue_len
+        self.clients = []
+        self.lock = threading.Lock()
+        self.tx_seq = 0
+        self.index = 0
+        self.m_clients = metrics.gauge('ina226_net_clients', 'Connected stream clients')
+
+        self.sock = socket.create_server((host, port))
+        self.port = self.sock.getsockname()[1]
+        self.thread = threading.Thread(target=self._accept_loop, daemon=True)
+        self.thread.start()
+
+    def _frame(self, ftype, payload):
+        frame = proto.encode_frame(ftype, self.tx_seq, payload)
+        self.tx_seq = (self.tx_seq + 1) & 0xffff
+        return frame
+
+    def _accept_loop(self):
+        while True:
+            try:
+                sock, addr = self.sock.accept()
+            except OSError:
+                break
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            client = ClientQueue(sock, addr, self.queue_len)
+            with self.lock:
+                # Meta goes to this client only, it takes the sequence number just
+                # before the next stream frame instead of using one up for everybody
+                seq = (self.tx_seq - 1) & 0xffff
+                client.offer(proto.encode_frame(FrameType.Meta, seq, json.dumps(self.meta).encode()))
+                self.clients.append(client)
+                self.m_clients.set(len(self.clients))
+            threading.Thread(target=client.send_loop, daemon=True).start()
+            print(f'Stream client {client.addr} connected')
+
+    def set_meta(self, **meta):
+        self.meta.update(meta)
+
+    def publish(self, t, current_raw, vbus_raw):
+        with self.lock:
+            self.clients = [c for c in self.clients if not c.closed]
+            self.m_clients.set(len(self.clients))
+            for pos in range(0, len(t), MaxBlock):
+                n = min(len(t) - pos, MaxBlock)
+                payload = encode_block(self.index, t[pos:pos + n], current_raw[pos:pos + n], vbus_raw[pos:pos + n])
+                self.index += n
+                if not self.clients:
+                    continue
+                frame = self._frame(FrameType.TimedSamples, payload)
+                for client in self.clients:
+                    client.offer(frame)
+
+    def close(self):
+        self.sock.close()
+        with self.lock:
+            for client in self.clients:
+                client.close()
+            self.clients = []
+
+class INA226_Net(INA226_If):
+    def __init__(self, host, port, timeout=5.0):
+        # timeout covers connecting and the metadata, then a block may take
+        # up to MaxBlock sample intervals to fill on the server
+        self.sock = socket.create_connection((host, port), timeout=timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.reader = FrameReader(self._recv, MaxPayload)
+
+        frame = self.reader.read_frame()
+        assert frame.type == FrameType.Meta, f'Expected stream metadata, got frame type {frame.type}'
+        self.meta = json.loads(frame.payload)
+        self.interval = self.meta.get('interval')
+        self.currentLSB = self.meta.get('currentLSB')
+        self.sock.settimeout(timeout + self.interval * MaxBlock if self.interval else None)
+
+        self.next_index = None
+        self.dropped_samples = 0
+        self.current_buf = np.empty(0, dtype=np.uint16)
+        self.vbus_buf = np.empty(0, dtype=np.uint16)
+        self.time_buf = np.empty(0)
+        self.current_idx = 0
+        self.vbus_idx = 0
+
+        # Clients only see the server's registers, writes stay local
+        self.regs = {
+            INA226_Regs.Config: self.meta.get('config', 0),
+            INA226_Regs.Calibration: self.meta.get('calibration', 0),
+            INA226_Regs.MaskEnable: 0,
+            INA226_Regs.AlertLimit: 0,
+            INA226_Regs.ManId: 0x5449,
+            INA226_Regs.DieId: 0x2260,
+        }
+
+    def _recv(self, nr_bytes):
+        # At least nr_bytes, the frame reader keeps whatever comes on top
+        data = bytearray()
+        while len(data) < nr_bytes:
+            chunk = self.sock.recv(max(nr_bytes - len(data), 65536))
+            if not chunk:
+                raise EOFError('Stream server closed the connection')
+            data += chunk
+        return data
+
+    def readReg16(self, addr: int):
+        return self.regs.get(addr, 0)
+
+    def writeReg16(self, addr: int, val: int):
+        self.regs[addr] = val
+
+    def _read_block(self):
+        while True:
+            frame = self.reader.read_frame()
+            if frame.type == FrameType.TimedSamples:
+                break
+            if frame.type == FrameType.Meta:
+                self.meta.update(json.loads(frame.payload))
+
+        index, t, current, vbus = decode_block(frame.payload)
+        if self.next_index is not None and index != self.next_index:
+            self.dropped_samples += index - self.next_index
+        self.next_index = index + len(t)
+        return current, vbus, t
+
+    def readBatchTimed(self, n=None):
+        # One server block per call, n is up to the server. Whatever
+        # readCurrent/readVbus left of the last block comes first.
+        start = min(self.current_idx, self.vbus_idx)
+        if start < len(self.current_buf):
+            self.current_idx = self.vbus_idx = len(self.current_buf)
+            return self.current_buf[start:], self.vbus_buf[start:], self.time_buf[start:]
+        return self._read_block()
+
+    def readBatch(self, n=None):
+        current, vbus, _ = self.readBatchTimed(n)
+        return current, vbus
+
+    def _next_block(self):
+        if self.current_idx < len(self.current_buf) or self.vbus_idx < len(self.vbus_buf):
+            print('Packets were not empty !')
+        self.current_buf, self.vbus_buf, self.time_buf = self._read_block()
+        self.current_idx = 0
+        self.vbus_idx = 0
+
+    def readCurrent(self):
+        if self.current_idx == len(self.current_buf):
+            self._next_block()
+
+        raw = self.current_buf[self.current_idx]
+        self.current_idx += 1
+        return int(raw)
+
+    def readVbus(self):
+        if self.vbus_idx == len(self.vbus_buf):
+            self._next_block()
+
+        raw = self.vbus_buf[self.vbus_idx]
+        self.vbus_idx += 1
+        return int(raw)
+
+    def terminate(self):
+        print(f'Stream client dropped {self.dropped_samples} samples, {self.reader.stats()}')
+        self.sock.close()
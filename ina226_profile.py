@@ -0,0 +1,81 @@
+from dataclasses import dataclass
+from functools import cached_property
+
+from ina226 import INA226
+from ina226_regs import *
+
+# Named measurement setups. A profile states what the capture needs, the
+# sample rate and the current range and resolution; Config and Calibration
+# follow from it. INA226.apply_profile only writes what differs from the
+# registers the device already holds.
+
+@dataclass
+class Profile:
+    name: str
+    # Samples per second the capture needs, the bandwidth
+    sample_rate: float
+    max_current: float = 0.1
+    rshunt: float = 1.0
+    # A per LSB, None for the finest the current range allows
+    resolution: float = None
+    mode: int = MODE_Setting.ShuntAndBusVoltageCont
+
+    def settings(self):
+        # Most integration time that still keeps up with sample_rate: the most
+        # averaging, then the longest shunt conversion for the least current noise.
+        # None if even the fastest setting is too slow.
+        max_interval = 1 / self.sample_rate
+        best = None
+        for vshct, shunt_time in INA226.map_conv_time.items():
+            for vbusct, bus_time in INA226.map_conv_time.items():
+                for avg, nr_avg in INA226.map_avg.items():
+                    config = self.mode | (vshct << 3) | (vbusct << 6) | (avg << 9)
+                    interval = INA226.config_interval(config)
+                    if interval > max_interval:
+                        continue
+                    key = (nr_avg, shunt_time, -interval)
+                    if best is None or key > best[0]:
+                        best = (key, vshct, vbusct, avg)
+
+        return best[1:] if best else None
+
+    @cached_property
+    def _registers(self):
+        settings = self.settings()
+        if settings is None:
+            print(f'Profile {self.name}: {self.sample_rate} samples/s is beyond the INA226, using the fastest setting')
+            settings = (VSHCT_Setting.ConversionTime_140us, VBUSCT_Setting.ConversionTime_140us,
+                        AVG_Setting.NrAverages_1)
+        vshct, vbusct, avg = settings
+        config = self.mode | (vshct << 3) | (vbusct << 6) | (avg << 9)
+
+        currentLSB = self.max_current / (2**15)
+        if self.resolution is not None:
+            currentLSB = max(currentLSB, self.resolution)
+        cal = int(0.00512 / (currentLSB * self.rshunt))
+        assert 0 < cal <= 0x7fff, f'Profile {self.name}: calibration {cal} out of range'
+        return config, cal, currentLSB
+
+    def registers(self):
+        # (config, calibration, currentLSB), worked out once per profile
+        return self._registers
+
+    def describe(self):
+        config, cal, currentLSB = self.registers()
+        vshct, vbusct, avg = (config >> 3) & 0b111, (config >> 6) & 0b111, (config >> 9) & 0b111
+        return (f'{self.name}: VSHCT {INA226.map_conv_time[vshct]} ms, VBUSCT {INA226.map_conv_time[vbusct]} ms, '
+                f'AVG {INA226.map_avg[avg]}, {1 / INA226.config_interval(config):.1f} samples/s, '
+                f'{currentLSB * 1e6:.3f} uA/LSB, config {config:#06x}, calibration {cal:#06x}')
+
+profiles = {p.name: p for p in (
+    # Shortest conversions, catches sub-millisecond load steps
+    Profile('fast-transient', sample_rate=3500),
+    # Moderate averaging at a rate every link keeps up with
+    Profile('balanced', sample_rate=400),
+    # Heavy averaging for long unattended runs at low currents
+    Profile('low-noise-soak', sample_rate=2, max_current=0.01),
+)}
+
+def get_profile(name):
+    assert name in profiles, f'Unknown profile {name}, one of {", ".join(profiles)}'
+    return profiles[name]
@@ -0,0 +1,138 @@
+import binascii
+import struct
+from collections import namedtuple
+from enum import IntEnum
+
+import ina226_metrics as metrics
+
+# Protocol v2 frame, all fields little-endian:
+#   sync 0xa5 0x5a | type u8 | flags u8 | seq u16 | length u16 | payload | crc16
+# crc16 is CRC-CCITT (binascii.crc_hqx, init 0xffff) over header and payload.
+# Each direction numbers its frames with its own wrapping sequence counter.
+
+Version = 2
+Sync = b'\xa5\x5a'
+header = struct.Struct('<2sBBHH')
+HeaderLen = header.size
+CrcLen = 2
+MaxPayload = 8192
+
+class FrameType(IntEnum):
+    Regs = 0x01
+    SetAddress = 0x02
+    Info = 0x03
+    Meta = 0x04
+    SampleRequest = 0x10
+    StreamStart = 0x11
+    StreamStop = 0x12
+    Samples = 0x20
+    TimedSamples = 0x21
+
+class SampleFormat(IntEnum):
+    Raw16 = 0
+    Delta = 1
+
+FormatMask = 0x0f
+FlagOverflow = 0x10
+
+class RegOp(IntEnum):
+    Read = 0
+    Write = 1
+
+RegError = 0x80
+
+reg_entry = struct.Struct('<BBH')
+info = struct.Struct('<BHH')
+sample_request = struct.Struct('<HB')
+samples_header = struct.Struct('<I')
+# Network stream: first sample index, count, then t f8[count] | current u2[count] | vbus u2[count]
+timed_samples_header = struct.Struct('<QI')
+
+Frame = namedtuple('Frame', ['type', 'flags', 'seq', 'payload'])
+
+def crc16(data, crc=0xffff):
+    return binascii.crc_hqx(data, crc)
+
+def encode_frame(ftype, seq, payload=b'', flags=0):
+    head = header.pack(Sync, ftype, flags, seq & 0xffff, len(payload))
+    crc = crc16(payload, crc16(head))
+    return b''.join((head, payload, crc.to_bytes(CrcLen, 'little')))
+
+def encode_regs(ops):
+    return b''.join(reg_entry.pack(op, addr, val & 0xffff) for op, addr, val in ops)
+
+def decode_regs(payload):
+    return list(reg_entry.iter_unpack(payload))
+
+class FrameReader:
+    def __init__(self, recv, max_payload=MaxPayload):
+        self.recv = recv
+        self.max_payload = max_payload
+        self.buf = bytearray()
+        self.expected_seq = None
+
+        self.frames = 0
+        self.crc_errors = 0
+        self.resync_bytes = 0
+        self.lost_frames = 0
+
+        self.m_crc_errors = metrics.counter('ina226_frame_crc_errors_total', 'Frames failing the CRC check')
+        self.m_resync_bytes = metrics.counter('ina226_resync_bytes_total', 'Bytes skipped to find the next frame')
+        self.m_lost_frames = metrics.counter('ina226_lost_frames_total', 'Frames missing from the sequence')
+
+    def _fill(self, nr_bytes):
+        if len(self.buf) < nr_bytes:
+            self.buf += self.recv(nr_bytes - len(self.buf))
+
+    def _skip(self, nr_bytes):
+        del self.buf[:nr_bytes]
+        self.resync_bytes += nr_bytes
+        self.m_resync_bytes.inc(nr_bytes)
+
+    def read_frame(self):
+        while True:
+            self._fill(HeaderLen)
+
+            pos = self.buf.find(Sync)
+            if pos < 0:
+                # A trailing first sync byte may still start a frame
+                pos = len(self.buf) - 1 if self.buf[-1] == Sync[0] else len(self.buf)
+            if pos:
+                self._skip(pos)
+                continue
+
+            _, ftype, flags, seq, length = header.unpack_from(self.buf)
+            if length > self.max_payload:
+                self._skip(1)
+                continue
+
+            end = HeaderLen + length
+            self._fill(end + CrcLen)
+            with memoryview(self.buf) as view:
+                crc = crc16(view[:end])
+            if crc != int.from_bytes(self.buf[end:end + CrcLen], 'little'):
+                # Corrupt or a false sync inside data, rescan from the next byte
+                self.crc_errors += 1
+                self.m_crc_errors.inc()
+                self._skip(1)
+                continue
+
+            payload = bytes(self.buf[HeaderLen:end])
+            del self.buf[:end + CrcLen]
+
+            if self.expected_seq is not None and seq != self.expected_seq:
+                lost = (seq - self.expected_seq) & 0xffff
+                self.lost_frames += lost
+                self.m_lost_frames.inc(lost)
+            self.expected_seq = (seq + 1) & 0xffff
+            self.frames += 1
+
+            return Frame(ftype, flags, seq, payload)
+
+    def stats(self):
+        return {
+            'frames': self.frames,
+            'crc_errors': self.crc_errors,
+            'resync_bytes': self.resync_bytes,
+            'lost_frames': self.lost_frames,
+        }
@@ -56,3 +56,17 @@ class MODE_Setting:
     ShuntVoltageCont: int = 0b101
     BusVoltageCont: int = 0b110
     ShuntAndBusVoltageCont: int = 0b111
+
+@dataclass
+class MaskEnable_Bits:
+    ShuntOverVoltage: int = 1 << 15
+    ShuntUnderVoltage: int = 1 << 14
+    BusOverVoltage: int = 1 << 13
+    BusUnderVoltage: int = 1 << 12
+    PowerOverLimit: int = 1 << 11
+    ConversionReady: int = 1 << 10
+    AlertFunctionFlag: int = 1 << 4
+    ConversionReadyFlag: int = 1 << 3
+    MathOverflowFlag: int = 1 << 2
+    AlertPolarity: int = 1 << 1
+    AlertLatchEnable: int = 1 << 0
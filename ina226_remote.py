@@ -1,40 +1,194 @@
+import contextlib
+import queue
+import threading
+import time
 from collections import deque
 import numpy as np
 from enum import IntEnum
 
 from ina226_regs import *
-from ina226_if import INA226_If, INA226_ll
+from ina226_if import INA226_If, INA226_ll, INA226_llAsync
+from ina226_timestamp import SampleClock
+import ina226_proto as proto
+from ina226_proto import FrameType, FrameReader, SampleFormat
+from ina226_codec import decode_delta, interleave
+import ina226_metrics as metrics
+from ina226_trace import tracer
 
 class OpCodes(IntEnum):
     ReadReg = 0xfff0
     WriteReg = 0xfff1
     Seti2cAddress = 0xfff2
     GetBufferLen = 0xfff3
+    SetProtocol = 0xfff4
 
 class INA226_Remote(INA226_If):
     byteorder = 'little'
     MaxPktLen = 2048
+    RegTimeout = 2.0
 
-    def __init__(self, i2c_address, nr_samples, ina226_ll: INA226_ll):
+    def __init__(self, i2c_address, nr_samples, ina226_ll: INA226_ll, pipeline_depth=1, protocol=1,
+                 sample_format=SampleFormat.Raw16):
         self.ll = ina226_ll
+        self.pipelineDepth = max(1, pipeline_depth)
+        self.pkt_req_inflight = 0
+        self.pkt_pending = deque()
+        self.stream_thread = None
+
+        # v1 firmware reads any unknown opcode as a packet length, so v2 is opt-in
+        self.protocol = protocol
+        self.tx_seq = 0
+        self.next_index = None
+        self.dropped_samples = 0
+        self.overflows = 0
+        self.sample_format = SampleFormat.Raw16
+        self.req_times = deque()
+
+        labels = {'addr': hex(i2c_address)}
+        self.m_packets = metrics.counter('ina226_packets_total', 'Sample packets received', labels)
+        self.m_samples = metrics.counter('ina226_samples_total', 'Current/vbus sample pairs received', labels)
+        self.m_dropped = metrics.counter('ina226_dropped_samples_total', 'Samples lost between bridge and host', labels)
+        self.m_overflows = metrics.counter('ina226_overflows_total', 'Frames flagged by the bridge after dropping data', labels)
+        self.m_latency = metrics.histogram('ina226_packet_latency_seconds', 'Sample request to packet arrival', labels)
+        self.m_wait = metrics.histogram('ina226_packet_wait_seconds', 'Time read_packet blocked for a packet', labels)
+        self.m_rtt = metrics.histogram('ina226_link_rtt_seconds', 'Register transaction round trip', labels)
+        self.m_queue = metrics.gauge('ina226_stream_queue_packets', 'Packets waiting in the stream queue', labels)
+
+        if protocol == 2:
+            self._setProtocol(proto.Version)
 
         self._seti2cAddress(i2c_address)
         self.MaxPktLen = self._getMaxPktLen()
+
+        if sample_format != SampleFormat.Raw16:
+            assert protocol == 2, 'Sample encodings need protocol 2'
+            if self.formats & (1 << sample_format):
+                self.sample_format = sample_format
+            else:
+                print(f'Bridge doesn\'t support {SampleFormat(sample_format).name} samples, using raw')
         self.nrSamples = self.MaxPktLen if nr_samples > self.MaxPktLen else nr_samples
 
         print(f'max packet length = {self.MaxPktLen}')
 
-        self.current_buf = deque(maxlen=self.MaxPktLen//2)
-        self.vbus_buf = deque(maxlen=self.MaxPktLen//2)
+        self.current_buf = np.empty(0, dtype=np.uint16)
+        self.vbus_buf = np.empty(0, dtype=np.uint16)
+        self.time_buf = np.empty(0)
+        self.current_idx = 0
+        self.vbus_idx = 0
         self.nr_packets = 0
-        self.pkt_req_sent = False
+        self.clock = SampleClock()
+
+    def setInterval(self, interval):
+        self.clock.reset(interval)
+
+    def setNrSamples(self, nr_samples):
+        # Requests already in flight were sized for the old length, a stream
+        # restarts with the new one
+        with self._exclusive():
+            self.nrSamples = self.MaxPktLen if nr_samples > self.MaxPktLen else nr_samples
+
+    def flush(self):
+        # Packets taken under the old configuration, including those in flight
+        with self._exclusive():
+            self.pkt_pending.clear()
+        self.current_buf = np.empty(0, dtype=np.uint16)
+        self.vbus_buf = np.empty(0, dtype=np.uint16)
+        self.time_buf = np.empty(0)
+        self.current_idx = 0
+        self.vbus_idx = 0
+
+    @contextlib.contextmanager
+    def _exclusive(self):
+        # v1 can't tell register replies from sample data, so a running stream
+        # stops around register traffic and starts again after, the packets
+        # it had in flight stay pending for read_packet
+        paused = self.stream_thread is not None
+        if paused:
+            self.stop_stream()
+        self._drain()
+        try:
+            yield
+        finally:
+            if paused:
+                self.start_stream(self.stream_queue_len)
 
     def checkAck(self):
         ack = self.ll.recvBytes(1)
         ack = int.from_bytes(bytes=ack, byteorder=self.byteorder)
         assert ack == 0xff
 
+    def _setProtocol(self, version):
+        header = OpCodes.SetProtocol.to_bytes(2, byteorder=self.byteorder)
+        self.ll.sendBytes(header)
+        self.checkAck()
+        self.ll.sendBytes(bytes([version]))
+        self.checkAck()
+        self.reader = FrameReader(self.ll.recvBytes)
+
+    def _send_frame(self, ftype, payload=b''):
+        self.ll.sendBytes(self._frame(ftype, payload))
+
+    def _frame(self, ftype, payload=b''):
+        frame = proto.encode_frame(ftype, self.tx_seq, payload)
+        self.tx_seq = (self.tx_seq + 1) & 0xffff
+        return frame
+
+    def _recv_response(self, ftype):
+        while True:
+            frame = self.reader.read_frame()
+            if frame.type == ftype:
+                return frame
+            if frame.type == FrameType.Samples:
+                self.pkt_pending.append(self._sample_frame(frame))
+            else:
+                print(f'Unexpected frame {frame.type:#x} while waiting for {ftype:#x}')
+
+    def _regs(self, ops):
+        # While the bridge pushes samples the stream thread owns the reader and
+        # hands the reply over, the register exchange rides along the stream
+        streaming = self.stream_thread is not None and self.protocol == 2
+        if not streaming:
+            self._drain()
+        start = time.perf_counter()
+        self._send_frame(FrameType.Regs, proto.encode_regs(ops))
+        frame = self._stream_reply() if streaming else self._recv_response(FrameType.Regs)
+        results = proto.decode_regs(frame.payload)
+        self.m_rtt.observe(time.perf_counter() - start)
+        for op, addr, val in results:
+            assert not op & proto.RegError, f'Register {addr:#x} access failed'
+        return results
+
+    def _stream_reply(self):
+        deadline = time.perf_counter() + self.RegTimeout
+        while True:
+            try:
+                frame = self.reg_replies.get(timeout=0.002)
+                break
+            except queue.Empty:
+                pass
+            # The caller may be the one reading packets, keep the stream
+            # thread from blocking on a full queue in front of the reply
+            while True:
+                try:
+                    item = self.pkt_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    self.pkt_queue.put(None)
+                    break
+                self.pkt_pending.append(item)
+            if time.perf_counter() > deadline:
+                raise TimeoutError('No register reply from the bridge while streaming')
+        if frame is None:
+            raise EOFError('Packet stream stopped')
+        return frame
+
     def _seti2cAddress(self, address):
+        if self.protocol == 2:
+            self._send_frame(FrameType.SetAddress, address.to_bytes(1, byteorder=self.byteorder))
+            self._recv_response(FrameType.SetAddress)
+            return
+
         header = OpCodes.Seti2cAddress.to_bytes(2, byteorder=self.byteorder)
         self.ll.sendBytes(header)
         self.checkAck()
@@ -42,6 +196,13 @@ class INA226_Remote(INA226_If):
         self.ll.sendBytes(bytes)
 
     def _getMaxPktLen(self):
+        if self.protocol == 2:
+            self._send_frame(FrameType.Info)
+            version, max_len, formats = proto.info.unpack(self._recv_response(FrameType.Info).payload)
+            assert version == proto.Version, f'Bridge speaks protocol {version}'
+            self.formats = formats
+            return max_len
+
         header = OpCodes.GetBufferLen.to_bytes(2, byteorder=self.byteorder)
         self.ll.sendBytes(header)
         self.checkAck()
@@ -49,72 +210,438 @@ class INA226_Remote(INA226_If):
         return int.from_bytes(bytes, byteorder=self.byteorder)
 
     def readReg16(self, addr: int):
-        header = OpCodes.ReadReg.to_bytes(2, byteorder=self.byteorder)
-        addr = addr.to_bytes(2, byteorder=self.byteorder)
+        if self.protocol == 2:
+            return self._regs([(proto.RegOp.Read, addr, 0)])[0][2]
 
-        self.ll.sendBytes(header)
-        self.checkAck()
-        self.ll.sendBytes(addr)
+        with self._exclusive():
+            start = time.perf_counter()
+
+            header = OpCodes.ReadReg.to_bytes(2, byteorder=self.byteorder)
+            addr = addr.to_bytes(2, byteorder=self.byteorder)
 
-        reg = self.ll.recvBytes(2)
-        reg = int.from_bytes(bytes=reg, byteorder=self.byteorder)
+            self.ll.sendBytes(header)
+            self.checkAck()
+            self.ll.sendBytes(addr)
+
+            reg = self.ll.recvBytes(2)
+            reg = int.from_bytes(bytes=reg, byteorder=self.byteorder)
+            self.m_rtt.observe(time.perf_counter() - start)
         return reg
 
     def writeReg16(self, addr: int, val: int):
-        header = OpCodes.WriteReg.to_bytes(2, byteorder=self.byteorder)
-        header = bytearray(header)
-        addr = addr.to_bytes(2, byteorder=self.byteorder)
-        val = val.to_bytes(2, byteorder=self.byteorder)
+        if self.protocol == 2:
+            self._regs([(proto.RegOp.Write, addr, val)])
+            return
 
+        with self._exclusive():
+            header = OpCodes.WriteReg.to_bytes(2, byteorder=self.byteorder)
+            header = bytearray(header)
+            addr = addr.to_bytes(2, byteorder=self.byteorder)
+            val = val.to_bytes(2, byteorder=self.byteorder)
 
-        self.ll.sendBytes(header)
-        self.checkAck()
-        self.ll.sendBytes(addr)
-        self.checkAck()
-        self.ll.sendBytes(val)
+            self.ll.sendBytes(header)
+            self.checkAck()
+            self.ll.sendBytes(addr)
+            self.checkAck()
+            self.ll.sendBytes(val)
+
+    def transact(self, ops):
+        if self.protocol == 2:
+            ops = [(proto.RegOp.Read, addr, 0) if val is None else (proto.RegOp.Write, addr, val)
+                   for addr, val in ops]
+            return [val for _, _, val in self._regs(ops)]
+
+        with self._exclusive():
+            return self._transact_v1(ops)
+
+    def _transact_v1(self, ops):
+        # v1 firmware consumes its input as a stream, so the whole command
+        # sequence can go out at once and the acks be checked afterwards
+        cmd = bytearray()
+        reply_len = 0
+        for addr, val in ops:
+            if val is None:
+                cmd += OpCodes.ReadReg.to_bytes(2, byteorder=self.byteorder)
+                cmd += addr.to_bytes(2, byteorder=self.byteorder)
+                reply_len += 3
+            else:
+                cmd += OpCodes.WriteReg.to_bytes(2, byteorder=self.byteorder)
+                cmd += addr.to_bytes(2, byteorder=self.byteorder)
+                cmd += val.to_bytes(2, byteorder=self.byteorder)
+                reply_len += 2
+        start = time.perf_counter()
+        self.ll.sendBytes(bytes(cmd))
+        reply = self.ll.recvBytes(reply_len)
+        self.m_rtt.observe(time.perf_counter() - start)
+
+        results = []
+        pos = 0
+        for addr, val in ops:
+            if val is None:
+                assert reply[pos] == 0xff
+                results.append(int.from_bytes(reply[pos + 1:pos + 3], byteorder=self.byteorder))
+                pos += 3
+            else:
+                assert reply[pos] == 0xff and reply[pos + 1] == 0xff
+                results.append(val)
+                pos += 2
+        return results
 
     def readCurrent(self):
-        if len(self.current_buf) == 0:
+        if self.current_idx == len(self.current_buf):
             self.read_packet()
 
-        raw = self.current_buf.popleft()
-        return raw
+        raw = self.current_buf[self.current_idx]
+        self.current_idx += 1
+        return int(raw)
 
     def readVbus(self):
-        if len(self.vbus_buf) == 0:
+        if self.vbus_idx == len(self.vbus_buf):
             self.read_packet()
 
-        raw = self.vbus_buf.popleft()
-        return raw
+        raw = self.vbus_buf[self.vbus_idx]
+        self.vbus_idx += 1
+        return int(raw)
 
-    def read_packet(self):
-        pkt_length = self.nrSamples
+    def _take(self, n):
+        assert self.current_idx == self.vbus_idx, 'Current and vbus reads are out of step'
+
+        if self.current_idx == len(self.current_buf):
+            self.read_packet()
 
-        if not self.pkt_req_sent:
-            wdata = pkt_length.to_bytes(2, byteorder='little')
+        start = self.current_idx
+        if n is None or start + n <= len(self.current_buf):
+            stop = len(self.current_buf) if n is None else start + n
+            self.current_idx = self.vbus_idx = stop
+            return self.current_buf[start:stop], self.vbus_buf[start:stop], self.time_buf[start:stop]
+
+        current = np.empty(n, dtype=np.uint16)
+        vbus = np.empty(n, dtype=np.uint16)
+        t = np.empty(n)
+        pos = 0
+        while pos < n:
+            if self.current_idx == len(self.current_buf):
+                self.read_packet()
+            start = self.current_idx
+            k = min(n - pos, len(self.current_buf) - start)
+            current[pos:pos + k] = self.current_buf[start:start + k]
+            vbus[pos:pos + k] = self.vbus_buf[start:start + k]
+            t[pos:pos + k] = self.time_buf[start:start + k]
+            self.current_idx = self.vbus_idx = start + k
+            pos += k
+
+        return current, vbus, t
+
+    def readBatch(self, n=None):
+        current, vbus, _ = self._take(n)
+        return current, vbus
+
+    def readBatchTimed(self, n=None):
+        return self._take(n)
+
+    def _request_packets(self):
+        nr_requests = self.pipelineDepth - self.pkt_req_inflight
+        if nr_requests > 0:
+            if self.protocol == 2:
+                payload = proto.sample_request.pack(self.nrSamples // 2, self.sample_format)
+                wdata = b''.join(self._frame(FrameType.SampleRequest, payload) for _ in range(nr_requests))
+            else:
+                wdata = self.nrSamples.to_bytes(2, byteorder='little') * nr_requests
             self.ll.sendBytes(wdata)
-            self.pkt_req_sent = True
+            self.pkt_req_inflight += nr_requests
+            self.req_times.extend([time.perf_counter()] * nr_requests)
 
-        pkt = self.ll.recvBytes(pkt_length * 2)
-        self.pkt_req_sent = False
-        pkt = np.frombuffer(pkt, dtype=np.uint16)
+    def _sample_frame(self, frame):
+        arrival = time.time()
+        start = tracer.enabled and time.perf_counter_ns()
+        index, = proto.samples_header.unpack_from(frame.payload)
+        if len(frame.payload) == proto.samples_header.size:
+            # Overflow frames only carry the index past the samples the bridge dropped
+            pkt = np.empty(0, dtype='<u2')
+        elif frame.flags & proto.FormatMask == SampleFormat.Delta:
+            pkt = interleave(*decode_delta(frame.payload, proto.samples_header.size))
+        else:
+            pkt = np.frombuffer(frame.payload, dtype='<u2', offset=proto.samples_header.size)
 
-        if (len(self.current_buf) or len(self.vbus_buf)):
-            print('Packets were not empty !')
+        if frame.flags & proto.FlagOverflow:
+            self.overflows += 1
+            self.m_overflows.inc()
+        if self.next_index is not None and index != self.next_index:
+            # Keep the sample clock counting conversions across the gap
+            gap = (index - self.next_index) & 0xffffffff
+            self.dropped_samples += gap
+            self.m_dropped.inc(gap)
+            self.clock.skip(gap)
+        self.next_index = (index + len(pkt) // 2) & 0xffffffff
+
+        if start: tracer.record('remote.sample_frame', start)
+        return arrival, pkt
+
+    def _recv_packet(self):
+        if self.protocol == 2:
+            lost = self.reader.lost_frames
+            frame = self._recv_response(FrameType.Samples)
+            # Lost frames were answers to our requests, don't wait for them
+            answered = 1 + self.reader.lost_frames - lost
+            self.pkt_req_inflight = max(self.pkt_req_inflight - answered, 0)
+            self._answered(answered)
+            return self._sample_frame(frame)
+
+        pkt = np.empty(self.nrSamples, dtype='<u2')
+        self.ll.recvInto(pkt)
+        self.pkt_req_inflight -= 1
+        self._answered(1)
+        return time.time(), pkt
+
+    def _answered(self, nr_requests):
+        # Requests without a recorded send time leave the latency alone
+        now = time.perf_counter()
+        sent = None
+        for _ in range(min(nr_requests, len(self.req_times))):
+            sent = self.req_times.popleft()
+        if sent is not None:
+            self.m_latency.observe(now - sent)
 
-        self.current_buf.clear()
-        self.vbus_buf.clear()
+    def _drain(self):
+        assert self.stream_thread is None, 'Register access while streaming'
+        while self.pkt_req_inflight:
+            self.pkt_pending.append(self._recv_packet())
 
-        self.current_buf.extend( pkt[::2] )
-        self.vbus_buf.extend( pkt[1::2] )
+    def read_packet(self):
+        trace_start = tracer.enabled and time.perf_counter_ns()
+        start = time.perf_counter()
+        # Skips empty overflow packets, _sample_frame already counted their loss
+        pkt = ()
+        while not len(pkt):
+            if self.pkt_pending:
+                arrival, pkt = self.pkt_pending.popleft()
+            elif self.stream_thread:
+                self.m_queue.set(self.pkt_queue.qsize())
+                item = self.pkt_queue.get()
+                if item is None:
+                    self._join_stream()
+                    raise EOFError('Packet stream stopped')
+                arrival, pkt = item
+            else:
+                self._request_packets()
+                arrival, pkt = self._recv_packet()
+                self._request_packets()
+        self.m_wait.observe(time.perf_counter() - start)
+
+        if self.current_idx < len(self.current_buf) or self.vbus_idx < len(self.vbus_buf):
+            print('Packets were not empty !')
+
+        nr_pairs = len(pkt) // 2
+        self.current_buf = pkt[0:nr_pairs * 2:2]
+        self.vbus_buf = pkt[1:nr_pairs * 2:2]
+        self.time_buf = self.clock.timestamps(nr_pairs, arrival)
+        self.current_idx = 0
+        self.vbus_idx = 0
 
-        print(f'Packet {self.nr_packets}')
         self.nr_packets += 1
+        self.m_packets.inc()
+        self.m_samples.inc(nr_pairs)
+        if trace_start: tracer.record('remote.read_packet', trace_start)
 
-        if not self.pkt_req_sent:
-            wdata = pkt_length.to_bytes(2, byteorder='little')
-            self.ll.sendBytes(wdata)
-            self.pkt_req_sent = True
+    def _push_loop(self):
+        try:
+            while True:
+                frame = self.reader.read_frame()
+                if frame.type == FrameType.Samples:
+                    self.pkt_queue.put(self._sample_frame(frame))
+                elif frame.type == FrameType.Regs:
+                    self.reg_replies.put(frame)
+                elif frame.type == FrameType.StreamStop:
+                    break
+        except (EOFError, TimeoutError) as e:
+            self.stream_error = e
+        finally:
+            self.reg_replies.put(None)
+            self.pkt_queue.put(None)
+
+    def _stream_loop(self):
+        try:
+            while not self.stream_stop.is_set() or self.pkt_req_inflight:
+                if not self.stream_stop.is_set():
+                    self._request_packets()
+                self.pkt_queue.put(self._recv_packet())
+        except (EOFError, TimeoutError) as e:
+            self.stream_error = e
+        finally:
+            self.pkt_queue.put(None)
+
+    def start_stream(self, queue_len=None):
+        assert self.stream_thread is None, 'Stream already running'
+
+        self.stream_stop = threading.Event()
+        self.stream_error = None
+        self.stream_queue_len = queue_len
+        self.pkt_queue = queue.Queue(maxsize=queue_len if queue_len else 4 * self.pipelineDepth)
+
+        if self.protocol == 2:
+            # The bridge pushes frames on its own, no requests to keep in flight
+            self._drain()
+            self.reg_replies = queue.Queue()
+            self._send_frame(FrameType.StreamStart,
+                             proto.sample_request.pack(self.nrSamples // 2, self.sample_format))
+            self.stream_thread = threading.Thread(target=self._push_loop, daemon=True)
+        else:
+            self.stream_thread = threading.Thread(target=self._stream_loop, daemon=True)
+        self.stream_thread.start()
+
+    def _join_stream(self):
+        self.stream_thread.join()
+        self.stream_thread = None
+
+    def stop_stream(self):
+        if self.stream_thread is None:
+            return
+
+        self.stream_stop.set()
+        if self.protocol == 2:
+            self._send_frame(FrameType.StreamStop)
+        while True:
+            pkt = self.pkt_queue.get()
+            if pkt is None:
+                break
+            self.pkt_pending.append(pkt)
+        self._join_stream()
 
     def terminate(self):
-        self.ll.terminate()
\ No newline at end of file
+        if self.stream_thread:
+            self.stream_stop.set()
+        self.ll.terminate()
+        if self.stream_thread:
+            # Unblock a stream thread stuck on a full queue
+            deadline = time.time() + 1
+            while self.stream_thread.is_alive() and time.time() < deadline:
+                try:
+                    self.pkt_queue.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            self.stream_thread = None
+
+class INA226_RemoteAsync:
+    byteorder = 'little'
+    MaxPktLen = 2048
+
+    def __init__(self, i2c_address, nr_samples, ina226_ll: INA226_llAsync, pipeline_depth=1):
+        self.ll = ina226_ll
+        self.i2c_address = i2c_address
+        self.nr_samples = nr_samples
+        self.pipelineDepth = max(1, pipeline_depth)
+        self.pkt_req_inflight = 0
+        self.pkt_pending = deque()
+
+        self.current_buf = np.empty(0, dtype=np.uint16)
+        self.vbus_buf = np.empty(0, dtype=np.uint16)
+        self.current_idx = 0
+        self.nr_packets = 0
+
+    @classmethod
+    async def create(cls, i2c_address, nr_samples, ina226_ll: INA226_llAsync, pipeline_depth=1):
+        remote = cls(i2c_address, nr_samples, ina226_ll, pipeline_depth)
+        await remote.open()
+        return remote
+
+    async def open(self):
+        await self._seti2cAddress(self.i2c_address)
+        self.MaxPktLen = await self._getMaxPktLen()
+        self.nrSamples = self.MaxPktLen if self.nr_samples > self.MaxPktLen else self.nr_samples
+
+        print(f'max packet length = {self.MaxPktLen}')
+
+    async def checkAck(self):
+        ack = await self.ll.recv(1)
+        assert ack[0] == 0xff
+
+    async def _seti2cAddress(self, address):
+        await self.ll.send(OpCodes.Seti2cAddress.to_bytes(2, byteorder=self.byteorder))
+        await self.checkAck()
+        await self.ll.send(int.to_bytes(address, 1, byteorder=self.byteorder))
+
+    async def _getMaxPktLen(self):
+        await self.ll.send(OpCodes.GetBufferLen.to_bytes(2, byteorder=self.byteorder))
+        await self.checkAck()
+        return int.from_bytes(await self.ll.recv(2), byteorder=self.byteorder)
+
+    async def readReg16(self, addr: int):
+        await self._drain()
+
+        await self.ll.send(OpCodes.ReadReg.to_bytes(2, byteorder=self.byteorder))
+        await self.checkAck()
+        await self.ll.send(addr.to_bytes(2, byteorder=self.byteorder))
+
+        return int.from_bytes(await self.ll.recv(2), byteorder=self.byteorder)
+
+    async def writeReg16(self, addr: int, val: int):
+        await self._drain()
+
+        await self.ll.send(OpCodes.WriteReg.to_bytes(2, byteorder=self.byteorder))
+        await self.checkAck()
+        await self.ll.send(addr.to_bytes(2, byteorder=self.byteorder))
+        await self.checkAck()
+        await self.ll.send(val.to_bytes(2, byteorder=self.byteorder))
+
+    async def _request_packets(self):
+        nr_requests = self.pipelineDepth - self.pkt_req_inflight
+        if nr_requests > 0:
+            wdata = self.nrSamples.to_bytes(2, byteorder='little')
+            await self.ll.send(wdata * nr_requests)
+            self.pkt_req_inflight += nr_requests
+
+    async def _recv_packet(self):
+        pkt = np.empty(self.nrSamples, dtype='<u2')
+        await self.ll.recvInto(pkt)
+        self.pkt_req_inflight -= 1
+        return pkt
+
+    async def _drain(self):
+        while self.pkt_req_inflight:
+            self.pkt_pending.append(await self._recv_packet())
+
+    async def read_packet(self):
+        if self.pkt_pending:
+            pkt = self.pkt_pending.popleft()
+        else:
+            await self._request_packets()
+            pkt = await self._recv_packet()
+            await self._request_packets()
+
+        nr_pairs = len(pkt) // 2
+        self.current_buf = pkt[0:nr_pairs * 2:2]
+        self.vbus_buf = pkt[1:nr_pairs * 2:2]
+        self.current_idx = 0
+        self.nr_packets += 1
+
+    async def readBatch(self, n=None):
+        if self.current_idx == len(self.current_buf):
+            await self.read_packet()
+
+        start = self.current_idx
+        if n is None or start + n <= len(self.current_buf):
+            stop = len(self.current_buf) if n is None else start + n
+            self.current_idx = stop
+            return self.current_buf[start:stop], self.vbus_buf[start:stop]
+
+        current = np.empty(n, dtype=np.uint16)
+        vbus = np.empty(n, dtype=np.uint16)
+        pos = 0
+        while pos < n:
+            if self.current_idx == len(self.current_buf):
+                await self.read_packet()
+            start = self.current_idx
+            k = min(n - pos, len(self.current_buf) - start)
+            current[pos:pos + k] = self.current_buf[start:start + k]
+            vbus[pos:pos + k] = self.vbus_buf[start:start + k]
+            self.current_idx = start + k
+            pos += k
+
+        return current, vbus
+
+    async def stream(self):
+        while True:
+            yield await self.readBatch()
+
+    async def terminate(self):
+        await self.ll.terminate()
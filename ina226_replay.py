@@ -0,0 +1,108 @@
+import time
+import numpy as np
+
+from ina226_regs import *
+from ina226_if import INA226_If
+from ina226_capture import CaptureReader
+
+class INA226_Replay(INA226_If):
+    def __init__(self, path, nr_samples=128, realtime=False, loop=False):
+        self.reader = CaptureReader(path)
+        self.nrSamples = nr_samples
+        self.realtime = realtime
+        self.loop = loop
+
+        self.regs = {
+            INA226_Regs.Config: self.reader.config,
+            INA226_Regs.Calibration: self.reader.calibration,
+            INA226_Regs.MaskEnable: 0,
+            INA226_Regs.AlertLimit: 0,
+            INA226_Regs.ManId: 0x5449,
+            INA226_Regs.DieId: 0x2260,
+        }
+
+        self.current_idx = 0
+        self.vbus_idx = 0
+        self.nr_replayed = 0
+        self.start_time = None
+
+    def setNrSamples(self, nr_samples):
+        self.nrSamples = nr_samples
+
+    def readReg16(self, addr: int):
+        if addr == INA226_Regs.Current:
+            return self.readCurrent()
+        if addr == INA226_Regs.BusVoltage:
+            return self.readVbus()
+        return self.regs.get(addr, 0)
+
+    def writeReg16(self, addr: int, val: int):
+        self.regs[addr] = val
+
+    def _pace(self, nr_samples):
+        if not self.realtime:
+            return
+        if self.start_time is None:
+            self.start_time = time.perf_counter()
+        wait = self.start_time + (self.nr_replayed + nr_samples) * self.reader.interval - time.perf_counter()
+        if wait > 0:
+            time.sleep(wait)
+
+    def _rewind(self, pos):
+        if pos < len(self.reader):
+            return pos
+        if not self.loop or len(self.reader) == 0:
+            raise EOFError(f'End of capture {self.reader.path}')
+        return 0
+
+    def readCurrent(self):
+        self.current_idx = self._rewind(self.current_idx)
+        self._pace(1)
+        current, _ = self.reader.raw(self.current_idx, self.current_idx + 1)
+        self.current_idx += 1
+        return int(current[0])
+
+    def readVbus(self):
+        self.vbus_idx = self._rewind(self.vbus_idx)
+        _, vbus = self.reader.raw(self.vbus_idx, self.vbus_idx + 1)
+        self.vbus_idx += 1
+        self.nr_replayed += 1
+        return int(vbus[0])
+
+    def readBatchTimed(self, n=None):
+        start = self._rewind(self.current_idx)
+        current, vbus = self.readBatch(n)
+        t = self.reader.times(start, min(start + len(current), len(self.reader)))
+        if len(t) < len(current):
+            # Looping past the end keeps the recorded clock running
+            t = np.concatenate((t, t[-1] + self.reader.interval * np.arange(1, len(current) - len(t) + 1)))
+        return current, vbus, t
+
+    def readBatch(self, n=None):
+        assert self.current_idx == self.vbus_idx, 'Current and vbus reads are out of step'
+
+        pos = self._rewind(self.current_idx)
+        if n is None:
+            n = min(self.nrSamples, len(self.reader) - pos)
+        self._pace(n)
+
+        if pos + n <= len(self.reader):
+            current, vbus = self.reader.raw(pos, pos + n)
+            pos += n
+        else:
+            current = np.empty(n, dtype=np.uint16)
+            vbus = np.empty(n, dtype=np.uint16)
+            done = 0
+            while done < n:
+                pos = self._rewind(pos)
+                k = min(n - done, len(self.reader) - pos)
+                current[done:done + k], vbus[done:done + k] = self.reader.raw(pos, pos + k)
+                done += k
+                pos += k
+
+        self.current_idx = self.vbus_idx = pos
+        self.nr_replayed += n
+        return current, vbus
+
+    def terminate(self):
+        pass
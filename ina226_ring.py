@@ -0,0 +1,92 @@
+import threading
+
+class ByteRing:
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.buf = bytearray(capacity)
+        self.view = memoryview(self.buf)
+        self.head = 0
+        self.size = 0
+        self.cond = threading.Condition()
+        self.closed = False
+
+        self.overflows = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return self.size
+
+    def write(self, data):
+        data = memoryview(data).cast('B')
+        with self.cond:
+            n = len(data)
+            free = self.capacity - self.size
+            if n > free:
+                self.overflows += 1
+                self.dropped += n - free
+                n = free
+
+            tail = (self.head + self.size) % self.capacity
+            first = min(n, self.capacity - tail)
+            self.view[tail:tail + first] = data[:first]
+            self.view[:n - first] = data[first:n]
+            self.size += n
+
+            self.cond.notify_all()
+            return n
+
+    def wait(self, nr_bytes, timeout=None):
+        assert nr_bytes <= self.capacity, f'Read of {nr_bytes} exceeds ring capacity {self.capacity}'
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.size >= nr_bytes or self.closed, timeout):
+                raise TimeoutError(f'Got {self.size} of {nr_bytes} bytes')
+            if self.size < nr_bytes:
+                raise EOFError('Ring closed')
+
+    def peek(self, nr_bytes, timeout=None):
+        self.wait(nr_bytes, timeout)
+        first = min(nr_bytes, self.capacity - self.head)
+        views = [self.view[self.head:self.head + first]]
+        if first < nr_bytes:
+            views.append(self.view[:nr_bytes - first])
+        return views
+
+    def consume(self, nr_bytes):
+        with self.cond:
+            assert nr_bytes <= self.size
+            self.head = (self.head + nr_bytes) % self.capacity
+            self.size -= nr_bytes
+            if self.size == 0:
+                self.head = 0
+            self.cond.notify_all()
+
+    # The returned view stays valid until consume(nr_bytes) is called
+    def read_view(self, nr_bytes, timeout=None):
+        views = self.peek(nr_bytes, timeout)
+        if len(views) == 1:
+            return views[0]
+        return memoryview(b''.join(views))
+
+    def readinto(self, buf, timeout=None):
+        out = memoryview(buf).cast('B')
+        pos = 0
+        for v in self.peek(len(out), timeout):
+            out[pos:pos + len(v)] = v
+            pos += len(v)
+        self.consume(pos)
+        return pos
+
+    def read(self, nr_bytes, timeout=None):
+        buf = bytearray(nr_bytes)
+        self.readinto(buf, timeout)
+        return bytes(buf)
+
+    def clear(self):
+        with self.cond:
+            self.head = 0
+            self.size = 0
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
@@ -0,0 +1,294 @@
+import json
+import os
+import sys
+import time
+from argparse import ArgumentParser
+
+import numpy as np
+
+from ina226 import INA226
+
+# Tiered store for long runs: a ring of full-rate raw samples plus rings of
+# min/max/mean/charge/energy aggregates per 1 s, 1 min and 1 h. Every ring is
+# a fixed-size memmapped .npy file in the store directory, so memory and disk
+# stay bounded however long the run is; rollup.json holds the write counters
+# and the still open buckets.
+
+Channels = ('current', 'vbus', 'power')
+
+rollup_dtype = np.dtype(
+    [('t', '<f8'), ('count', '<u4')] +
+    [(f'{ch}_{agg}', '<f8') for ch in Channels for agg in ('min', 'max', 'mean')] +
+    [('charge', '<f8'), ('energy', '<f8')]
+)
+
+raw_dtype = np.dtype([('t', '<f8'), ('current', '<u2'), ('vbus', '<u2')])
+
+DefaultRetention = {
+    1: 8 * 86400,
+    60: 400 * 86400,
+    3600: 10 * 365 * 86400,
+}
+
+class Ring:
+    def __init__(self, path, dtype, capacity, count=0):
+        if os.path.exists(path):
+            self.data = np.lib.format.open_memmap(path, mode='r+')
+            assert self.data.dtype == dtype and len(self.data) == capacity, f'{path} does not match the store layout'
+        else:
+            self.data = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=(capacity,))
+        self.capacity = capacity
+        # Total records ever written, the ring holds the last capacity of them
+        self.count = count
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def append(self, recs):
+        n = len(recs)
+        skip = max(n - self.capacity, 0)
+        pos = (self.count + skip) % self.capacity
+        first = min(n - skip, self.capacity - pos)
+        self.data[pos:pos + first] = recs[skip:skip + first]
+        self.data[:n - skip - first] = recs[skip + first:]
+        self.count += n
+
+    def segments(self):
+        # Oldest first, without copying the whole ring
+        if self.count <= self.capacity:
+            return [self.data[:self.count]]
+        head = self.count % self.capacity
+        return [self.data[head:], self.data[:head]]
+
+    def oldest(self):
+        if not self.count:
+            return None
+        return float(self.segments()[0]['t'][0])
+
+    def range(self, start, stop, span=0):
+        # Records overlapping [start, stop), each covering span from its t
+        parts = []
+        for seg in self.segments():
+            lo = np.searchsorted(seg['t'], start - span, side='right' if span else 'left')
+            hi = np.searchsorted(seg['t'], stop)
+            parts.append(seg[lo:hi])
+        return np.concatenate(parts)
+
+    def covers(self, start):
+        # Never wrapped means nothing before start was ever dropped
+        return self.count <= self.capacity or self.oldest() <= start
+
+    def flush(self):
+        self.data.flush()
+
+def reduce_records(recs, keys, resolution):
+    # Merge runs of records sharing a bucket key, recs ordered by time
+    starts = np.flatnonzero(np.diff(keys, prepend=keys[0] - 1))
+    out = np.zeros(len(starts), dtype=rollup_dtype)
+    out['t'] = keys[starts] * resolution
+    count = np.add.reduceat(recs['count'], starts)
+    out['count'] = count
+    for ch in Channels:
+        out[f'{ch}_min'] = np.minimum.reduceat(recs[f'{ch}_min'], starts)
+        out[f'{ch}_max'] = np.maximum.reduceat(recs[f'{ch}_max'], starts)
+        out[f'{ch}_mean'] = np.add.reduceat(recs[f'{ch}_mean'] * recs['count'], starts) / count
+    out['charge'] = np.add.reduceat(recs['charge'], starts)
+    out['energy'] = np.add.reduceat(recs['energy'], starts)
+    return out
+
+def sample_records(t, current, vbus, power, last=None):
+    # One record per sample, the trapezoid from the previous sample goes to this one
+    recs = np.zeros(len(t), dtype=rollup_dtype)
+    recs['t'] = t
+    recs['count'] = 1
+    for ch, y in zip(Channels, (current, vbus, power)):
+        recs[f'{ch}_min'] = recs[f'{ch}_max'] = recs[f'{ch}_mean'] = y
+
+    prev_t, prev_current, prev_power = last if last else (t[0], current[0], power[0])
+    dt = np.diff(t, prepend=prev_t)
+    recs['charge'] = 0.5 * dt * (current + np.concatenate(([prev_current], current[:-1])))
+    recs['energy'] = 0.5 * dt * (power + np.concatenate(([prev_power], power[:-1])))
+    return recs
+
+class Tier:
+    def __init__(self, directory, resolution, retention, state=None):
+        state = state or {}
+        self.resolution = resolution
+        self.retention = retention
+        self.ring = Ring(os.path.join(directory, f'tier_{resolution}.npy'), rollup_dtype,
+                         int(retention // resolution), state.get('count', 0))
+        pending = state.get('pending')
+        self.pending = np.array([tuple(pending)], dtype=rollup_dtype) if pending else None
+
+    def add(self, recs):
+        # Returns the buckets closed by these records
+        if self.pending is not None:
+            recs = np.concatenate((self.pending, recs))
+        keys = np.floor(recs['t'] / self.resolution).astype(np.int64)
+        buckets = reduce_records(recs, keys, self.resolution)
+        closed, self.pending = buckets[:-1], buckets[-1:]
+        if len(closed):
+            self.ring.append(closed)
+        return closed
+
+    def oldest(self):
+        oldest = self.ring.oldest()
+        if oldest is None and self.pending is not None:
+            oldest = float(self.pending['t'][0])
+        return oldest
+
+    def range(self, start, stop):
+        recs = self.ring.range(start, stop, self.resolution)
+        if self.pending is not None and start - self.resolution < self.pending['t'][0] < stop:
+            recs = np.concatenate((recs, self.pending))
+        return recs
+
+    def state(self):
+        pending = self.pending[0].tolist() if self.pending is not None else None
+        return {'count': self.ring.count, 'pending': pending}
+
+class RollupStore:
+    Resolutions = (1, 60, 3600)
+    FlushInterval = 10.0
+    MaxGap = 1.0
+
+    def __init__(self, directory, currentLSB=None, raw_samples=1 << 22, retention=DefaultRetention):
+        self.directory = directory
+        self.meta_path = os.path.join(directory, 'rollup.json')
+        os.makedirs(directory, exist_ok=True)
+
+        meta = {}
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path) as f:
+                meta = json.load(f)
+            assert currentLSB is None or meta['currentLSB'] == currentLSB, \
+                f'{directory} was recorded with currentLSB {meta["currentLSB"]}'
+            raw_samples = meta['raw_samples']
+            retention = {int(res): r for res, r in meta['retention'].items()}
+
+        self.currentLSB = meta.get('currentLSB', currentLSB)
+        assert self.currentLSB is not None, 'New rollup store needs a currentLSB'
+        self.raw_samples = raw_samples
+        self.retention = retention
+
+        self.raw = Ring(os.path.join(directory, 'raw.npy'), raw_dtype, raw_samples, meta.get('raw_count', 0))
+        tiers = meta.get('tiers', {})
+        self.tiers = [Tier(directory, res, retention[res], tiers.get(str(res))) for res in self.Resolutions]
+        self.last = tuple(meta['last']) if meta.get('last') else None
+        self.last_flush = time.monotonic()
+
+    @classmethod
+    def for_ina226(cls, directory, ina226: INA226, **kwargs):
+        return cls(directory, ina226.currentLSB, **kwargs)
+
+    def convert(self, current_raw, vbus_raw):
+        current = current_raw.view(np.int16) * self.currentLSB
+        vbus = vbus_raw * INA226.BusVoltageLSB
+        return current, vbus, current * vbus
+
+    def update(self, t, current_raw, vbus_raw):
+        if len(t) == 0:
+            return
+
+        raw = np.empty(len(t), dtype=raw_dtype)
+        raw['t'] = t
+        raw['current'] = current_raw
+        raw['vbus'] = vbus_raw
+        self.raw.append(raw)
+
+        current, vbus, power = self.convert(np.asarray(current_raw, dtype=np.uint16), vbus_raw)
+        # Don't integrate across a restart or a stalled link
+        last = self.last if self.last and t[0] - self.last[0] <= self.MaxGap else None
+        recs = sample_records(np.asarray(t, dtype=np.float64), current, vbus, power, last)
+        self.last = (float(t[-1]), float(current[-1]), float(power[-1]))
+
+        # Each tier only sees the buckets the finer one closed
+        for tier in self.tiers:
+            recs = tier.add(recs)
+            if not len(recs):
+                break
+
+        if time.monotonic() - self.last_flush > self.FlushInterval:
+            self.flush()
+
+    def raw_range(self, start, stop):
+        raw = self.raw.range(start, stop)
+        current, vbus, power = self.convert(raw['current'], raw['vbus'])
+        return sample_records(raw['t'], current, vbus, power) if len(raw) else np.zeros(0, dtype=rollup_dtype)
+
+    def oldest(self):
+        times = [t for t in [self.raw.oldest()] + [tier.oldest() for tier in self.tiers] if t is not None]
+        return min(times) if times else None
+
+    def query(self, start, stop, max_points=2000):
+        # Finest tier that still holds start and keeps the result under max_points,
+        # else the coarsest one with any data in range. Returns (resolution, records),
+        # resolution 0 being raw samples.
+        raw = self.raw.range(start, stop)
+        if len(raw) and self.raw.covers(start) and len(raw) <= max_points:
+            return 0, self.raw_range(start, stop)
+
+        best = (self.Resolutions[0], np.zeros(0, dtype=rollup_dtype))
+        for tier in self.tiers:
+            recs = tier.range(start, stop)
+            if not len(recs):
+                continue
+            best = (tier.resolution, recs)
+            if tier.ring.covers(start) and len(recs) <= max_points:
+                break
+        return best
+
+    def flush(self):
+        self.raw.flush()
+        for tier in self.tiers:
+            tier.ring.flush()
+
+        meta = {
+            'currentLSB': self.currentLSB,
+            'raw_samples': self.raw_samples,
+            'retention': self.retention,
+            'raw_count': self.raw.count,
+            'tiers': {str(tier.resolution): tier.state() for tier in self.tiers},
+            'last': self.last,
+        }
+        tmp = self.meta_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp, self.meta_path)
+        self.last_flush = time.monotonic()
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def main():
+    argparser = ArgumentParser(description='Query a rollup store, picks the tier from range and point budget')
+    argparser.add_argument('store', help='rollup store directory')
+    argparser.add_argument('--start', type=float, default=None, help='unix time, default oldest data')
+    argparser.add_argument('--stop', type=float, default=None, help='unix time, default now')
+    argparser.add_argument('--last', type=float, default=None, help='seconds before stop, instead of --start')
+    argparser.add_argument('--points', type=int, default=2000, help='max points to return')
+    args = argparser.parse_args()
+
+    store = RollupStore(args.store)
+    stop = args.stop if args.stop is not None else time.time()
+    if args.last is not None:
+        start = stop - args.last
+    elif args.start is not None:
+        start = args.start
+    else:
+        start = store.oldest() or 0
+
+    resolution, recs = store.query(start, stop, args.points)
+    print(f'# resolution {resolution} s, {len(recs)} points')
+    print(','.join(rollup_dtype.names))
+    np.savetxt(sys.stdout, recs, delimiter=',',
+               fmt=['%.3f', '%d'] + ['%.9g'] * (len(rollup_dtype.names) - 2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,321 @@
+import multiprocessing
+import time
+from multiprocessing import shared_memory, resource_tracker
+
+import numpy as np
+
+from ina226_regs import *
+from ina226_if import INA226_If
+
+# One producer, any number of consumers, in one shared memory segment:
+#   header | slots x (seq | count | t[block] | current[block] | vbus[block])
+# Block b goes to slot b % slots. The producer marks the slot seq 2b + 1 while
+# writing and 2b + 2 once done, then bumps write_seq. Consumers never write,
+# they check the slot seq around a read to catch blocks overwritten under them.
+
+RingMagic = b'INA226SH'
+RingVersion = 1
+
+header_dtype = np.dtype([
+    ('magic', 'S8'),
+    ('version', '<u4'),
+    ('slots', '<u4'),
+    ('block_samples', '<u4'),
+    ('closed', '<u4'),
+    ('write_seq', '<u8'),
+    ('currentLSB', '<f8'),
+    ('interval', '<f8'),
+    ('config', '<u2'),
+    ('calibration', '<u2'),
+    ('padding', 'V12'),
+])
+
+def slot_dtype(block_samples):
+    return np.dtype([
+        ('seq', '<u8'),
+        ('count', '<u4'),
+        ('reserved', '<u4'),
+        ('t', '<f8', (block_samples,)),
+        ('current', '<u2', (block_samples,)),
+        ('vbus', '<u2', (block_samples,)),
+    ])
+
+def _attach(name):
+    # Consumers must not hand the segment to the resource tracker, it would
+    # unlink it under the producer when the consumer exits
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        register = resource_tracker.register
+        resource_tracker.register = lambda name, rtype: None
+        try:
+            return shared_memory.SharedMemory(name=name)
+        finally:
+            resource_tracker.register = register
+
+def _map(shm, slots=None, block_samples=None):
+    header = np.ndarray(1, dtype=header_dtype, buffer=shm.buf)
+    if slots is None:
+        assert header['magic'][0] == RingMagic, f'{shm.name} is not an INA226 sample ring'
+        assert header['version'][0] == RingVersion, f'Unsupported sample ring version {header["version"][0]}'
+        slots = int(header['slots'][0])
+        block_samples = int(header['block_samples'][0])
+    data = np.ndarray(slots, dtype=slot_dtype(block_samples), buffer=shm.buf, offset=header_dtype.itemsize)
+    return header[0], data
+
+class SampleRingWriter:
+    def __init__(self, name=None, slots=256, block_samples=4096):
+        size = header_dtype.itemsize + slots * slot_dtype(block_samples).itemsize
+        self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        self.name = self.shm.name
+        self.header, self.data = _map(self.shm, slots, block_samples)
+        self.slots = slots
+        self.block_samples = block_samples
+
+        self.header['slots'] = slots
+        self.header['block_samples'] = block_samples
+        self.header['version'] = RingVersion
+        self.header['magic'] = RingMagic
+        self.seq = 0
+
+    def set_meta(self, currentLSB, interval, config, calibration):
+        self.header['currentLSB'] = currentLSB
+        self.header['interval'] = interval
+        self.header['config'] = config
+        self.header['calibration'] = calibration
+
+    def write(self, t, current_raw, vbus_raw):
+        for pos in range(0, len(t), self.block_samples):
+            n = min(len(t) - pos, self.block_samples)
+            slot = self.data[self.seq % self.slots]
+            slot['seq'] = 2 * self.seq + 1
+            slot['t'][:n] = t[pos:pos + n]
+            slot['current'][:n] = current_raw[pos:pos + n]
+            slot['vbus'][:n] = vbus_raw[pos:pos + n]
+            slot['count'] = n
+            slot['seq'] = 2 * self.seq + 2
+            self.seq += 1
+            self.header['write_seq'] = self.seq
+
+    def close(self):
+        if self.shm is None:
+            return
+        self.header['closed'] = 1
+        del self.header, self.data
+        self.shm.close()
+        self.shm.unlink()
+        self.shm = None
+
+class SampleRingReader:
+    PollInterval = 1e-3
+
+    def __init__(self, name, latest=True):
+        self.shm = _attach(name)
+        self.header, self.data = _map(self.shm)
+        self.slots = len(self.data)
+
+        write_seq = int(self.header['write_seq'])
+        self.next = write_seq if latest else max(write_seq - self.slots + 1, 0)
+        self.current = None
+
+        self.blocks = 0
+        self.samples = 0
+        self.dropped_blocks = 0
+        self.torn_blocks = 0
+
+    @property
+    def currentLSB(self):
+        return float(self.header['currentLSB'])
+
+    @property
+    def interval(self):
+        return float(self.header['interval'])
+
+    @property
+    def lag(self):
+        # Blocks written but not read yet
+        return int(self.header['write_seq']) - self.next
+
+    def _valid(self, seq):
+        return self.data[seq % self.slots]['seq'] == 2 * seq + 2
+
+    def release(self):
+        # Views of the previous block were overwritten while in use
+        if self.current is not None and not self._valid(self.current):
+            self.torn_blocks += 1
+        self.current = None
+
+    def read(self, timeout=None, copy=False):
+        # Next block as (t, current_raw, vbus_raw), views into the ring unless
+        # copy. Views stay valid until the producer laps the ring, which the
+        # next read or release() checks. None on timeout.
+        self.release()
+        deadline = time.perf_counter() + timeout if timeout is not None else None
+        while True:
+            write_seq = int(self.header['write_seq'])
+            # The slot after the newest may already be under rewrite
+            oldest = write_seq - self.slots + 1
+            if self.next < oldest:
+                self.dropped_blocks += oldest - self.next
+                self.next = oldest
+
+            if self.next < write_seq:
+                seq = self.next
+                slot = self.data[seq % self.slots]
+                n = int(slot['count'])
+                block = slot['t'][:n], slot['current'][:n], slot['vbus'][:n]
+                if copy:
+                    block = tuple(x.copy() for x in block)
+                if not self._valid(seq):
+                    # Overwritten while we looked, catch up from the oldest again
+                    self.torn_blocks += 1
+                    continue
+                self.next = seq + 1
+                self.current = None if copy else seq
+                self.blocks += 1
+                self.samples += n
+                return block
+
+            if self.header['closed']:
+                raise EOFError(f'Sample ring {self.shm.name} closed')
+            if deadline is not None and time.perf_counter() > deadline:
+                return None
+            time.sleep(self.PollInterval)
+
+    def stats(self):
+        return {
+            'blocks': self.blocks,
+            'samples': self.samples,
+            'lag_blocks': self.lag,
+            'dropped_blocks': self.dropped_blocks,
+            'torn_blocks': self.torn_blocks,
+        }
+
+    def close(self):
+        if self.shm is None:
+            return
+        del self.header, self.data
+        try:
+            self.shm.close()
+        except BufferError:
+            # Blocks handed out as views still map the segment, unmapped once they go
+            pass
+        self.shm = None
+
+class INA226_Shm(INA226_If):
+    def __init__(self, name, latest=True, timeout=5.0):
+        self.reader = SampleRingReader(name, latest)
+        self.interval = self.reader.interval
+        # A block may take up to block_samples intervals to fill, timeout is the slack on top
+        self.timeout = timeout + self.interval * int(self.reader.header['block_samples'])
+        self.currentLSB = self.reader.currentLSB
+        self.current_buf = np.empty(0, dtype=np.uint16)
+        self.vbus_buf = np.empty(0, dtype=np.uint16)
+        self.time_buf = np.empty(0)
+        self.current_idx = 0
+        self.vbus_idx = 0
+
+        # Consumers only see the producer's registers, writes stay local
+        self.regs = {
+            INA226_Regs.Config: int(self.reader.header['config']),
+            INA226_Regs.Calibration: int(self.reader.header['calibration']),
+            INA226_Regs.MaskEnable: 0,
+            INA226_Regs.AlertLimit: 0,
+            INA226_Regs.ManId: 0x5449,
+            INA226_Regs.DieId: 0x2260,
+        }
+
+    def readReg16(self, addr: int):
+        return self.regs.get(addr, 0)
+
+    def writeReg16(self, addr: int, val: int):
+        self.regs[addr] = val
+
+    def _read_block(self):
+        block = self.reader.read(self.timeout, copy=True)
+        if block is None:
+            raise TimeoutError(f'No samples from {self.reader.shm.name} in {self.timeout} s')
+        t, current, vbus = block
+        return current, vbus, t
+
+    def readBatchTimed(self, n=None):
+        # One producer block per call, n is up to the producer. Whatever
+        # readCurrent/readVbus left of the last block comes first.
+        start = min(self.current_idx, self.vbus_idx)
+        if start < len(self.current_buf):
+            self.current_idx = self.vbus_idx = len(self.current_buf)
+            return self.current_buf[start:], self.vbus_buf[start:], self.time_buf[start:]
+        return self._read_block()
+
+    def readBatch(self, n=None):
+        current, vbus, _ = self.readBatchTimed(n)
+        return current, vbus
+
+    def _next_block(self):
+        if self.current_idx < len(self.current_buf) or self.vbus_idx < len(self.vbus_buf):
+            print('Packets were not empty !')
+        self.current_buf, self.vbus_buf, self.time_buf = self._read_block()
+        self.current_idx = 0
+        self.vbus_idx = 0
+
+    def readCurrent(self):
+        if self.current_idx == len(self.current_buf):
+            self._next_block()
+
+        raw = self.current_buf[self.current_idx]
+        self.current_idx += 1
+        return int(raw)
+
+    def readVbus(self):
+        if self.vbus_idx == len(self.vbus_buf):
+            self._next_block()
+
+        raw = self.vbus_buf[self.vbus_idx]
+        self.vbus_idx += 1
+        return int(raw)
+
+    def terminate(self):
+        print(f'Sample ring {self.reader.stats()}')
+        self.reader.close()
+
+def _acquire(name, bring_up, args, stop, ready, slots, block_samples):
+    ina226 = bring_up(args)
+    ina_if = ina226.ina226_if
+    writer = SampleRingWriter(name, slots, block_samples)
+    writer.set_meta(ina226.currentLSB, ina226.interval, ina226.config, ina226.calibration)
+    if hasattr(ina_if, 'start_stream'):
+        ina_if.start_stream()
+    ready.set()
+    try:
+        while not stop.is_set():
+            t, current_raw, vbus_raw = ina226.read_raw_batch_timed()
+            writer.write(t, current_raw, vbus_raw)
+    except (KeyboardInterrupt, EOFError):
+        pass
+    finally:
+        ina226.terminate()
+        writer.close()
+
+class Acquisition:
+    # Runs bring_up(args) -> INA226 and the read loop in a child process, so
+    # rendering and other consumers never hold the GIL the link is read under
+    def __init__(self, name, bring_up, args, slots=256, block_samples=4096):
+        self.name = name
+        self.stop_event = multiprocessing.Event()
+        self.ready = multiprocessing.Event()
+        self.process = multiprocessing.Process(target=_acquire, daemon=True,
+                                               args=(name, bring_up, args, self.stop_event, self.ready,
+                                                     slots, block_samples))
+
+    def start(self, timeout=30.0):
+        self.process.start()
+        while not self.ready.wait(0.1):
+            if not self.process.is_alive() or timeout <= 0:
+                raise RuntimeError(f'Acquisition process for {self.name} failed to start')
+            timeout -= 0.1
+
+    def stop(self, timeout=5.0):
+        self.stop_event.set()
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.terminate()
@@ -0,0 +1,522 @@
+import asyncio
+import random
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+from ina226 import INA226
+from ina226_regs import *
+from ina226_if import INA226_ll, INA226_llAsync
+from ina226_remote import OpCodes
+import ina226_proto as proto
+from ina226_proto import FrameType, SampleFormat
+from ina226_codec import encode_delta
+from ina226_trace import tracer
+
+ShuntVoltageLSB = 2.5e-6
+BusVoltageLSB = 1.25e-3
+
+class INA226_SimChip:
+    ManId = 0x5449
+    DieId = 0x2260
+    ConfigDefault = 0x4127
+
+    def __init__(self, rshunt=1.0, current=None, vbus=None, noise=0.0002, seed=None):
+        self.rshunt = rshunt
+        self.current = current if current else lambda t: 0.05 + 0.02 * np.sin(2 * np.pi * t)
+        self.vbus = vbus if vbus else lambda t: 3.3 - 0.5 * self.current(t)
+        self.noise = noise
+        self.rng = np.random.default_rng(seed)
+        self.t0 = time.perf_counter()
+        self.pointer = 0
+
+        self.regs = {
+            INA226_Regs.Config: self.ConfigDefault,
+            INA226_Regs.Calibration: 0,
+            INA226_Regs.MaskEnable: 0,
+            INA226_Regs.AlertLimit: 0,
+            INA226_Regs.ManId: self.ManId,
+            INA226_Regs.DieId: self.DieId,
+        }
+        self.conv_start = self.t0
+        self.conv_seen = 0
+        self.alert_latched = False
+
+    def conversionInterval(self):
+        config = self.regs[INA226_Regs.Config]
+        vshct = (config >> 3) & 0b111
+        vbusct = (config >> 6) & 0b111
+        avg = (config >> 9) & 0b111
+        interval = (INA226.map_conv_time[vshct] + INA226.map_conv_time[vbusct]) * INA226.map_avg[avg]
+        return interval / 1000
+
+    def conversions(self, t):
+        mode = self.regs[INA226_Regs.Config] & 0b111
+        if mode in (MODE_Setting.PowerDown, MODE_Setting.ShutDown):
+            return 0
+        n = int((t - self.conv_start) / self.conversionInterval())
+        if mode & 0b100:
+            return n
+        return min(n, 1)
+
+    def samples(self, t):
+        t = np.asarray(t, dtype=np.float64) - self.t0
+        current = self.current(t) + self.rng.normal(0, self.noise, t.shape)
+        vbus = self.vbus(t)
+
+        shunt_raw = np.clip(np.round(current * self.rshunt / ShuntVoltageLSB), -0x8000, 0x7fff)
+        cal = self.regs[INA226_Regs.Calibration]
+        current_raw = np.clip(np.trunc(shunt_raw * cal / 2048), -0x8000, 0x7fff).astype(np.int16)
+        vbus_raw = np.clip(np.round(vbus / BusVoltageLSB), 0, 0x7fff).astype(np.uint16)
+        shunt_raw = shunt_raw.astype(np.int16)
+
+        return current_raw.view(np.uint16), vbus_raw, shunt_raw.view(np.uint16)
+
+    def alert(self, t):
+        # Comparator per conversion at times t
+        return self.compare(*self.samples(np.atleast_1d(t)))
+
+    def compare(self, current_raw, vbus_raw, shunt_raw):
+        reg = self.regs[INA226_Regs.MaskEnable]
+        limit = self.regs[INA226_Regs.AlertLimit]
+        shunt = shunt_raw.view(np.int16).astype(np.int64)
+        current = current_raw.view(np.int16).astype(np.int64)
+        vbus = vbus_raw.astype(np.int64)
+        slimit = limit - 0x10000 if limit & 0x8000 else limit
+        fired = np.zeros(len(shunt), dtype=bool)
+        if reg & MaskEnable_Bits.ShuntOverVoltage:
+            fired |= shunt > slimit
+        if reg & MaskEnable_Bits.ShuntUnderVoltage:
+            fired |= shunt < slimit
+        if reg & MaskEnable_Bits.BusOverVoltage:
+            fired |= vbus > limit
+        if reg & MaskEnable_Bits.BusUnderVoltage:
+            fired |= vbus < limit
+        if reg & MaskEnable_Bits.PowerOverLimit:
+            fired |= np.abs(current) * vbus // 20000 > limit
+        return fired
+
+    def latch(self, current_raw, vbus_raw, shunt_raw):
+        # Conversions the bridge streamed out, with the latch enabled any of
+        # them past the limit holds the alert flag until MaskEnable is read
+        if self.regs[INA226_Regs.MaskEnable] & MaskEnable_Bits.AlertLatchEnable and \
+                self.compare(current_raw, vbus_raw, shunt_raw).any():
+            self.alert_latched = True
+
+    def readReg(self, addr, t):
+        if addr in (INA226_Regs.ShuntVoltage, INA226_Regs.BusVoltage, INA226_Regs.Power, INA226_Regs.Current):
+            n = self.conversions(t)
+            if n == 0:
+                return 0
+            current_raw, vbus_raw, shunt_raw = self.samples(self.conv_start + n * self.conversionInterval())
+            current_raw, vbus_raw, shunt_raw = int(current_raw), int(vbus_raw), int(shunt_raw)
+            if addr == INA226_Regs.Current:
+                return current_raw
+            if addr == INA226_Regs.BusVoltage:
+                return vbus_raw
+            if addr == INA226_Regs.ShuntVoltage:
+                return shunt_raw
+            current_raw = current_raw - 0x10000 if current_raw & 0x8000 else current_raw
+            return (abs(current_raw) * vbus_raw // 20000) & 0xffff
+
+        if addr == INA226_Regs.MaskEnable:
+            n = self.conversions(t)
+            reg = self.regs[addr]
+            if n > self.conv_seen:
+                reg |= MaskEnable_Bits.ConversionReadyFlag
+                self.conv_seen = n
+            if self.alert_latched or (n and self.alert(self.conv_start + n * self.conversionInterval())[0]):
+                reg |= MaskEnable_Bits.AlertFunctionFlag
+            self.alert_latched = False
+            return reg
+
+        return self.regs.get(addr, 0)
+
+    def writeReg(self, addr, val, t):
+        if addr == INA226_Regs.Config:
+            if val & 0x8000:
+                val = self.ConfigDefault
+                self.regs[INA226_Regs.Calibration] = 0
+            self.conv_start = t
+            self.conv_seen = 0
+        if addr in (INA226_Regs.Config, INA226_Regs.Calibration, INA226_Regs.MaskEnable, INA226_Regs.AlertLimit):
+            self.regs[addr] = val & 0xffff
+
+
+class INA226_Sim(INA226_ll):
+    byteorder = 'little'
+    MaxPktLen = 2048
+    TxBufferLen = 16384
+    PushHorizon = 0.05
+    PushQueueLen = 64
+    PushPoll = 1e-3
+
+    def __init__(self, chips=None, latency=0.0, bandwidth=None, jitter=0.0, mtu=None,
+                 model_conversion=False, timeout=5.0, loss=0.0, seed=None):
+        self.chips = chips if chips is not None else {0x40: INA226_SimChip(seed=seed)}
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.jitter = jitter
+        self.mtu = mtu
+        self.model_conversion = model_conversion
+        self.timeout = timeout
+        self.loss = loss
+        self.random = random.Random(seed)
+
+        self.cond = threading.Condition()
+        self.rxq = deque()
+        self.devbuf = bytearray()
+        self.firmware = self._firmware()
+        self.need = next(self.firmware)
+
+        self.i2c_address = 0x40
+        self.device_time = 0.0
+        self.sample_time = 0.0
+        self.downlink_free = 0.0
+        self.uplink_free = 0.0
+        self.last_ready = 0.0
+
+        self.tx_seq = 0
+        self.sample_index = 0
+        self.stream_pairs = 0
+        self.stream_format = SampleFormat.Raw16
+
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.bytes_lost = 0
+        self.frames_dropped = 0
+        self.closed = False
+
+    def _transfer(self, start, nbytes, free):
+        start = max(start, free)
+        if self.bandwidth:
+            start += nbytes / self.bandwidth
+        return start
+
+    def _emit(self, data):
+        data = bytes(data)
+        step = self.mtu if self.mtu else len(data)
+        for off in range(0, len(data), step):
+            chunk = data[off:off + step]
+            if self.loss and self.random.random() < self.loss:
+                # Lose one byte of the chunk, like an overrun receive buffer
+                pos = self.random.randrange(len(chunk))
+                chunk = chunk[:pos] + chunk[pos + 1:]
+                self.bytes_lost += 1
+            self.uplink_free = self._transfer(self.device_time, len(chunk), self.uplink_free)
+            ready = self.uplink_free + self.latency
+            if self.jitter:
+                ready += self.random.uniform(0, self.jitter)
+            ready = max(ready, self.last_ready)
+            self.last_ready = ready
+            self.rxq.append((ready, memoryview(chunk)))
+        self.cond.notify_all()
+
+    def _ack(self):
+        self._emit(b'\xff')
+
+    def _word(self):
+        data = yield 2
+        return int.from_bytes(data, byteorder=self.byteorder)
+
+    def _chip(self):
+        return self.chips.get(self.i2c_address)
+
+    def _samples(self, nr_pairs):
+        chip = self._chip()
+        pkt = np.zeros(nr_pairs * 2, dtype='<u2')
+        self.sample_index += nr_pairs
+        if chip is None:
+            return pkt
+
+        interval = chip.conversionInterval()
+        start = max(self.sample_time, self.device_time) if self.model_conversion else self.device_time
+        t = start + interval * np.arange(1, nr_pairs + 1)
+        self.sample_time = t[-1]
+        if self.model_conversion:
+            self.device_time = self.sample_time
+
+        current_raw, vbus_raw, shunt_raw = chip.samples(t)
+        chip.latch(current_raw, vbus_raw, shunt_raw)
+        pkt[0::2], pkt[1::2] = current_raw, vbus_raw
+        return pkt
+
+    def _emit_samples(self, pkt_length):
+        pkt = self._samples((pkt_length + 1) // 2)
+        self._emit(pkt[:pkt_length].tobytes())
+
+    def _emit_frame(self, ftype, payload=b'', flags=0):
+        self._emit(proto.encode_frame(ftype, self.tx_seq, payload, flags))
+        self.tx_seq = (self.tx_seq + 1) & 0xffff
+
+    def _emit_sample_frame(self, nr_pairs, fmt=SampleFormat.Raw16):
+        index = self.sample_index
+        pkt = self._samples(nr_pairs)
+
+        if self.bandwidth and (self.uplink_free - self.device_time) * self.bandwidth > self.TxBufferLen:
+            # Link can't keep up, the bridge drops the samples but still answers,
+            # with an empty flagged frame indexed past the dropped ones
+            self.frames_dropped += 1
+            self._emit_frame(FrameType.Samples, proto.samples_header.pack(self.sample_index),
+                             fmt | proto.FlagOverflow)
+            return
+
+        data = encode_delta(pkt[0::2], pkt[1::2]) if fmt == SampleFormat.Delta else pkt.tobytes()
+        self._emit_frame(FrameType.Samples, proto.samples_header.pack(index) + data, fmt)
+
+    def _push(self, now):
+        if not self.stream_pairs:
+            return
+
+        if self.model_conversion:
+            chip = self._chip()
+            if chip is None:
+                return
+            # Conversions keep running whether or not the link keeps up
+            frame_time = self.stream_pairs * chip.conversionInterval()
+            while self.stream_pairs and max(self.sample_time, self.device_time) + frame_time <= now:
+                self._emit_sample_frame(self.stream_pairs, self.stream_format)
+            return
+
+        # Without conversion timing the bridge sends as fast as the uplink drains
+        while len(self.rxq) < self.PushQueueLen and self.last_ready <= now + self.latency + self.PushHorizon:
+            self.device_time = max(self.device_time, now, self.uplink_free)
+            self._emit_sample_frame(self.stream_pairs, self.stream_format)
+
+    def _firmware_v2(self):
+        while True:
+            head = yield proto.HeaderLen
+            sync, ftype, flags, seq, length = proto.header.unpack(head)
+            rest = yield length + proto.CrcLen
+            payload = rest[:length]
+            if sync != proto.Sync or proto.crc16(payload, proto.crc16(head)) != int.from_bytes(rest[length:], 'little'):
+                continue
+
+            if ftype == FrameType.Regs:
+                chip = self._chip()
+                results = []
+                for op, addr, value in proto.decode_regs(payload):
+                    if chip is None:
+                        results.append((op | proto.RegError, addr, 0))
+                    elif op == proto.RegOp.Write:
+                        chip.writeReg(addr, value, self.device_time)
+                        results.append((op, addr, value))
+                    else:
+                        results.append((op, addr, chip.readReg(addr, self.device_time)))
+                self._emit_frame(FrameType.Regs, proto.encode_regs(results))
+
+            elif ftype == FrameType.SetAddress:
+                self.i2c_address = payload[0]
+                self._emit_frame(FrameType.SetAddress, payload)
+
+            elif ftype == FrameType.Info:
+                self._emit_frame(FrameType.Info, proto.info.pack(proto.Version, self.MaxPktLen,
+                                                                 (1 << SampleFormat.Raw16) | (1 << SampleFormat.Delta)))
+
+            elif ftype == FrameType.SampleRequest:
+                nr_pairs, fmt = proto.sample_request.unpack(payload)
+                self._emit_sample_frame(nr_pairs, fmt)
+
+            elif ftype == FrameType.StreamStart:
+                self.stream_pairs, self.stream_format = proto.sample_request.unpack(payload)
+                self.sample_time = max(self.sample_time, self.device_time)
+                self._push(time.perf_counter())
+
+            elif ftype == FrameType.StreamStop:
+                self.stream_pairs = 0
+                self._emit_frame(FrameType.StreamStop)
+
+    def _firmware(self):
+        while True:
+            op = yield from self._word()
+
+            if op == OpCodes.ReadReg:
+                self._ack()
+                addr = yield from self._word()
+                chip = self._chip()
+                value = chip.readReg(addr, self.device_time) if chip else 0
+                self._emit(value.to_bytes(2, byteorder=self.byteorder))
+
+            elif op == OpCodes.WriteReg:
+                self._ack()
+                addr = yield from self._word()
+                self._ack()
+                value = yield from self._word()
+                chip = self._chip()
+                if chip:
+                    chip.writeReg(addr, value, self.device_time)
+
+            elif op == OpCodes.Seti2cAddress:
+                self._ack()
+                addr = yield 1
+                self.i2c_address = addr[0]
+
+            elif op == OpCodes.GetBufferLen:
+                self._ack()
+                self._emit(self.MaxPktLen.to_bytes(2, byteorder=self.byteorder))
+
+            elif op == OpCodes.SetProtocol:
+                self._ack()
+                version = yield 1
+                if version[0] == proto.Version:
+                    self._ack()
+                    yield from self._firmware_v2()
+
+            else:
+                self._emit_samples(op)
+
+    def sendBytes(self, data):
+        with self.cond:
+            now = time.perf_counter()
+            self.downlink_free = self._transfer(now, len(data), self.downlink_free)
+            self.device_time = max(self.device_time, self.downlink_free + self.latency)
+            self.bytes_sent += len(data)
+
+            self.devbuf.extend(data)
+            while len(self.devbuf) >= self.need:
+                chunk = bytes(self.devbuf[:self.need])
+                del self.devbuf[:self.need]
+                self.need = self.firmware.send(chunk)
+
+    def readyTime(self, nr_bytes):
+        with self.cond:
+            self._push(time.perf_counter())
+            total = 0
+            for ready, chunk in self.rxq:
+                total += len(chunk)
+                if total >= nr_bytes:
+                    return ready
+        return None
+
+    def recvBytes(self, nr_bytes):
+        buf = bytearray(nr_bytes)
+        self.recvInto(buf)
+        return bytes(buf)
+
+    def recvInto(self, buf):
+        start = tracer.enabled and time.perf_counter_ns()
+        out = memoryview(buf).cast('B')
+        pos = 0
+        deadline = time.perf_counter() + self.timeout if self.timeout else None
+
+        with self.cond:
+            while pos < len(out):
+                now = time.perf_counter()
+                self._push(now)
+                if self.rxq and self.rxq[0][0] <= now:
+                    ready, chunk = self.rxq[0]
+                    n = min(len(chunk), len(out) - pos)
+                    out[pos:pos + n] = chunk[:n]
+                    pos += n
+                    if n == len(chunk):
+                        self.rxq.popleft()
+                    else:
+                        self.rxq[0] = (ready, chunk[n:])
+                    continue
+
+                if self.closed:
+                    raise EOFError('Simulated link closed')
+
+                if deadline and now > deadline:
+                    raise TimeoutError(f'Simulated link timeout, got {pos} of {len(out)} bytes')
+
+                wait = self.rxq[0][0] - now if self.rxq else None
+                if self.stream_pairs and not self.rxq:
+                    wait = self.PushPoll
+                if deadline:
+                    wait = min(wait, deadline - now) if wait is not None else deadline - now
+                self.cond.wait(wait)
+
+        self.bytes_received += pos
+        if start: tracer.record('ll.recvInto', start)
+        return pos
+
+    def terminate(self):
+        with self.cond:
+            self.closed = True
+            self.stream_pairs = 0
+            self.rxq.clear()
+            self.devbuf.clear()
+            self.cond.notify_all()
+
+
+class INA226_SimAsync(INA226_llAsync):
+    def __init__(self, sim: INA226_Sim = None, **kwargs):
+        self.sim = sim if sim else INA226_Sim(**kwargs)
+
+    async def send(self, data):
+        self.sim.sendBytes(data)
+
+    async def recvInto(self, buf):
+        nr_bytes = len(memoryview(buf).cast('B'))
+        ready = self.sim.readyTime(nr_bytes)
+        while ready is None:
+            await asyncio.sleep(0.001)
+            ready = self.sim.readyTime(nr_bytes)
+
+        delay = ready - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        return self.sim.recvInto(buf)
+
+    async def terminate(self):
+        self.sim.terminate()
+
+
+class INA226_SimSerial:
+    def __init__(self, sim: INA226_Sim):
+        self.sim = sim
+
+    def write(self, data):
+        self.sim.sendBytes(data)
+        return len(data)
+
+    def read(self, size=1):
+        return self.sim.recvBytes(size)
+
+    def readinto(self, buf):
+        return self.sim.recvInto(buf)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.sim.terminate()
+
+
+class INA226_SimI2cPort:
+    def __init__(self, chip: INA226_SimChip = None, latency=1e-3):
+        self.chip = chip if chip else INA226_SimChip()
+        self.latency = latency
+        self.transactions = 0
+
+    def _transaction(self):
+        self.transactions += 1
+        if self.latency:
+            time.sleep(self.latency)
+        return time.perf_counter()
+
+    def _write(self, out, t):
+        out = bytes(out)
+        if not out:
+            return
+        self.chip.pointer = out[0]
+        if len(out) >= 3:
+            self.chip.writeReg(out[0], (out[1] << 8) | out[2], t)
+
+    def _read(self, readlen, t):
+        value = self.chip.readReg(self.chip.pointer, t)
+        return value.to_bytes(2, byteorder='big')[:readlen]
+
+    def write(self, out, relax=True, start=True):
+        self._write(out, self._transaction())
+
+    def read(self, readlen=0, relax=True, start=True):
+        return self._read(readlen, self._transaction())
+
+    def exchange(self, out=b'', readlen=0, relax=True, start=True):
+        t = self._transaction()
+        self._write(out, t)
+        return self._read(readlen, t)
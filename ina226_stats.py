@@ -0,0 +1,93 @@
+from collections import deque
+import numpy as np
+
+class StreamingStats:
+    def __init__(self, window):
+        self.window = window
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.integral = 0.0
+        self.last_t = None
+        self.last_y = None
+        self.min_q = deque()
+        self.max_q = deque()
+
+    @staticmethod
+    def _push(q, index, y):
+        # Only samples smaller than everything after them can become the window minimum
+        suffix_min = np.minimum.accumulate(y[::-1])[::-1]
+        keep = np.flatnonzero(y < np.append(suffix_min[1:], np.inf))
+
+        while q and q[-1][1] >= y[keep[0]]:
+            q.pop()
+        q.extend(zip((index + keep).tolist(), y[keep].tolist()))
+
+    @staticmethod
+    def _expire(q, oldest):
+        while q and q[0][0] < oldest:
+            q.popleft()
+
+    def update(self, y, t):
+        y = np.asarray(y, dtype=np.float64)
+        t = np.asarray(t, dtype=np.float64)
+        n = len(y)
+        if n == 0:
+            return
+
+        block_mean = float(y.mean())
+        block_m2 = float(np.sum((y - block_mean) ** 2))
+        total = self.count + n
+        delta = block_mean - self.mean
+        self.mean += delta * n / total
+        self.m2 += block_m2 + delta * delta * self.count * n / total
+
+        if self.last_t is not None:
+            self.integral += 0.5 * (t[0] - self.last_t) * (y[0] + self.last_y)
+        self.integral += 0.5 * float(np.sum(np.diff(t) * (y[1:] + y[:-1])))
+        self.last_t = float(t[-1])
+        self.last_y = float(y[-1])
+
+        self._push(self.min_q, self.count, y)
+        self._push(self.max_q, self.count, -y)
+        self.count = total
+        self._expire(self.min_q, self.count - self.window)
+        self._expire(self.max_q, self.count - self.window)
+
+    @property
+    def variance(self):
+        return self.m2 / (self.count - 1) if self.count > 1 else 0.0
+
+    @property
+    def std(self):
+        return self.variance ** 0.5
+
+    @property
+    def min(self):
+        return self.min_q[0][1] if self.min_q else 0.0
+
+    @property
+    def max(self):
+        return -self.max_q[0][1] if self.max_q else 0.0
+
+class RailStats:
+    def __init__(self, window):
+        self.current = StreamingStats(window)
+        self.vbus = StreamingStats(window)
+        self.power = StreamingStats(window)
+
+    def update(self, t, current, vbus, power):
+        self.current.update(current, t)
+        self.vbus.update(vbus, t)
+        self.power.update(power, t)
+
+    @property
+    def charge_mAh(self):
+        return self.current.integral * 1000 / 3600
+
+    @property
+    def energy_mWh(self):
+        return self.power.integral * 1000 / 3600
@@ -0,0 +1,65 @@
+from collections import deque
+import numpy as np
+
+class SampleClock:
+    def __init__(self, interval=None, window=256):
+        self.interval = interval
+        self.points = deque(maxlen=window)
+        self.index = 0
+        self.slope = interval
+        self.offset = None
+        self.last = None
+
+    def reset(self, interval=None):
+        self.__init__(interval if interval is not None else self.interval, self.points.maxlen)
+
+    @staticmethod
+    def _slope(k, t):
+        k_mean, t_mean = k.mean(), t.mean()
+        return float(np.sum((k - k_mean) * (t - t_mean)) / np.sum((k - k_mean) ** 2))
+
+    def _fit(self):
+        k = np.fromiter((p[0] for p in self.points), dtype=np.float64, count=len(self.points))
+        t = np.fromiter((p[1] for p in self.points), dtype=np.float64, count=len(self.points))
+
+        k0, t0 = k[0], t[0]
+        k, t = k - k0, t - t0
+        if len(k) >= 2 and k[-1] > 0:
+            self.slope = self._slope(k, t)
+            if len(k) >= 8:
+                # Link delay only ever adds to arrival times, the least delayed
+                # packets follow the device clock much closer than the average
+                residual = t - self.slope * k
+                fast = residual <= np.percentile(residual, 25)
+                if np.ptp(k[fast]) > 0:
+                    self.slope = self._slope(k[fast], t[fast])
+        elif self.slope is None:
+            self.slope = 0.0
+
+        # Samples can't arrive before they are taken, so put the line under the
+        # earliest arrival instead of through the average link latency
+        self.offset = t0 + float(np.min(t - self.slope * k)) - self.slope * k0
+
+    def timestamps(self, nr_samples, arrival):
+        last = self.index + nr_samples - 1
+        self.points.append((last, arrival))
+        self._fit()
+
+        t = self.offset + self.slope * (self.index + np.arange(nr_samples))
+        if self.last is not None and t[0] <= self.last:
+            # A refit must never move samples back over the previous packet,
+            # slew into the new line within this packet instead
+            end = max(t[-1], self.last + self.slope * nr_samples / 2)
+            t = self.last + (end - self.last) * np.arange(1, nr_samples + 1) / nr_samples
+        self.index += nr_samples
+        self.last = t[-1]
+        return t
+
+    def skip(self, nr_samples):
+        self.index += nr_samples
+
+    @property
+    def drift_ppm(self):
+        if not self.interval or not self.slope:
+            return 0.0
+        return (self.slope / self.interval - 1) * 1e6
@@ -0,0 +1,135 @@
+import itertools
+import json
+import sys
+import threading
+from threading import get_ident
+import time
+from argparse import ArgumentParser
+
+import numpy as np
+
+# Hot paths guard their spans with a single attribute check so a disabled
+# tracer costs next to nothing:
+#
+#   start = tracer.enabled and time.perf_counter_ns()
+#   ...
+#   if start: tracer.record('layer.name', start)
+#
+# Span names are 'layer.what', the layer becomes the Chrome trace category.
+
+class Tracer:
+    def __init__(self, size=1 << 16):
+        self.enabled = False
+        self.resize(size)
+
+    def resize(self, size):
+        self.size = size
+        # Plain lists, element stores are much cheaper than on numpy arrays
+        self.name = [0] * size
+        self.start = [0] * size
+        self.dur = [0] * size
+        self.tid = [0] * size
+        # Ids start at 1 so a known name is a single truthy dict lookup
+        self.names = ['']
+        self.name_ids = {}
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        # next() on itertools.count is atomic under the GIL, no lock per record
+        self.counter = itertools.count()
+        self.origin = time.perf_counter_ns()
+
+    def enable(self, size=None):
+        if size and size != self.size:
+            self.resize(size)
+        self.clear()
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def _name_id(self, name):
+        name_id = self.name_ids.get(name)
+        if name_id is None:
+            with self.lock:
+                name_id = self.name_ids.setdefault(name, len(self.names))
+                if name_id == len(self.names):
+                    self.names.append(name)
+        return name_id
+
+    def record(self, name, start, end=None):
+        if end is None:
+            end = time.perf_counter_ns()
+        i = next(self.counter) % self.size
+        self.name[i] = self.name_ids.get(name) or self._name_id(name)
+        self.start[i] = start
+        self.dur[i] = end - start
+        self.tid[i] = get_ident()
+
+    def records(self):
+        # Taking the count burns one slot, leave it out once the ring wrapped
+        count = next(self.counter)
+        n = min(count, self.size)
+        valid = [i for i in range(n) if count < self.size or i != count % self.size]
+        valid.sort(key=self.start.__getitem__)
+        return [(self.names[self.name[i]], self.start[i], self.dur[i], self.tid[i]) for i in valid]
+
+    def chrome_trace(self):
+        events = []
+        for name, start, dur, tid in self.records():
+            events.append({
+                'name': name,
+                'cat': name.split('.')[0],
+                'ph': 'X',
+                'ts': (start - self.origin) / 1000,
+                'dur': dur / 1000,
+                'pid': 1,
+                'tid': tid,
+            })
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def dump(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.chrome_trace(), f)
+
+tracer = Tracer()
+
+def load(path):
+    with open(path) as f:
+        trace = json.load(f)
+    events = trace['traceEvents'] if isinstance(trace, dict) else trace
+    return [e for e in events if e.get('ph') == 'X']
+
+def summarize(events, percentiles=(50, 90, 99)):
+    durs = {}
+    for e in events:
+        durs.setdefault(e['name'], []).append(e['dur'])
+
+    rows = []
+    for name, d in durs.items():
+        d = np.array(d) / 1000
+        rows.append((name, len(d), d.sum(), *np.percentile(d, percentiles), d.max()))
+    return sorted(rows, key=lambda row: -row[2])
+
+def print_summary(rows, percentiles=(50, 90, 99), file=sys.stdout):
+    head = ''.join(f'{f"p{p}":>10}' for p in percentiles)
+    print(f'{"span":<24}{"count":>8}{"total ms":>12}{head}{"max":>10}', file=file)
+    for name, count, total, *rest in rows:
+        values = ''.join(f'{v:>10.3f}' for v in rest)
+        print(f'{name:<24}{count:>8}{total:>12.1f}{values}', file=file)
+
+def main():
+    argparser = ArgumentParser(description='Per-span latency percentiles (ms) of a Chrome trace dump')
+    argparser.add_argument('trace', help='trace JSON written by monitor.py --trace')
+    argparser.add_argument('--layer', nargs='?', default=None,
+                            help='only spans of this layer, e.g. ll, remote, ina226, plot')
+    args = argparser.parse_args()
+
+    events = load(args.trace)
+    if args.layer:
+        events = [e for e in events if e['name'].split('.')[0] == args.layer]
+    print_summary(summarize(events))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+import importlib
+
+# Transports pull in heavy optional packages (pyftdi, bleak, pyserial), keep
+# them out of the import path until one is actually selected
+classes = {
+    'INA226_I2C_If': 'ina226_i2c',
+    'INA226_Uart': 'ina226_uart',
+    'INA226_Serial': 'ina226_uart',
+    'INA226_Bt': 'ina226_bt',
+    'INA226_Remote': 'ina226_remote',
+    'INA226_Replay': 'ina226_replay',
+    'INA226_Sim': 'ina226_sim',
+    'INA226_Shm': 'ina226_shm',
+    'INA226_Net': 'ina226_net',
+}
+
+transports = {}
+
+def load(name):
+    return getattr(importlib.import_module(classes[name]), name)
+
+def register(name, opener=None):
+    def wrap(opener):
+        transports[name] = opener
+        return opener
+    return wrap(opener) if opener else wrap
+
+def open_transport(name, args):
+    if name not in transports:
+        raise ValueError(f'Unknown transport {name}, choose from {", ".join(transports)}')
+    return transports[name](args)
+
+def _remote(ina_ll, args):
+    if len(args.i2c_addr) > 1:
+        raise Exception('A remote bridge serves one i2c address at a time')
+
+    from ina226_proto import SampleFormat
+
+    INA226_Remote = load('INA226_Remote')
+    try:
+        return [INA226_Remote(args.i2c_addr[0], args.nr_samples, ina_ll, args.pipeline_depth,
+                              protocol=args.protocol, sample_format=SampleFormat[args.encoding])]
+    except KeyboardInterrupt:
+        print('*** KeyboardInterrupt ***')
+        ina_ll.terminate()
+        exit(1)
+
+@register('ble')
+def open_ble(args):
+    return _remote(load('INA226_Bt')(args.ble), args)
+
+@register('uart')
+def open_uart(args):
+    # The STM32 bridge only knows register read/write and fixed size packets,
+    # the remote protocol (address select, buffer length, v2 frames) is opt-in
+    if args.protocol == 2:
+        return _remote(load('INA226_Serial')(args.serial, 115200), args)
+    if len(args.i2c_addr) > 1:
+        raise Exception('The uart bridge serves one i2c address')
+    return [load('INA226_Uart')(args.serial, 115200)]
+
+@register('ftdi')
+def open_ftdi(args):
+    from pyftdi.ftdi import Ftdi
+    from pyftdi.i2c import I2cController
+
+    Ftdi.show_devices()
+    i2c = I2cController()
+
+    i2c.set_retry_count(1)
+    i2c.force_clock_mode(False)
+    i2c.configure(args.ftdi_device)
+
+    INA226_I2C_If = load('INA226_I2C_If')
+    return [INA226_I2C_If(i2c.get_port(addr)) for addr in args.i2c_addr]
+
+@register('replay')
+def open_replay(args):
+    return [load('INA226_Replay')(args.replay, args.nr_samples, realtime=args.realtime)]
+
+@register('sim')
+def open_sim(args):
+    return _remote(load('INA226_Sim')(), args)
+
+@register('shm')
+def open_shm(args):
+    if not args.shm:
+        raise ValueError('The shm transport needs --shm NAME of a running acquisition')
+    return [load('INA226_Shm')(args.shm)]
+
+@register('net')
+def open_net(args):
+    if not args.connect:
+        raise ValueError('The net transport needs --connect host:port')
+    host, port = args.connect.rsplit(':', 1)
+    return [load('INA226_Net')(host, int(port))]
@@ -0,0 +1,248 @@
+import os
+from dataclasses import dataclass
+
+import numpy as np
+
+from ina226 import INA226
+from ina226_regs import *
+from ina226_capture import CaptureWriter
+
+Sources = ('current', 'vbus', 'power')
+Kinds = ('threshold', 'edge', 'slope')
+Directions = ('rising', 'falling', 'either')
+
+@dataclass
+class Trigger:
+    source: str = 'current'
+    kind: str = 'edge'
+    direction: str = 'rising'
+    # A, V or W; for slope triggers the rate in units per second
+    level: float = 0.0
+    hysteresis: float = 0.0
+
+    def __post_init__(self):
+        assert self.source in Sources, f'Unknown trigger source {self.source}'
+        assert self.kind in Kinds, f'Unknown trigger kind {self.kind}'
+        assert self.direction in Directions, f'Unknown trigger direction {self.direction}'
+
+def parse_trigger(spec):
+    # source,kind,direction,level[,hysteresis], e.g. current,edge,rising,0.08
+    fields = spec.split(',')
+    assert len(fields) in (4, 5), f'Trigger spec {spec} is not source,kind,direction,level[,hysteresis]'
+    return Trigger(fields[0], fields[1], fields[2], *map(float, fields[3:]))
+
+@dataclass
+class Capture:
+    number: int
+    t: np.ndarray
+    current_raw: np.ndarray
+    vbus_raw: np.ndarray
+    trigger_index: int
+    # Device alert flag read when the capture completed, None without a hardware alert
+    alert: bool = None
+
+    @property
+    def trigger_time(self):
+        return self.t[self.trigger_index]
+
+    def save(self, path, ina226: INA226):
+        with CaptureWriter.for_ina226(path, ina226, start_time=self.t[0]) as writer:
+            writer.write(self.current_raw, self.vbus_raw, self.t[0])
+
+class CaptureSaver:
+    def __init__(self, directory, ina226: INA226, prefix='trigger'):
+        self.directory = directory
+        self.ina226 = ina226
+        self.prefix = prefix
+        os.makedirs(directory, exist_ok=True)
+
+    def __call__(self, capture: Capture):
+        path = os.path.join(self.directory, f'{self.prefix}_{capture.number:05d}.ina226')
+        capture.save(path, self.ina226)
+        confirmed = '' if capture.alert is None else ', device alert set' if capture.alert else ', device alert not set'
+        print(f'Trigger {capture.number} at {capture.trigger_time:.6f}{confirmed} -> {path}')
+
+class SampleRing:
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.t = np.zeros(capacity)
+        self.current_raw = np.zeros(capacity, dtype=np.uint16)
+        self.vbus_raw = np.zeros(capacity, dtype=np.uint16)
+        # Total samples ever written, absolute index of the next one
+        self.count = 0
+
+    def extend(self, t, current_raw, vbus_raw):
+        n = len(t)
+        skip = max(n - self.capacity, 0)
+        pos = (self.count + skip) % self.capacity
+        first = min(n - skip, self.capacity - pos)
+        for dst, src in ((self.t, t), (self.current_raw, current_raw), (self.vbus_raw, vbus_raw)):
+            dst[pos:pos + first] = src[skip:skip + first]
+            dst[:n - skip - first] = src[skip + first:]
+        self.count += n
+
+    def get(self, start, stop):
+        assert self.count - self.capacity <= start <= stop <= self.count, 'Samples no longer held in the ring'
+        idx = np.arange(start, stop) % self.capacity
+        return self.t[idx], self.current_raw[idx], self.vbus_raw[idx]
+
+class TriggerEngine:
+    def __init__(self, ina226: INA226, trigger: Trigger, pre=1024, post=1024, callback=None, max_packet=4096,
+                 alert=False):
+        self.ina226 = ina226
+        self.trigger = trigger
+        # The trigger is armed in the device comparator too, each capture is
+        # checked against its latched alert flag
+        self.alert = alert
+        self.pre = pre
+        self.post = post
+        self.callback = callback
+        # Pre and post trigger depth plus the packet that completes the capture
+        self.ring = SampleRing(pre + post + max_packet)
+
+        # Edge arming state for the rising and the falling direction
+        self.armed = (False, False)
+        self.last_value = None
+        self.last_time = None
+        self.pending = None
+        self.rearm_at = 0
+        self.nr_captures = 0
+        self.captures = []
+
+    def _values(self, current_raw, vbus_raw):
+        current, vbus, power = self.ina226.convert(current_raw, vbus_raw)
+        return {'current': current, 'vbus': vbus, 'power': power}[self.trigger.source]
+
+    def _edge(self, y, level, hysteresis, armed):
+        # Crossing level counts once y was below level - hysteresis since the last crossing.
+        # Track the last index of each condition, a slot before the packet carries the state.
+        idx = np.arange(len(y) + 1)
+        below = np.concatenate(([armed], y < level - hysteresis))
+        above = np.concatenate(([not armed], y >= level))
+        last_below = np.maximum.accumulate(np.where(below, idx, -1))
+        last_above = np.maximum.accumulate(np.where(above, idx, -1))
+        hits = above[1:] & (last_below[:-1] > last_above[:-1])
+        return hits, bool(last_below[-1] > last_above[-1])
+
+    def _hits(self, t, y):
+        trig = self.trigger
+        signs = {'rising': (1,), 'falling': (-1,), 'either': (1, -1)}[trig.direction]
+
+        if trig.kind == 'slope':
+            prev_y = y[0] if self.last_value is None else self.last_value
+            prev_t = t[0] - self.ina226.interval if self.last_time is None else self.last_time
+            dt = np.diff(t, prepend=prev_t)
+            rate = np.diff(y, prepend=prev_y) / np.where(dt > 0, dt, np.inf)
+            return np.logical_or.reduce([sign * rate >= trig.level for sign in signs])
+
+        if trig.kind == 'threshold':
+            return np.logical_or.reduce([sign * y >= sign * trig.level for sign in signs])
+
+        hits = np.zeros(len(y), dtype=bool)
+        new_armed = []
+        for sign, was_armed in zip((1, -1), self.armed):
+            edge, state = self._edge(sign * y, sign * trig.level, trig.hysteresis, was_armed)
+            new_armed.append(state)
+            if sign in signs:
+                hits |= edge
+        self.armed = tuple(new_armed)
+        return hits
+
+    def _emit(self, start):
+        first = max(start - self.pre, 0)
+        t, current_raw, vbus_raw = self.ring.get(first, start + self.post)
+        alert = alert_fired(self.ina226) if self.alert else None
+        capture = Capture(self.nr_captures, t, current_raw, vbus_raw, start - first, alert)
+        self.nr_captures += 1
+        if self.callback:
+            self.callback(capture)
+        else:
+            self.captures.append(capture)
+
+    def feed(self, t, current_raw, vbus_raw):
+        n = len(t)
+        if n == 0:
+            return
+
+        assert n + self.pre + self.post <= self.ring.capacity, 'Packet larger than the trigger ring allows'
+        base = self.ring.count
+        self.ring.extend(t, current_raw, vbus_raw)
+
+        y = self._values(current_raw, vbus_raw)
+        hits = self._hits(t, y)
+        self.last_value = y[-1]
+        self.last_time = t[-1]
+
+        while True:
+            if self.pending is not None:
+                if self.pending + self.post > self.ring.count:
+                    break
+                self._emit(self.pending)
+                self.pending = None
+
+            # No overlapping captures, look for the next trigger after the last one ends
+            pos = max(self.rearm_at - base, 0)
+            nz = np.flatnonzero(hits[pos:])
+            if not len(nz):
+                break
+            self.pending = base + pos + int(nz[0])
+            self.rearm_at = self.pending + self.post
+
+    def flush(self):
+        # Hand out a capture still waiting for post trigger samples, truncated
+        if self.pending is not None:
+            post = self.post
+            self.post = self.ring.count - self.pending
+            self._emit(self.pending)
+            self.post = post
+            self.pending = None
+
+def alert_config(ina226: INA226, trigger: Trigger):
+    # Map a trigger onto the INA226 alert comparator. Only one level function
+    # can be active, so slopes, falling power and either-way triggers stay
+    # host-side. Returns (mask_enable, alert_limit) or None.
+    if trigger.kind == 'slope' or trigger.direction == 'either':
+        return None
+
+    rising = trigger.direction == 'rising'
+    if trigger.source == 'current':
+        # The comparator sees the shunt voltage register, current = shunt * cal / 2048
+        limit = round(trigger.level / ina226.currentLSB * 2048 / ina226.calibration)
+        bit = MaskEnable_Bits.ShuntOverVoltage if rising else MaskEnable_Bits.ShuntUnderVoltage
+        # Compared against the signed shunt voltage register
+        low, high = -0x8000, 0x7fff
+    elif trigger.source == 'vbus':
+        limit = round(trigger.level / INA226.BusVoltageLSB)
+        bit = MaskEnable_Bits.BusOverVoltage if rising else MaskEnable_Bits.BusUnderVoltage
+        low, high = 0, 0xffff
+    elif rising:
+        limit = round(trigger.level / (25 * ina226.currentLSB))
+        bit = MaskEnable_Bits.PowerOverLimit
+        low, high = 0, 0xffff
+    else:
+        return None
+
+    if not low <= limit <= high:
+        return None
+    return bit | MaskEnable_Bits.AlertLatchEnable, limit & 0xffff
+
+def arm_alert(ina226: INA226, trigger: Trigger):
+    regs = alert_config(ina226, trigger)
+    if regs is None:
+        print(f'Trigger {trigger} has no INA226 alert equivalent, evaluated on the host only')
+        return False
+    mask_enable, alert_limit = regs
+    ina226.apply_config(mask_enable=mask_enable, alert_limit=alert_limit)
+    # Start from a cleared latch
+    alert_fired(ina226)
+    return True
+
+def alert_fired(ina226: INA226):
+    # Latched alert flag, reading MaskEnable clears it for the next capture.
+    # Interfaces that poll MaskEnable themselves keep the flag they saw.
+    ina_if = ina226.ina226_if
+    fired = bool(ina_if.readReg16(INA226_Regs.MaskEnable) & MaskEnable_Bits.AlertFunctionFlag)
+    if hasattr(ina_if, 'alert_flag'):
+        fired = fired or ina_if.alert_flag
+        ina_if.alert_flag = False
+    return fired
@@ -0,0 +1,145 @@
+import json
+import math
+import os
+import time
+from dataclasses import dataclass, asdict
+
+from ina226 import INA226
+from ina226_regs import *
+
+CachePath = os.path.join(os.path.expanduser('~'), '.cache', 'ina226', 'tune.json')
+
+@dataclass
+class TuneResult:
+    device: str
+    rtt: float
+    rate: float
+    vshct: int
+    vbusct: int
+    avg: int
+    interval: float
+    nr_samples: int
+    mode: int = MODE_Setting.ShuntAndBusVoltageCont
+
+    def apply(self, ina226: INA226):
+        interval = ina226.setup(self.vshct, self.vbusct, self.avg, self.mode)
+        ina226.ina226_if.setNrSamples(self.nr_samples)
+        # Packets still held from the trial run would get the new interval's timestamps
+        ina226.ina226_if.flush()
+        return interval
+
+    def report(self):
+        print(f'{self.device}: rtt {self.rtt * 1000:.2f} ms, link {self.rate:.0f} samples/s -> '
+              f'VSHCT {INA226.map_conv_time[self.vshct]} ms, VBUSCT {INA226.map_conv_time[self.vbusct]} ms, '
+              f'AVG {INA226.map_avg[self.avg]}, {1 / self.interval:.1f} samples/s, '
+              f'nr_samples {self.nr_samples}')
+
+def measure_rtt(ina226: INA226, nr_iter=20):
+    start = time.perf_counter()
+    for _ in range(nr_iter):
+        ina226.ina226_if.readReg16(INA226_Regs.ManId)
+    return (time.perf_counter() - start) / nr_iter
+
+def measure_rate(ina226: INA226, duration=1.0, nr_samples=None):
+    ina_if = ina226.ina226_if
+    if nr_samples:
+        ina_if.setNrSamples(nr_samples)
+
+    # First batch pays for filling the pipeline
+    ina_if.readBatch()
+    count = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < duration:
+        current, _ = ina_if.readBatch()
+        count += len(current)
+    return count / (time.perf_counter() - start)
+
+def measure_poll_rate(ina226: INA226, duration=1.0):
+    # The register traffic of one polled sample, timed without waiting for
+    # conversions so the chip's conversion rate doesn't cap the result
+    ina_if = ina226.ina226_if
+    regs = (INA226_Regs.MaskEnable, INA226_Regs.Current, INA226_Regs.BusVoltage)
+    count = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < duration:
+        for addr in regs:
+            ina_if.readReg16(addr)
+        count += 1
+    return count / (time.perf_counter() - start)
+
+def choose_config(min_interval):
+    best = None
+    for vshct, shunt_time in INA226.map_conv_time.items():
+        for vbusct, bus_time in INA226.map_conv_time.items():
+            for avg, nr_avg in INA226.map_avg.items():
+                interval = (shunt_time + bus_time) * nr_avg / 1000
+                if interval < min_interval:
+                    continue
+                # Fastest rate the link keeps up with, then the most averaging,
+                # then the longest shunt conversion for the least current noise
+                key = (interval, -nr_avg, -shunt_time)
+                if best is None or key < best[0]:
+                    best = (key, vshct, vbusct, avg, interval)
+
+    if best is None:
+        return (VSHCT_Setting.ConversionTime_8244us, VBUSCT_Setting.ConversionTime_8244us,
+                AVG_Setting.NrAverages_1024, 2 * 8.244 * 1024 / 1000)
+    return best[1:]
+
+def choose_batch(rtt, interval, max_samples, overhead=0.1, max_latency=0.25):
+    # Enough samples per packet that the round trip is a small share of it,
+    # but not so many that a packet takes longer than max_latency to fill
+    nr_pairs = rtt / (overhead * interval)
+    nr_pairs = min(nr_pairs, max_latency / interval)
+    nr_samples = max(2 * math.ceil(nr_pairs), 16)
+    return int(min(nr_samples, max_samples))
+
+def tune(ina226: INA226, device, margin=0.8, duration=1.0):
+    ina_if = ina226.ina226_if
+    max_samples = getattr(ina_if, 'MaxPktLen', 2048)
+
+    ina226.setup(VSHCT_Setting.ConversionTime_140us, VBUSCT_Setting.ConversionTime_140us,
+                 AVG_Setting.NrAverages_1, MODE_Setting.ShuntAndBusVoltageCont)
+
+    rtt = measure_rtt(ina226)
+    if getattr(ina_if, 'PollsConversions', False):
+        rate = measure_poll_rate(ina226, duration)
+    else:
+        rate = measure_rate(ina226, duration, max_samples)
+
+    vshct, vbusct, avg, interval = choose_config(1 / (margin * rate))
+    nr_samples = choose_batch(rtt, interval, max_samples)
+
+    return TuneResult(device, rtt, rate, vshct, vbusct, avg, interval, nr_samples)
+
+def load(device, path=CachePath):
+    try:
+        with open(path) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if device not in cache:
+        return None
+    return TuneResult(**cache[device])
+
+def save(result: TuneResult, path=CachePath):
+    try:
+        with open(path) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = {}
+    cache[result.device] = asdict(result)
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(cache, f, indent=2)
+    os.replace(tmp, path)
+
+def autotune(ina226: INA226, device, retune=False, path=CachePath, **kwargs):
+    result = None if retune else load(device, path)
+    if result is None:
+        result = tune(ina226, device, **kwargs)
+        save(result, path)
+    result.report()
+    return result.apply(ina226)
@@ -2,29 +2,74 @@
 
 import serial
 import struct
+import time
 from collections import deque
 import numpy as np
 from enum import IntEnum
 
 from ina226_regs import *
-from ina226_if import INA226_If
+from ina226_if import INA226_If, INA226_ll
+import ina226_metrics as metrics
+from ina226_trace import tracer
 
 class OpCodes(IntEnum):
     ReadReg = 0xfff0
     WriteReg = 0xfff1
 
+class INA226_Serial(INA226_ll):
+    def __init__(self, port, baud=115200, timeout=5.0):
+        if isinstance(port, str):
+            self.serial = serial.Serial(port, baud, timeout=timeout)
+        else:
+            self.serial = port
+
+    def sendBytes(self, data):
+        self.serial.write(data)
+
+    def recvBytes(self, nr_bytes):
+        start = tracer.enabled and time.perf_counter_ns()
+        data = self.serial.read(nr_bytes)
+        if len(data) < nr_bytes:
+            raise TimeoutError(f'Serial read timeout, got {len(data)} of {nr_bytes} bytes')
+        if start: tracer.record('ll.recvBytes', start)
+        return data
+
+    def recvInto(self, buf):
+        start = tracer.enabled and time.perf_counter_ns()
+        out = memoryview(buf).cast('B')
+        pos = 0
+        while pos < len(out):
+            n = self.serial.readinto(out[pos:])
+            if not n:
+                raise TimeoutError(f'Serial read timeout, got {pos} of {len(out)} bytes')
+            pos += n
+        if start: tracer.record('ll.recvInto', start)
+        return pos
+
+    def terminate(self):
+        self.serial.close()
+
 class INA226_Uart(INA226_If):
     byteorder = 'little'
     MaxPktLen = 2048
+    PktLength = 128
 
     def __init__(self, port, baud):
         self.port = port
         self.baud = baud
-        self.serial = serial.Serial(self.port, self.baud, timeout=200000)
+        if isinstance(port, str):
+            self.serial = serial.Serial(self.port, self.baud, timeout=200000)
+        else:
+            self.serial = port
         self.current_buf = deque(maxlen=self.MaxPktLen//2)
         self.vbus_buf = deque(maxlen=self.MaxPktLen//2)
         self.nr_packets = 0
         self.pkt_req_sent = False
+        self.pkt_pending = deque()
+
+        labels = {'port': str(port)}
+        self.m_packets = metrics.counter('ina226_packets_total', 'Sample packets received', labels)
+        self.m_samples = metrics.counter('ina226_samples_total', 'Current/vbus sample pairs received', labels)
 
     def checkAck(self):
         ack = self.serial.read(1)
@@ -32,7 +77,21 @@ class INA226_Uart(INA226_If):
         assert ack == 0xff
 
 
+    def _drain(self):
+        # The next packet is requested ahead, take it off the line before
+        # register traffic or the bridge's reply lands behind the samples
+        if self.pkt_req_sent:
+            self.pkt_pending.append(self.serial.read(self.PktLength * 2))
+            self.pkt_req_sent = False
+
+    def flush(self):
+        self._drain()
+        self.pkt_pending.clear()
+        self.current_buf.clear()
+        self.vbus_buf.clear()
+
     def readReg16(self, addr: int):
+        self._drain()
         header = OpCodes.ReadReg.to_bytes(2, byteorder=self.byteorder)
         addr = addr.to_bytes(2, byteorder=self.byteorder)
 
@@ -42,10 +101,11 @@ class INA226_Uart(INA226_If):
         self.serial.write(addr)
 
         reg = self.serial.read(2)
-        reg = np.frombuffer(reg, dtype=np.uint16)
+        reg = int.from_bytes(reg, byteorder=self.byteorder)
         return reg
 
     def writeReg16(self, addr: int, val: int):
+        self._drain()
         header = OpCodes.WriteReg.to_bytes(2, byteorder=self.byteorder)
         header = bytearray(header)
         addr = addr.to_bytes(2, byteorder=self.byteorder)
@@ -75,15 +135,18 @@ class INA226_Uart(INA226_If):
 
     def read_packet(self):
         self.serial.flush()
-        pkt_length = 128
-
-        if not self.pkt_req_sent:
-            wdata = pkt_length.to_bytes(2, byteorder='little')
-            self.serial.write(wdata)
-            self.pkt_req_sent = True
-
-        pkt = self.serial.read(pkt_length * 2)
-        self.pkt_req_sent = False
+        pkt_length = self.PktLength
+
+        if self.pkt_pending:
+            pkt = self.pkt_pending.popleft()
+        else:
+            if not self.pkt_req_sent:
+                wdata = pkt_length.to_bytes(2, byteorder='little')
+                self.serial.write(wdata)
+                self.pkt_req_sent = True
+
+            pkt = self.serial.read(pkt_length * 2)
+            self.pkt_req_sent = False
         pkt = np.frombuffer(pkt, dtype=np.uint16)
 
         if (len(self.current_buf) or len(self.vbus_buf)):
@@ -95,8 +158,9 @@ class INA226_Uart(INA226_If):
         self.current_buf.extend( pkt[::2] )
         self.vbus_buf.extend( pkt[1::2] )
 
-        print(f'Packet {self.nr_packets}')
         self.nr_packets += 1
+        self.m_packets.inc()
+        self.m_samples.inc(len(pkt) // 2)
 
         if not self.pkt_req_sent:
             wdata = pkt_length.to_bytes(2, byteorder='little')
@@ -1,16 +1,20 @@
 #!/usr/bin/env python3
 
-from pyftdi.ftdi import Ftdi
-from pyftdi.i2c import I2cController, I2cNackError
 from argparse import ArgumentParser, FileType
-from plot import RealTimePlotParams, RealTimePlot
+import atexit
+import copy
+import sys
 import time
+import numpy as np
 
 from ina226 import INA226
-from ina226_i2c import INA226_I2C_If
-from ina226_uart import INA226_Uart
-from ina226_bt import INA226_Bt
-from ina226_remote import INA226_Remote
+from ina226_regs import INA226_Regs
+import ina226_metrics as metrics
+from ina226_trace import tracer
+from ina226_capture import CaptureWriter
+from ina226_multi import INA226_Multi
+from ina226_stats import RailStats
+from ina226_transport import transports, open_transport
 
 ftdi_device = "ftdi://ftdi:232h:3:10/1"
 
@@ -19,65 +23,409 @@ def generator(ina226: INA226, interval):
         current = ina226.readCurrent()
         vbus = ina226.readVbus()
         power = current * vbus
-        time.sleep(0.01)
 
-        yield [power * 1000, vbus * 1000, current * 1000]
+        yield time.time(), [power * 1000, vbus * 1000, current * 1000]
+
+def block_generator(ina226: INA226, nr_samples=None, recorder=None, server=None):
+    while True:
+        t, current_raw, vbus_raw = ina226.read_raw_batch_timed(nr_samples)
+        if recorder:
+            recorder.write(current_raw, vbus_raw, t[0])
+        if server:
+            server.publish(t, current_raw, vbus_raw)
+        current, vbus, power = ina226.convert(current_raw, vbus_raw)
+
+        yield t, [power * 1000, vbus * 1000, current * 1000]
+
+def multi_generator(multi: INA226_Multi):
+    for t, rails in multi.blocks():
+        power = np.array([power * 1000 for _, _, power in rails.values()])
+        # Holes in any rail are left out, the plot shows them like a stalled single rail
+        valid = ~np.isnan(power).any(axis=0)
+        if valid.any():
+            yield t[valid], list(power[:, valid])
+
+class CsvSink:
+    def __init__(self, out, ina226: INA226):
+        self.out = out
+        self.ina226 = ina226
+        self.out.write(b'time,current,vbus,power\n')
+
+    def write(self, t, current_raw, vbus_raw):
+        current, vbus, power = self.ina226.convert(current_raw, vbus_raw)
+        np.savetxt(self.out, np.column_stack((t, current, vbus, power)),
+                   fmt=('%.6f', '%.9g', '%.6g', '%.9g'), delimiter=',')
+
+    def close(self):
+        self.out.flush()
+
+class BinSink:
+    def __init__(self, out):
+        self.out = out
+
+    def write(self, t, current_raw, vbus_raw):
+        pkt = np.empty(2 * len(current_raw), dtype='<u2')
+        pkt[0::2] = current_raw
+        pkt[1::2] = vbus_raw
+        self.out.write(pkt.data)
+
+    def close(self):
+        self.out.flush()
+
+class CaptureSink:
+    def __init__(self, path, ina226: INA226):
+        self.writer = CaptureWriter.for_ina226(path, ina226)
+
+    def write(self, t, current_raw, vbus_raw):
+        self.writer.write(current_raw, vbus_raw, t[0])
+
+    def close(self):
+        self.writer.close()
+
+class TriggerSink:
+    def __init__(self, directory, ina226: INA226, args):
+        from ina226_trigger import TriggerEngine, CaptureSaver, parse_trigger, alert_config
+
+        trigger = parse_trigger(args.trigger)
+        # open_ina226s armed the comparator where the trigger maps onto it
+        alert = args.alert and alert_config(ina226, trigger) is not None
+        self.engine = TriggerEngine(ina226, trigger, args.pre_trigger, args.post_trigger,
+                                    CaptureSaver(directory, ina226), alert=alert)
+
+    def write(self, t, current_raw, vbus_raw):
+        self.engine.feed(t, current_raw, vbus_raw)
+
+    def close(self):
+        self.engine.flush()
+
+def run_headless(ina226: INA226, args, out, server=None):
+    if args.trigger:
+        sink = TriggerSink(args.output if args.output != '-' else 'captures', ina226, args)
+    elif args.format == 'capture':
+        assert args.output != '-', 'capture format needs an output file'
+        sink = CaptureSink(args.output, ina226)
+    else:
+        if args.output != '-':
+            out = open(args.output, 'wb')
+        sink = CsvSink(out, ina226) if args.format == 'csv' else BinSink(out)
+
+    rollup = None
+    if args.rollup:
+        from ina226_rollup import RollupStore
+
+        rollup = RollupStore.for_ina226(args.rollup, ina226)
+
+    stats = RailStats(max(int(5 / ina226.interval), 1))
+    m_rate = metrics.gauge('ina226_sample_rate', 'Samples/s over the last summary interval')
+
+    start = last_report = time.time()
+    nr_samples = last_samples = 0
+
+    try:
+        while args.duration is None or time.time() - start < args.duration:
+            t, current_raw, vbus_raw = ina226.read_raw_batch_timed()
+            arrival = time.time()
+
+            sink.write(t, current_raw, vbus_raw)
+            if rollup:
+                rollup.update(t, current_raw, vbus_raw)
+            if server:
+                server.publish(t, current_raw, vbus_raw)
+            stats.update(t, *ina226.convert(current_raw, vbus_raw))
+            nr_samples += len(current_raw)
+
+            if arrival - last_report >= args.summary_interval:
+                rate = (nr_samples - last_samples) / (arrival - last_report)
+                m_rate.set(rate)
+                print(f'{nr_samples} samples, {rate:.1f} samples/s, '
+                      f'{stats.charge_mAh:.6f} mAh, {stats.energy_mWh:.6f} mWh', file=sys.stderr)
+                last_report, last_samples = arrival, nr_samples
+    except (KeyboardInterrupt, EOFError, BrokenPipeError):
+        pass
+    except TimeoutError as e:
+        print(f'Acquisition stopped: {e}', file=sys.stderr)
+    finally:
+        try:
+            sink.close()
+        except BrokenPipeError:
+            pass
+        if rollup:
+            rollup.close()
+        if server:
+            server.close()
+        ina226.terminate()
+
+    elapsed = time.time() - start
+    print(f'{nr_samples} samples in {elapsed:.1f} s, {nr_samples / elapsed:.1f} samples/s', file=sys.stderr)
+
+def open_ina226s(transport, args):
+    ina_ifs = open_transport(transport, args)
+
+    ina226s = []
+    for addr, ina_if in zip(args.i2c_addr, ina_ifs):
+        ina226 = INA226(ina_if)
+        if transport in ('replay', 'shm', 'net'):
+            # Recorded or forwarded samples, keep the settings of the device
+            # they came from instead of configuring one
+            source = ina_if.reader if transport == 'replay' else ina_if
+            ina226.config = ina_if.readReg16(INA226_Regs.Config)
+            ina226.calibration = ina_if.readReg16(INA226_Regs.Calibration)
+            ina226.interval = source.interval
+            ina226.currentLSB = source.currentLSB
+        elif args.profile:
+            from ina226_profile import get_profile
+
+            profile = get_profile(args.profile)
+            print(profile.describe())
+            ina226.apply_profile(profile)
+        elif args.tune or args.retune:
+            from ina226_tune import autotune, CachePath
+
+            device = ':'.join((transport, str(transport_device(transport, args)), hex(addr)))
+            autotune(ina226, device, retune=args.retune, path=args.tune_cache or CachePath)
+            ina226.calibrate(maxCurrent=0.100, Rshunt=1)
+        else:
+            ina226.setup()
+            ina226.calibrate(maxCurrent=0.100, Rshunt=1)
+        if args.trigger and args.alert:
+            from ina226_trigger import arm_alert, parse_trigger
+
+            arm_alert(ina226, parse_trigger(args.trigger))
+        ina226s.append(ina226)
+    return ina226s
+
+# Argument holding the device of each transport, set from --rails transport:device
+device_args = {
+    'ble': 'ble',
+    'uart': 'serial',
+    'ftdi': 'ftdi_device',
+    'replay': 'replay',
+    'shm': 'shm',
+    'net': 'connect',
+}
+
+def open_rails(args):
+    # Each --rails bridge gets its own acquisition thread, the addresses on
+    # one bridge (several only on ftdi) share it and are read round-robin
+    rails = []
+    for k, spec in enumerate(args.rails):
+        transport, _, device = spec.partition(':')
+        bridge = spec if args.rails.count(spec) == 1 else f'{spec}#{k}'
+        rail_args = copy.copy(args)
+        if device:
+            setattr(rail_args, device_args[transport], device)
+        ina226s = open_ina226s(transport, rail_args)
+        for addr, ina226 in zip(rail_args.i2c_addr, ina226s):
+            name = bridge if len(ina226s) == 1 else f'{bridge}/{hex(addr)}'
+            rails.append((name, ina226, bridge))
+    return rails
+
+def acquisition_bring_up(args):
+    # Runs in the acquisition process, args.transport is resolved by then
+    return open_ina226s(args.transport, args)[0]
+
+def transport_device(transport, args):
+    return {
+        'ble': args.ble,
+        'uart': args.serial,
+        'ftdi': args.ftdi_device,
+        'replay': args.replay,
+    }.get(transport, transport)
 
 def main():
     argparser = ArgumentParser()
+    argparser.add_argument('--transport', nargs='?', default=None, choices=transports.keys(),
+                            help='device transport, picked from --serial/--replay when omitted, ble otherwise')
+
     argparser.add_argument('--serial', nargs='?', default=None,
                             help='serial port device name')
 
     argparser.add_argument('--ble', nargs='?', default='esp32_ina226_uart',
                             help='ble device name')
 
-    argparser.add_argument('--i2c_addr', nargs='?', default=0x40,
-                            help='i2c slave address', type=lambda x: int(x,0))
+    argparser.add_argument('--ftdi_device', nargs='?', default=ftdi_device,
+                            help='ftdi device url')
+
+    argparser.add_argument('--i2c_addr', nargs='+', default=[0x40],
+                            help='i2c slave address, several for multi-rail capture (ftdi only)', type=lambda x: int(x,0))
 
     argparser.add_argument('--nr_samples', nargs='?', default=128,
                             help='Number of samples to read per batch (remote only)', type=lambda x: int(x,0))
 
+    argparser.add_argument('--pipeline_depth', nargs='?', default=4,
+                            help='Number of packet requests kept in flight (remote only)', type=int)
+
+    argparser.add_argument('--protocol', nargs='?', default=1, type=int, choices=[1, 2],
+                            help='bridge protocol, 2 is framed with CRC and needs v2 firmware; uart uses the plain STM32 bridge unless 2')
+
+    argparser.add_argument('--encoding', nargs='?', default='Raw16', choices=['Raw16', 'Delta'],
+                            help='sample encoding on the link, Delta packs sample differences (protocol 2 only)')
+
+    argparser.add_argument('--stream', action='store_true',
+                            help='Receive packets continuously in a background thread (remote only)')
+
+    argparser.add_argument('--tune', action='store_true',
+                            help='pick conversion settings and batch size for the link, cached per device')
+
+    argparser.add_argument('--retune', action='store_true',
+                            help='measure the link again instead of using the cached tuning')
+
+    argparser.add_argument('--tune_cache', nargs='?', default=None,
+                            help='tuning cache file')
+
+    argparser.add_argument('--profile', nargs='?', default=None,
+                            help='named measurement profile, e.g. fast-transient, balanced, low-noise-soak; '
+                                 'overrides --tune')
+
+    argparser.add_argument('--record', nargs='?', default=None,
+                            help='append raw samples to a capture file')
+
+    argparser.add_argument('--replay', nargs='?', default=None,
+                            help='play back a capture file instead of a device')
+
+    argparser.add_argument('--realtime', action='store_true',
+                            help='replay at the recorded sample rate')
+
+    argparser.add_argument('--headless', action='store_true',
+                            help='acquire as fast as the link allows without plotting')
+
+    argparser.add_argument('--output', nargs='?', default='-',
+                            help='headless output file, - for stdout')
+
+    argparser.add_argument('--format', nargs='?', default='csv', choices=['csv', 'bin', 'capture'],
+                            help='headless output format')
+
+    argparser.add_argument('--duration', nargs='?', default=None, type=float,
+                            help='stop headless acquisition after this many seconds')
+
+    argparser.add_argument('--summary_interval', nargs='?', default=1.0, type=float,
+                            help='seconds between headless throughput summaries')
+
+    argparser.add_argument('--trigger', nargs='?', default=None,
+                            help='headless triggered capture, source,kind,direction,level[,hysteresis] '
+                                 'e.g. current,edge,rising,0.08; captures go to the --output directory')
+
+    argparser.add_argument('--pre_trigger', nargs='?', default=1024, type=int,
+                            help='samples kept before each trigger')
+
+    argparser.add_argument('--post_trigger', nargs='?', default=1024, type=int,
+                            help='samples kept after each trigger')
+
+    argparser.add_argument('--alert', action='store_true',
+                            help='also program the trigger level into the INA226 alert comparator')
+
+    argparser.add_argument('--rollup', nargs='?', default=None,
+                            help='headless: also keep 1 s / 1 min / 1 h aggregates in this store directory')
+
+    argparser.add_argument('--shm', nargs='?', default=None,
+                            help='acquire in a separate process publishing to this shared memory ring; '
+                                 'with --transport shm attach to an existing one instead')
+
+    argparser.add_argument('--serve', nargs='?', default=None, type=int,
+                            help='publish sample blocks to TCP clients on this port')
+
+    argparser.add_argument('--serve_host', nargs='?', default='127.0.0.1',
+                            help='address to serve on, 0.0.0.0 for all interfaces')
+
+    argparser.add_argument('--connect', nargs='?', default=None,
+                            help='host:port of a monitor.py --serve, used by --transport net')
+
+    argparser.add_argument('--rails', nargs='+', default=None,
+                            help='capture several bridges at once, transport[:device] each, '
+                                 'e.g. uart:/dev/ttyUSB0 ble:esp32_ina226_uart')
+
+    argparser.add_argument('--metrics_port', nargs='?', default=None, type=int,
+                            help='serve metrics as Prometheus text on this local port')
+
+    argparser.add_argument('--trace', nargs='?', default=None,
+                            help='record hot path spans and write a Chrome/Perfetto trace here on exit')
+
     args = argparser.parse_args()
 
-    serial = args.serial
-    ble = args.ble
-    i2c_addr = args.i2c_addr
-    nr_samples = args.nr_samples
+    # Keep stdout clean for sample data, status messages go to stderr
+    out = sys.stdout.buffer
+    if args.headless and args.output == '-':
+        sys.stdout = sys.stderr
 
-    if serial and ble:
-        raise Exception('Can\'t use both serial and ble same time')
+    assert not args.trigger or args.headless, '--trigger needs --headless'
 
-    if serial or ble:
-        if serial:
-            ina_ll = INA226_Uart(serial, 115200)
-        else:
-            ina_ll = INA226_Bt(ble)
+    if args.trace:
+        tracer.enable()
+        atexit.register(tracer.dump, args.trace)
 
-        try:
-            ina_if = INA226_Remote(i2c_addr, nr_samples, ina_ll)
-        except KeyboardInterrupt:
-            print('*** KeyboardInterrupt ***')
-            ina_ll.terminate()
-            exit(1)
+    if args.metrics_port is not None:
+        server = metrics.MetricsServer(args.metrics_port)
+        print(f'metrics on http://127.0.0.1:{server.port}/metrics')
 
+    transport = args.transport
+    if transport is None:
+        transport = 'replay' if args.replay else 'uart' if args.serial else 'ble'
+
+    if args.shm and transport != 'shm':
+        from ina226_shm import Acquisition
+
+        assert len(args.i2c_addr) == 1, '--shm publishes a single rail'
+        args.transport = transport
+        acquisition = Acquisition(args.shm, acquisition_bring_up, args)
+        acquisition.start()
+        atexit.register(acquisition.stop)
+        transport = 'shm'
+
+    if args.rails:
+        rails = open_rails(args)
     else:
-        Ftdi.show_devices()
-        i2c = I2cController()
+        rails = [(hex(addr), ina226, transport) for addr, ina226 in zip(args.i2c_addr, open_ina226s(transport, args))]
+    ina226 = rails[-1][1]
+    ina_if = ina226.ina226_if
+    interval = ina226.interval
 
-        i2c.set_retry_count(1)
-        i2c.force_clock_mode(False)
-        i2c.configure(i2c_addr)
+    if len(rails) > 1:
+        from plot import RealTimePlotParams, RealTimePlot
 
-        port = i2c.get_port(args.addr)
-        ina_if = INA226_I2C_If(port)
+        assert not args.headless, 'Several rails are plotted only, no --headless'
+        multi = INA226_Multi()
+        for name, ina226, group in rails:
+            multi.add_rail(name, ina226, group=group)
+        multi.start()
 
-    ina226 = INA226(ina_if)
+        plotParams = []
+        for name in multi.rails:
+            plotParams.append( RealTimePlotParams(
+                    xlabel='Time S',
+                    ylabel=f"{name} Power, mW",
+                    title="",
+                    integral_label="Energy, mWh",
+                    integral_scale=1 / 3600
+                )
+            )
 
-    interval = ina226.setup()
-    ina226.calibrate(maxCurrent=0.100, Rshunt=1)
+        def terminate_callback(event):
+            multi.terminate()
+
+        plot = RealTimePlot(plotParams, int(5 / multi.period), multi.period, multi_generator(multi), terminate_callback)
+        plot.run()
+        return
 
     print(f'interval = {interval}')
 
+    server = None
+    if args.serve is not None:
+        from ina226_net import SampleServer
+
+        server = SampleServer(args.serve, args.serve_host, meta=dict(
+            currentLSB=ina226.currentLSB, interval=interval, config=ina226.config,
+            calibration=ina226.calibration, device=str(transport_device(transport, args))))
+        print(f'streaming on {args.serve_host}:{server.port}')
+
+    if (args.stream or args.headless) and hasattr(ina_if, 'start_stream'):
+        ina_if.start_stream()
+
+    if args.headless:
+        run_headless(ina226, args, out, server)
+        return
+
+    from plot import RealTimePlotParams, RealTimePlot
+
     winsize_sec = 5
     winsize = int(winsize_sec / interval)
 
@@ -85,28 +433,42 @@ def main():
     plotParams.append( RealTimePlotParams(
             xlabel='Time S',
             ylabel="Power, mW",
-            title=""
+            title="",
+            integral_label="Energy, mWh",
+            integral_scale=1 / 3600
         )
     )
 
     plotParams.append( RealTimePlotParams(
             xlabel='Time S',
             ylabel="Voltage, mV",
-            title=""
+            title="",
+            integral_label=None
         )
     )
 
     plotParams.append( RealTimePlotParams(
             xlabel='Time S',
             ylabel="Current, mA",
-            title=""
+            title="",
+            integral_label="Charge, mAh",
+            integral_scale=1 / 3600
         )
     )
 
+    recorder = None
+    if args.record:
+        recorder = CaptureWriter.for_ina226(args.record, ina226)
+    gen = block_generator(ina226, recorder=recorder, server=server)
+
     def terminate_callback(event):
         ina226.terminate()
+        if recorder:
+            recorder.close()
+        if server:
+            server.close()
 
-    plot = RealTimePlot(plotParams, winsize, interval, generator(ina226, interval), terminate_callback)
+    plot = RealTimePlot(plotParams, winsize, interval, gen, terminate_callback)
     plot.run()
 
 if __name__ == '__main__':
@@ -1,18 +1,70 @@
 import matplotlib.pyplot as plt
 import matplotlib.animation as animation
 import numpy as np
+import queue
+import threading
 import time
-from collections import deque
 
 from dataclasses import dataclass
 
+from ina226_stats import StreamingStats
+import ina226_metrics as metrics
+from ina226_trace import tracer
+
 @dataclass
 class RealTimePlotParams:
     xlabel: str = "Xlabel",
     ylabel: str = "Ylabel",
     title: str = "Title"
+    integral_label: str = "Integral"
+    integral_scale: float = 1.0
+
+class SampleWindow:
+    def __init__(self, size):
+        self.size = size
+        self.t = np.zeros(size)
+        self.y = np.zeros(size)
+        self.head = 0
+        self.count = 0
+
+    def extend(self, t, y):
+        n = len(y)
+        if n > self.size:
+            t, y, n = t[-self.size:], y[-self.size:], self.size
+
+        first = min(n, self.size - self.head)
+        self.t[self.head:self.head + first] = t[:first]
+        self.y[self.head:self.head + first] = y[:first]
+        self.t[:n - first] = t[first:]
+        self.y[:n - first] = y[first:]
+
+        self.head = (self.head + n) % self.size
+        self.count = min(self.count + n, self.size)
+
+    def ordered(self):
+        if self.count < self.size:
+            return self.t[:self.count], self.y[:self.count]
+        return np.concatenate((self.t[self.head:], self.t[:self.head])), \
+               np.concatenate((self.y[self.head:], self.y[:self.head]))
+
+def envelope(t, y, nr_buckets):
+    if len(y) <= 2 * nr_buckets:
+        return t, y
+
+    per_bucket = len(y) // nr_buckets
+    skip = len(y) - per_bucket * nr_buckets
+    t = t[skip:].reshape(nr_buckets, per_bucket)
+    y = y[skip:].reshape(nr_buckets, per_bucket)
+
+    env_t = np.repeat(t[:, 0], 2)
+    env_y = np.empty(2 * nr_buckets)
+    env_y[0::2] = y.min(axis=1)
+    env_y[1::2] = y.max(axis=1)
+    return env_t, env_y
 
 class RealTimePlot:
+    MinFrameInterval = 1 / 30
+
     def __init__(self, params: list, winsize, interval, generator, terminate_callback):
 
         n = len(params)
@@ -23,16 +75,20 @@ class RealTimePlot:
 
         self.params = params
         self.fig, self.axes = plt.subplots(n)
+        self.axes = np.atleast_1d(self.axes)
 
         self.fig.canvas.mpl_connect('close_event', terminate_callback)
 
-        self.data = []
-        self.timestamps = []
+        self.windows = []
+        self.stats = []
         for p in self.params:
-            self.data.append( deque(maxlen=self.winsize) )
-            self.timestamps.append( deque(maxlen=self.winsize) )
+            self.windows.append( SampleWindow(self.winsize) )
+            self.stats.append( StreamingStats(self.winsize) )
 
         self.start_time = time.time()  # Initial timestamp for X axis
+        self.win_time = self.interval * self.winsize
+        self.need_redraw = False
+        self.m_frame_time = metrics.histogram('ina226_plot_frame_seconds', 'Time spent updating one plot frame')
 
         self.lines = []
         self.text_boxes = []
@@ -42,6 +98,7 @@ class RealTimePlot:
             self.axes[i].set_xlabel(p.xlabel)
             self.axes[i].set_ylabel(p.ylabel)
             self.axes[i].set_title(p.title)
+            self.axes[i].set_xlim(-self.win_time, 0)
             self.axes[i].grid(True)
             self.text_boxes.append(
                 self.axes[i].text(
@@ -49,47 +106,89 @@ class RealTimePlot:
                 )
             )
 
-    def update_plot_single(self, i, value, current_time):
-        new_value = value
-        self.data[i].append(new_value)
-        self.timestamps[i].append(current_time)
-
-        self.lines[i].set_data(self.timestamps[i], self.data[i])
-
-        if False:
-            mean_value = np.mean(self.data) if self.data else 0
-            std_dev = np.std(self.data) if self.data else 0
-            min_value = np.min(self.data) if self.data else 0
-            max_value = np.max(self.data) if self.data else 0
-            integral = np.trapz(self.data, self.time_stamps) if len(self.data) > 1 else 0
-
-            # Update the statistics text box
-            self.text_box.set_text(
-                f"Mean: {mean_value:.2f}\n"
-                f"Std Dev: {std_dev:.2f}\n"
-                f"Min: {min_value:.2f}\n"
-                f"Max: {max_value:.2f}\n"
-                f"Integral: {integral:.2f}"
-            )
-
-        win_time = self.interval * self.winsize
-        self.axes[i].set_xlim(max(0, current_time - win_time), current_time)
-        self.axes[i].relim()
-        self.axes[i].autoscale_view()
+        self.samples = queue.SimpleQueue()
+        self.feeder = threading.Thread(target=self.feed, daemon=True)
+
+    def feed(self):
+        try:
+            for t, values in self.generator:
+                self.samples.put((t, values))
+        except EOFError:
+            pass
+        except TimeoutError as e:
+            print(f'Acquisition stopped: {e}')
+
+    def drain(self):
+        blocks = []
+        while True:
+            try:
+                t, values = self.samples.get_nowait()
+            except queue.Empty:
+                break
+
+            values = [np.atleast_1d(v) for v in values]
+            blocks.append((np.atleast_1d(t) - self.start_time, values))
+        return blocks
+
+    def autoscale_y(self, i, y):
+        ymin, ymax = float(np.min(y)), float(np.max(y))
+        low, high = self.axes[i].get_ylim()
+        span = ymax - ymin
+
+        if ymin < low or ymax > high or span < 0.25 * (high - low):
+            margin = 0.1 * span if span else 0.1 * abs(ymax) or 1.0
+            self.axes[i].set_ylim(ymin - margin, ymax + margin)
+            self.need_redraw = True
+
+    def update_stats(self, i, t, y):
+        stats = self.stats[i]
+        stats.update(y, t)
+
+        text = f"Mean: {stats.mean:.2f}\n" \
+               f"Std Dev: {stats.std:.2f}\n" \
+               f"Min: {stats.min:.2f}\n" \
+               f"Max: {stats.max:.2f}"
+        if self.params[i].integral_label:
+            text += f"\n{self.params[i].integral_label}: {stats.integral * self.params[i].integral_scale:.4f}"
+
+        self.text_boxes[i].set_text(text)
+
+    def update_plot_single(self, i, t, y):
+        self.windows[i].extend(t, y)
+        self.update_stats(i, t, y)
+
+        t, y = self.windows[i].ordered()
+        width = max(int(self.axes[i].bbox.width), 1)
+        env_t, env_y = envelope(t, y, width)
+
+        self.lines[i].set_data(env_t - t[-1], env_y)
+        self.autoscale_y(i, env_y)
 
     def update_plot(self, frame):
-        current_time = time.time() - self.start_time  # Calculate elapsed time
-
-        values = next(self.generator)
+        trace_start = tracer.enabled and time.perf_counter_ns()
+        start = time.perf_counter()
+        blocks = self.drain()
+        if not blocks:
+            return self.lines + self.text_boxes
 
+        t = np.concatenate([b[0] for b in blocks])
         for i in range(len(self.params)):
-            self.update_plot_single(i, values[i], current_time)
+            y = np.concatenate([b[1][i] for b in blocks])
+            self.update_plot_single(i, t, y)
 
-        return self.lines
+        if self.need_redraw:
+            self.need_redraw = False
+            self.fig.canvas.draw_idle()
+
+        self.m_frame_time.observe(time.perf_counter() - start)
+        if trace_start: tracer.record('plot.update_plot', trace_start)
+        return self.lines + self.text_boxes
 
     def run(self):
+        self.feeder.start()
         ani = animation.FuncAnimation(
-            self.fig, self.update_plot, blit=True, interval=self.interval * 1000
+            self.fig, self.update_plot, blit=True, cache_frame_data=False,
+            interval=max(self.interval, self.MinFrameInterval) * 1000
         )
         plt.show()
 
@@ -97,14 +196,10 @@ winsize = 1000
 interval = 0.02
 
 
-def generator_1():
-    while True:
-        yield np.sin(time.time())
-        time.sleep(interval)
-
-def generator_2():
+def generator():
     while True:
-        yield np.cos(time.time())
+        t = time.time()
+        yield t, [np.sin(t), np.cos(t)]
         time.sleep(interval)
 
 if __name__ == '__main__':
@@ -112,7 +207,6 @@ if __name__ == '__main__':
 
     params.append(
         RealTimePlotParams(
-            generator=generator_1(),
             xlabel="Time",
             ylabel="Voltage",
             title=("voltage")
@@ -121,13 +215,12 @@ if __name__ == '__main__':
 
     params.append(
         RealTimePlotParams(
-            generator=generator_2(),
             xlabel="Time",
             ylabel="Power",
             title=("Power")
         )
     )
 
-    plot = RealTimePlot(params, winsize, interval)
+    plot = RealTimePlot(params, winsize, interval, generator(), lambda event: None)
 
-    plot.run()
\ No newline at end of file
+    plot.run()
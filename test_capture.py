@@ -0,0 +1,88 @@
+import numpy as np
+import pytest
+
+from ina226 import INA226
+from ina226_capture import CaptureWriter, CaptureReader, header_dtype, chunk_dtype
+
+ChunkSamples = 100
+
+def write_capture(path, current, vbus, sizes, start_time=1000.0, interval=1e-3):
+    with CaptureWriter(path, 0x4127, 1677, 1e-5, interval, start_time=start_time,
+                       chunk_samples=ChunkSamples) as writer:
+        pos = 0
+        for n in sizes:
+            writer.write(current[pos:pos + n], vbus[pos:pos + n])
+            pos += n
+
+def test_round_trip(tmp_path):
+    path = tmp_path / 'test.ina226'
+    n = 2 * ChunkSamples + 50
+    current = np.arange(n, dtype=np.uint16) - 100
+    vbus = np.arange(n, dtype=np.uint16) + 2000
+    # Writes straddling chunk boundaries, the last chunk only half full
+    write_capture(path, current, vbus, [37, 100, 113])
+
+    assert path.stat().st_size == header_dtype.itemsize + 3 * chunk_dtype(ChunkSamples).itemsize
+
+    reader = CaptureReader(path)
+    assert isinstance(reader.chunks, np.memmap)
+    assert (reader.config, reader.calibration) == (0x4127, 1677)
+    assert (reader.currentLSB, reader.interval, reader.start_time) == (1e-5, 1e-3, 1000.0)
+    assert reader.chunk_samples == ChunkSamples
+    assert list(reader.chunks['index']) == [0, 1, 2]
+    assert list(reader.counts) == [ChunkSamples, ChunkSamples, 50]
+    assert len(reader) == n
+
+    got_current, got_vbus = reader.raw()
+    np.testing.assert_array_equal(got_current, current)
+    np.testing.assert_array_equal(got_vbus, vbus)
+
+    # Ranges within a chunk, across chunks and into the partial last one
+    for start, stop in [(10, 20), (90, 110), (50, 240), (195, None), (-10, None)]:
+        got_current, got_vbus = reader.raw(start, stop)
+        np.testing.assert_array_equal(got_current, current[start:stop])
+        np.testing.assert_array_equal(got_vbus, vbus[start:stop])
+
+    np.testing.assert_allclose(reader.times(), 1000.0 + np.arange(n) * 1e-3)
+    np.testing.assert_allclose(reader.times(150, 160), 1000.0 + np.arange(150, 160) * 1e-3)
+
+    blocks = list(reader.blocks())
+    assert [len(c) for c, _ in blocks] == [ChunkSamples, ChunkSamples, 50]
+    np.testing.assert_array_equal(np.concatenate([c for c, _ in blocks]), current)
+
+    c, v, p = reader.read(0, 5)
+    np.testing.assert_allclose(c, current[:5].view(np.int16) * 1e-5)
+    np.testing.assert_allclose(v, vbus[:5] * INA226.BusVoltageLSB)
+    np.testing.assert_allclose(p, c * v)
+
+def test_chunk_times_follow_write_times(tmp_path):
+    path = tmp_path / 'timed.ina226'
+    with CaptureWriter(path, 0, 0, 1e-5, 1e-3, start_time=0.0, chunk_samples=ChunkSamples) as writer:
+        writer.write(np.zeros(ChunkSamples, dtype=np.uint16), np.zeros(ChunkSamples, dtype=np.uint16), 5.0)
+        writer.write(np.zeros(10, dtype=np.uint16), np.zeros(10, dtype=np.uint16), 7.0)
+
+    reader = CaptureReader(path)
+    assert list(reader.chunks['time']) == [5.0, 7.0]
+    np.testing.assert_allclose(reader.times(98, 102), [5.098, 5.099, 7.0, 7.001])
+
+def test_empty_capture(tmp_path):
+    path = tmp_path / 'empty.ina226'
+    CaptureWriter(path, 0, 0, 1e-5, 1e-3, chunk_samples=ChunkSamples).close()
+
+    reader = CaptureReader(path)
+    assert len(reader) == 0
+    current, vbus = reader.raw()
+    assert len(current) == len(vbus) == 0
+
+def test_corrupt_chunk_index(tmp_path):
+    path = tmp_path / 'corrupt.ina226'
+    n = 2 * ChunkSamples
+    write_capture(path, np.zeros(n, dtype=np.uint16), np.zeros(n, dtype=np.uint16), [n])
+
+    chunks = np.memmap(path, dtype=chunk_dtype(ChunkSamples), mode='r+', offset=header_dtype.itemsize)
+    chunks['index'][1] = 5
+    chunks.flush()
+    del chunks
+
+    with pytest.raises(AssertionError, match='chunk index'):
+        CaptureReader(path)
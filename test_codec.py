@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+
+from ina226_codec import BlockLen, encode_delta, decode_delta, interleave
+
+def round_trip(current, vbus):
+    current = np.asarray(current, dtype=np.uint16)
+    vbus = np.asarray(vbus, dtype=np.uint16)
+    buf = encode_delta(current, vbus)
+    got_current, got_vbus = decode_delta(buf)
+    np.testing.assert_array_equal(got_current, current)
+    np.testing.assert_array_equal(got_vbus, vbus)
+    return buf
+
+@pytest.mark.parametrize('n', [0, 1, 2, 3, BlockLen - 1, BlockLen, BlockLen + 1, BlockLen + 2,
+                               2 * BlockLen + 1, 1000, 2048])
+def test_sizes(n):
+    rng = np.random.default_rng(n)
+    current = 0x1000 + np.cumsum(rng.integers(-300, 300, n))
+    vbus = rng.integers(0, 0x8000, n)
+    round_trip(current.astype(np.uint16), vbus)
+
+def test_full_range_swings():
+    n = 3 * BlockLen + 5
+    odd = np.arange(n) % 2
+    # Swings over the whole int16 and uint16 range, both wrap to deltas of +-1
+    round_trip(np.where(odd, 0x7fff, 0x8000), np.where(odd, 0xffff, 0x0000))
+
+    # Steps of 0x8000 zigzag to the full 16 bits, every block needs the widest width
+    buf = round_trip(np.where(odd, 0x8000, 0x0000), np.where(odd, 0x0000, 0x8000))
+    nr_blocks = -(-(n - 1) // BlockLen)
+    assert len(buf) == 2 + 2 * (2 + nr_blocks + nr_blocks * BlockLen * 2)
+
+    rng = np.random.default_rng(0)
+    round_trip(rng.integers(0, 0x10000, n), rng.integers(0, 0x10000, n))
+
+def test_constant_input():
+    n = 4 * BlockLen + 7
+    buf = round_trip(np.full(n, 0x1234), np.full(n, 0xffff))
+    # Zero width blocks carry no data: count, then first value and widths per channel
+    nr_blocks = -(-(n - 1) // BlockLen)
+    assert len(buf) == 2 + 2 * (2 + nr_blocks)
+
+def test_decode_at_offset():
+    current = np.arange(100, dtype=np.uint16)
+    vbus = np.arange(100, 0, -1, dtype=np.uint16)
+    header = b'\x01\x02\x03\x04'
+    got_current, got_vbus = decode_delta(header + encode_delta(current, vbus), len(header))
+    np.testing.assert_array_equal(interleave(got_current, got_vbus), interleave(current, vbus))
@@ -0,0 +1,133 @@
+import io
+
+import numpy as np
+import pytest
+
+import ina226_proto as proto
+from ina226_proto import FrameType, FrameReader, SampleFormat
+from ina226_remote import INA226_Remote
+from ina226_sim import INA226_Sim
+
+def reader_for(data, **kwargs):
+    stream = io.BytesIO(data)
+
+    def recv(nr_bytes):
+        chunk = stream.read(nr_bytes)
+        if len(chunk) < nr_bytes:
+            raise EOFError('End of test data')
+        return chunk
+
+    return FrameReader(recv, **kwargs)
+
+def read_all(reader):
+    frames = []
+    with pytest.raises(EOFError):
+        while True:
+            frames.append(reader.read_frame())
+    return frames
+
+def filler(first_seq, nr_frames=64):
+    # A corrupted or false length makes the reader wait for that many bytes,
+    # on a live link the frames after it provide them
+    return b''.join(proto.encode_frame(FrameType.Samples, seq, bytes(40))
+                    for seq in range(first_seq, first_seq + nr_frames))
+
+def test_round_trip():
+    sent = [
+        (FrameType.Regs, 0, proto.encode_regs([(proto.RegOp.Read, 0x00, 0), (proto.RegOp.Write, 0x05, 0x1234)])),
+        (FrameType.StreamStop, 0, b''),
+        (FrameType.Samples, SampleFormat.Delta | proto.FlagOverflow, bytes(range(256)) * 4),
+    ]
+    data = b''.join(proto.encode_frame(ftype, seq, payload, flags) for seq, (ftype, flags, payload) in enumerate(sent))
+    reader = reader_for(data)
+
+    frames = read_all(reader)
+    assert [(f.type, f.flags, f.payload) for f in frames] == sent
+    assert [f.seq for f in frames] == [0, 1, 2]
+    assert reader.stats() == {'frames': 3, 'crc_errors': 0, 'resync_bytes': 0, 'lost_frames': 0}
+    assert proto.decode_regs(frames[0].payload) == [(proto.RegOp.Read, 0x00, 0), (proto.RegOp.Write, 0x05, 0x1234)]
+
+@pytest.mark.parametrize('pos', [0, 3, 6, proto.HeaderLen + 5, -1])
+def test_resync_after_corrupt_byte(pos):
+    frames = [proto.encode_frame(FrameType.Samples, seq, bytes([seq]) * 40) for seq in range(3)]
+    bad = bytearray(frames[1])
+    bad[pos] ^= 0x41
+    reader = reader_for(frames[0] + bytes(bad) + frames[2] + filler(3))
+
+    got = read_all(reader)
+    assert [f.seq for f in got] == [0] + list(range(2, 3 + 64))
+    assert got[1].payload == bytes([2]) * 40
+    assert reader.lost_frames == 1
+    # Everything of the broken frame is skipped, nothing of the next one
+    assert reader.resync_bytes == len(bad)
+
+def test_resync_over_garbage_and_false_sync():
+    garbage = b'\x00\xa5\x5a\xff\x13' + proto.Sync + b'\x01\x02'
+    data = garbage + proto.encode_frame(FrameType.Info, 7, b'abc') + proto.Sync[:1] + proto.encode_frame(FrameType.Info, 8)
+    reader = reader_for(data + filler(9))
+
+    got = read_all(reader)
+    assert [(f.seq, f.payload) for f in got[:2]] == [(7, b'abc'), (8, b'')]
+    assert len(got) == 2 + 64
+    assert reader.resync_bytes == len(garbage) + 1
+    assert reader.lost_frames == 0
+
+def test_length_error_resyncs():
+    # A header claiming more than max_payload is a false sync, not a frame to wait for
+    bogus = proto.header.pack(proto.Sync, FrameType.Samples, 0, 0, 0xffff)
+    data = bogus + proto.encode_frame(FrameType.Samples, 1, b'\x01\x02')
+    reader = reader_for(data, max_payload=64)
+
+    got = read_all(reader)
+    assert [f.payload for f in got] == [b'\x01\x02']
+    assert reader.resync_bytes == len(bogus)
+
+def test_seq_wraparound():
+    seqs = [0xfffd, 0xfffe, 0xffff, 0x0000, 0x0001]
+    reader = reader_for(b''.join(proto.encode_frame(FrameType.Info, seq) for seq in seqs))
+    assert [f.seq for f in read_all(reader)] == seqs
+    assert reader.lost_frames == 0
+
+    seqs = [0xfffe, 0x0002]
+    reader = reader_for(b''.join(proto.encode_frame(FrameType.Info, seq) for seq in seqs))
+    read_all(reader)
+    assert reader.lost_frames == 3
+
+def sample_frame(seq, index, nr_pairs):
+    payload = proto.samples_header.pack(index & 0xffffffff) + np.zeros(2 * nr_pairs, dtype='<u2').tobytes()
+    return proto.Frame(FrameType.Samples, SampleFormat.Raw16, seq, payload)
+
+def test_sample_index_drops():
+    remote = INA226_Remote(0x40, 128, INA226_Sim(seed=0), protocol=2)
+    remote.setInterval(1e-3)
+
+    remote._sample_frame(sample_frame(0, 100, 10))
+    remote._sample_frame(sample_frame(1, 110, 10))
+    assert remote.dropped_samples == 0
+
+    # 15 samples never arrived
+    remote._sample_frame(sample_frame(2, 135, 10))
+    assert remote.dropped_samples == 15
+
+    # The 32 bit index wraps without counting a gap
+    remote.next_index = 0xfffffffa
+    remote._sample_frame(sample_frame(3, 0xfffffffa, 10))
+    remote._sample_frame(sample_frame(4, 4, 10))
+    assert remote.dropped_samples == 15
+    remote.terminate()
+
+def test_overflow_answers_every_request():
+    # A saturated link drops samples, but each pipelined request still gets
+    # exactly one reply, an empty flagged frame for the dropped ones
+    sim = INA226_Sim(bandwidth=200000, seed=0, timeout=1.0)
+    remote = INA226_Remote(0x40, 2048, sim, pipeline_depth=16, protocol=2)
+    remote.setInterval(1e-3)
+    for _ in range(40):
+        assert len(remote.readBatch()[0]) == 1024
+    remote._drain()
+
+    assert sim.frames_dropped > 0
+    assert remote.pkt_req_inflight == 0
+    assert remote.overflows == sim.frames_dropped
+    assert remote.dropped_samples == 1024 * sim.frames_dropped
+    remote.terminate()
@@ -0,0 +1,47 @@
+import json
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+import pytest
+
+from ina226_capture import CaptureWriter
+
+Root = os.path.dirname(os.path.abspath(__file__))
+
+# Packages only the transport (or the plot) that needs them may pull in
+Heavy = ('bleak', 'pyftdi', 'serial', 'matplotlib')
+TransportModules = ('ina226_bt', 'ina226_i2c', 'ina226_uart', 'ina226_remote', 'ina226_sim')
+
+def loaded_after(code):
+    # A fresh interpreter, this process has imported all sorts already
+    script = f'{code}\nimport json, sys\nprint(json.dumps(sorted(sys.modules)))'
+    out = subprocess.run([sys.executable, '-c', script], cwd=Root, check=True,
+                         capture_output=True, text=True).stdout
+    return {name.split('.')[0] for name in json.loads(out.splitlines()[-1])}
+
+def test_monitor_import_is_light():
+    loaded = loaded_after('import monitor')
+    assert not loaded & set(Heavy), f'import monitor loads {sorted(loaded & set(Heavy))}'
+    assert not loaded & set(TransportModules), f'import monitor loads {sorted(loaded & set(TransportModules))}'
+
+@pytest.mark.parametrize('name, module', [('INA226_Replay', 'ina226_replay'), ('INA226_Sim', 'ina226_sim')])
+def test_transport_loads_only_its_module(name, module):
+    loaded = loaded_after(f'import ina226_transport\nina226_transport.load({name!r})')
+    assert module in loaded
+    assert not loaded & {'bleak', 'pyftdi', 'matplotlib'}
+
+def test_replay_startup_time(tmp_path):
+    # One headless run the way test jigs launch it, bounded generously so
+    # only a regression like an eager heavy import trips it
+    path = tmp_path / 'jig.ina226'
+    with CaptureWriter(path, 0x4127, 1677, 1e-5, 1e-3) as writer:
+        writer.write(np.zeros(1024, dtype=np.uint16), np.zeros(1024, dtype=np.uint16))
+
+    cmd = [sys.executable, os.path.join(Root, 'monitor.py'), '--transport', 'replay', '--replay', str(path),
+           '--headless', '--output', os.devnull]
+    start = time.perf_counter()
+    subprocess.run(cmd, cwd=Root, check=True, capture_output=True)
+    assert time.perf_counter() - start < 5.0